@@ -25,32 +25,23 @@ $$ LANGUAGE plpgsql;
 CREATE OR REPLACE FUNCTION recreate_vertex_of_routing_table(regclass)
 RETURNS void
 AS $$
-DECLARE
-    row RECORD;
-    vertex_storage hstore;
-    new_vertex int;
 BEGIN
-    vertex_storage := ''::hstore;
-    new_vertex := -1;
-    FOR row in EXECUTE FORMAT('SELECT id, source, target FROM %I ORDER BY id', $1)
-    LOOP
-        IF NOT vertex_storage ? row.source::text THEN
-            vertex_storage = vertex_storage || hstore(row.source::text, new_vertex::text);
-            new_vertex := new_vertex - 1;
-        END IF;
-        IF NOT vertex_storage ? row.target::text THEN
-            vertex_storage = vertex_storage || hstore(row.target::text, new_vertex::text);
-            new_vertex := new_vertex - 1;
-        END IF;
-    END LOOP;
-    -- remap
-    FOR row IN SELECT key, value FROM EACH(vertex_storage)
-    LOOP
-        EXECUTE FORMAT('UPDATE %I SET source=$1 WHERE source = $2', $1) USING row.value::int, row.key::int;
-        EXECUTE FORMAT('UPDATE %I SET target=$1 WHERE target = $2', $1) USING row.value::int, row.key::int;
-    END LOOP;
-    -- invert sign of source and target columns
-    EXECUTE FORMAT('UPDATE %I SET source=source*(-1)', $1);
-    EXECUTE FORMAT('UPDATE %I SET target=target*(-1)', $1);
+    -- number the vertices 1..n in the order of their first appearance (ordered by edge id,
+    -- source before target) and remap source and target with a single update
+    EXECUTE FORMAT(
+        'WITH vertex AS (
+            SELECT old_vertex, ROW_NUMBER() OVER (ORDER BY MIN(position)) AS new_vertex
+                FROM (
+                    SELECT source AS old_vertex, id::bigint * 2 AS position FROM %1$I
+                    UNION ALL
+                    SELECT target AS old_vertex, id::bigint * 2 + 1 AS position FROM %1$I
+                ) AS end_point
+                GROUP BY old_vertex
+        )
+        UPDATE %1$I AS routing
+            SET source = source_vertex.new_vertex, target = target_vertex.new_vertex
+            FROM vertex AS source_vertex, vertex AS target_vertex
+            WHERE routing.source = source_vertex.old_vertex
+                AND routing.target = target_vertex.old_vertex', $1);
 END;
 $$ LANGUAGE plpgsql;
@@ -70,6 +70,7 @@ CREATE INDEX idx_"$db_routing_table"_source ON $db_routing_table(source);\n\
 CREATE INDEX idx_"$db_routing_table"_target ON $db_routing_table(target);\n\
 CREATE INDEX idx_"$db_routing_table"_osm_source_id ON $db_routing_table(osm_source_id);\n\
 CREATE INDEX idx_"$db_routing_table"_osm_target_id ON $db_routing_table(osm_target_id);\n\
+CREATE INDEX idx_"$db_routing_table"_osm_id ON $db_routing_table(osm_id);\n\
 CREATE INDEX idx_"$db_routing_table"_geom_way  ON $db_routing_table USING GIST (geom_way);\n\
 \n\
 -- cluster and analyse\n\
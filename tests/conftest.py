@@ -0,0 +1,20 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os, sys, types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Config:
+    """ stand-in for the config singleton, the tests don't need a wg_server.conf """
+    default_language = "en"
+    maps = {}
+
+    def has_session_id_to_remove(self, id):
+        return False
+
+
+config_module = types.ModuleType("webserver.config")
+config_module.Config = Config
+sys.modules["webserver.config"] = config_module
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import math, random
+from array import array
+
+import pytest
+
+from webserver import geometry
+
+
+def get_bearing_list_point_by_point(coordinates):
+    return [ geometry.bearing_between_two_points(
+                coordinates[i+1], coordinates[i], coordinates[i+3], coordinates[i+2]) \
+            for i in range(0, len(coordinates)-2, 2) ]
+
+
+def create_footpath(generator, lat, lon, number_of_points):
+    """ flat coordinate array of a winding path with steps of about 2 meters """
+    coordinates = array('d', [lon, lat])
+    heading = generator.uniform(0, 360)
+    for i in range(number_of_points - 1):
+        heading += generator.gauss(0, 15)
+        lon += 2 / 111320 * math.sin(math.radians(heading)) / math.cos(math.radians(lat))
+        lat += 2 / 111320 * math.cos(math.radians(heading))
+        coordinates.extend((lon, lat))
+    return coordinates
+
+
+@pytest.mark.parametrize("lat, lon", [
+        (52.5200, 13.4050),         # Berlin
+        (50.4501, 30.5234),         # Kyiv
+        (-33.8688, 151.2093),       # Sydney
+        (64.1466, -21.9426),        # Reykjavik
+        (-16.5000, 179.9999)])      # Fiji, crosses the antimeridian
+def test_get_bearing_list_equals_bearing_between_two_points(lat, lon):
+    coordinates = create_footpath(random.Random(lat), lat, lon, 2000)
+    assert list(geometry.get_bearing_list(coordinates)) \
+            == get_bearing_list_point_by_point(coordinates)
+
+
+@pytest.mark.parametrize("coordinates", [
+        # antimeridian in both directions
+        [179.9999, -16.5, -179.9999, -16.5, 179.9998, -16.5001],
+        [-180.0, 10.0, 180.0, 10.0, -179.5, 10.5],
+        # equal points, also between two different ones
+        [13.405, 52.52, 13.405, 52.52],
+        [13.405, 52.52, 13.405, 52.52, 13.406, 52.52, 13.406, 52.52, 13.406, 52.521],
+        # due north, east, south and west
+        [13.0, 52.0, 13.0, 52.001, 13.001, 52.001, 13.001, 52.0, 13.0, 52.0],
+        # close to the poles
+        [0.0, 89.9999, 90.0, 89.9999, -120.0, -89.9999]])
+def test_get_bearing_list_edge_cases(coordinates):
+    coordinates = array('d', coordinates)
+    assert list(geometry.get_bearing_list(coordinates)) \
+            == get_bearing_list_point_by_point(coordinates)
+
+
+def test_get_bearing_list_of_less_than_two_points():
+    assert list(geometry.get_bearing_list(array('d'))) == []
+    assert list(geometry.get_bearing_list(array('d', [13.405, 52.52]))) == []
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Golden test of PedestrianRoute.RouteBuilder: the route of the column-wise
+builder must equal the one of the former add_point_to_route implementation,
+which is kept below as reference.
+"""
+
+import copy, json, math, random
+
+import pytest
+
+from webserver import geometry
+from webserver.pedestrian_route import PedestrianRoute
+
+
+class Translator:
+    def translate(self, section, key):
+        return key
+
+
+def create_pedestrian_route(way_class_by_osm_id):
+    pedestrian_route = object.__new__(PedestrianRoute)
+    pedestrian_route.translator = Translator()
+    # all way classes are known, so important_intersection doesn't query the database
+    pedestrian_route.way_class_by_osm_id = dict(way_class_by_osm_id)
+    pedestrian_route.important_intersection_cache = {}
+    return pedestrian_route
+
+
+#####
+# reference implementation
+#####
+
+def add_point_to_route(pedestrian_route, route, next_point, next_segment, add_all_intersections=False):
+    # calculate distance and bearing of new segment
+    try:
+        next_segment = geometry.add_bearing_and_distance_to_segment(
+                next_segment,
+                route[-1]['lat'], route[-1]['lon'],
+                next_point['lat'], next_point['lon'])
+        if next_segment['distance'] == 0 and next_point['type'] == "intersection":
+            # replace last point
+            route[-1] = next_point
+            return route
+    except IndexError as e:
+        # if the route is still empty, add the next route point and exit
+        route.append(next_point)
+        return route
+    # try to find and delete unimportant intersections and way points
+    try:
+        turn = geometry.turn_between_two_segments(
+                next_segment['bearing'], route[-2]['bearing'])
+        if (not add_all_intersections \
+                    or (add_all_intersections and route[-1]['type'] != "intersection")) \
+                and (turn <= 22 or turn >= 338) \
+                and route[-2]['name'] == next_segment['name'] \
+                and route[-2]['sub_type'] == next_segment['sub_type'] \
+                and not pedestrian_route.important_intersection(route[-1], route[-2]):
+            # delete unimportant waypoint or intersection
+            del route[-2:]
+    except IndexError as e:
+        pass
+    # find and delete zigzag
+    try:
+        turn = geometry.turn_between_two_segments(
+                next_segment['bearing'], route[-4]['bearing'])
+        if not add_all_intersections \
+                and (turn <= 22 or turn >= 338) \
+                and route[-2]['distance'] < 4 \
+                and not pedestrian_route.important_intersection(route[-1], route[-2]) \
+                and not pedestrian_route.important_intersection(route[-3], route[-4]):
+            del route[-4:]
+    except IndexError as e:
+        pass
+    # delete double train intersection but leave first of two intersections
+    try:
+        turn = geometry.turn_between_two_segments(
+                next_segment['bearing'], route[-4]['bearing'])
+        if not add_all_intersections \
+                and (turn <= 22 or turn >= 338) \
+                and route[-2]['distance'] < 5 \
+                and ("tram" in route[-1]['name'] or "rail" in route[-1]['name']) \
+                and ("tram" in route[-3]['name'] or "rail" in route[-3]['name']):
+            del route[-2:]
+    except IndexError as e:
+        pass
+    # calculate the updated distance and bearing to the potentially new prev point
+    next_segment = geometry.add_bearing_and_distance_to_segment(
+            next_segment,
+            route[-1]['lat'], route[-1]['lon'],
+            next_point['lat'], next_point['lon'])
+    next_segment['type'] = "footway_route"
+    # update turn value
+    try:
+        if "turn" not in route[-1]:
+            route[-1]['turn'] = geometry.turn_between_two_segments(
+                    next_segment['bearing'], route[-2]['bearing'])
+    except IndexError as e:
+        pass
+    # append new segment and point
+    route.append(next_segment)
+    route.append(next_point)
+    return route
+
+
+def mark_route_ways_of_intersections(route):
+    for i in range(0, len(route), 2):
+        if route[i].get("type") == "intersection":
+            intersection = route[i]
+            minimal_bearing_difference_previous = 180
+            index_of_previous = -1
+            bearing_of_previous_route_segment = None
+            if (i-1) > 0 \
+                    and route[i-1].get("bearing"):
+                bearing_of_previous_route_segment = route[i-1].get("bearing")
+            minimal_bearing_difference_next = 180
+            index_of_next = -1
+            bearing_of_next_route_segment = None
+            if (i+1) < len(route) \
+                    and route[i+1].get("bearing"):
+                bearing_of_next_route_segment = route[i+1].get("bearing")
+            for index, intersection_segment in enumerate(intersection.get("way_list")):
+                if bearing_of_previous_route_segment:
+                    bearing_difference_previous = geometry.bearing_difference_between_two_segments(
+                            (bearing_of_previous_route_segment + 180) % 360,
+                            intersection_segment.get("bearing"))
+                    if bearing_difference_previous < minimal_bearing_difference_previous:
+                        minimal_bearing_difference_previous = bearing_difference_previous
+                        index_of_previous = index
+                if bearing_of_next_route_segment:
+                    bearing_difference_next = geometry.bearing_difference_between_two_segments(
+                            bearing_of_next_route_segment,
+                            intersection_segment.get("bearing"))
+                    if bearing_difference_next < minimal_bearing_difference_next:
+                        minimal_bearing_difference_next = bearing_difference_next
+                        index_of_next = index
+            if index_of_previous > -1:
+                intersection['way_list'][index_of_previous]['part_of_previous_route_segment'] = True
+            if index_of_next > -1:
+                intersection['way_list'][index_of_next]['part_of_next_route_segment'] = True
+
+
+def build_reference_route(pedestrian_route, start_point, part_list, add_all_intersections):
+    route = add_point_to_route(pedestrian_route, [], start_point, None)
+    for segment, point_list in part_list:
+        for point in point_list:
+            route = add_point_to_route(
+                    pedestrian_route, route, point, segment.copy(), add_all_intersections)
+    # the first segment, see calculate_route_section
+    first_point = route[0]
+    new_start_point = {"type":"point", "name":"start",
+            "lat":first_point['lat'] - 0.0002, "lon":first_point['lon'] - 0.0002}
+    bearing_start_p0 = geometry.bearing_between_two_points(
+            new_start_point['lat'], new_start_point['lon'], first_point['lat'], first_point['lon'])
+    first_point['turn'] = geometry.turn_between_two_segments(route[1]['bearing'], bearing_start_p0)
+    first_segment = geometry.add_bearing_and_distance_to_segment(
+            {"name":"first_segment", "type":"footway", "sub_type":"", "way_id":-1, "pois":[]},
+            new_start_point['lat'], new_start_point['lon'], first_point['lat'], first_point['lon'])
+    first_segment['type'] = "footway_route"
+    route.insert(0, first_segment)
+    route.insert(0, new_start_point)
+    mark_route_ways_of_intersections(route)
+    return route
+
+
+def build_route(pedestrian_route, start_point, part_list, add_all_intersections):
+    route = PedestrianRoute.RouteBuilder(pedestrian_route, add_all_intersections)
+    route.add_point(start_point, None)
+    for segment, point_list in part_list:
+        for point in point_list:
+            route.add_point(point, segment)
+    first_point = route.point_list[0]
+    route.insert_first_point(
+            {"type":"point", "name":"start",
+                "lat":first_point['lat'] - 0.0002, "lon":first_point['lon'] - 0.0002},
+            {"name":"first_segment", "type":"footway", "sub_type":"", "way_id":-1, "pois":[]})
+    return route.to_list()
+
+
+#####
+# fixed route sections
+#####
+
+def create_route_section(seed):
+    """
+    Random walk of edge parts with intersections, way points, railway crossings,
+    duplicate intersections, short zigzags and repeated way names. Returns the
+    start point, the parts as list of (segment, point list) and the way classes.
+    """
+    generator = random.Random(seed)
+    way_class_by_osm_id = {}
+    lat, lon = 52.5, 13.4
+    bearing = generator.uniform(0, 360)
+    start_point = {"type":"point", "name":"p0", "lat":lat, "lon":lon}
+    part_list = []
+    for part_index in range(60):
+        osm_id = generator.randrange(1, 12)
+        way_class_by_osm_id[osm_id] = generator.choice([1, 2, 3, 4, 5, 6, 7, None])
+        segment = {"name":"way {}".format(osm_id % 4), "type":"footway",
+                "sub_type":generator.choice(["footway", "residential"]),
+                "way_id":osm_id, "way_class":way_class_by_osm_id[osm_id], "pois":[]}
+        point_list = []
+        for point_index in range(generator.randint(1, 4)):
+            # mostly straight on, sometimes a turn or a short zigzag
+            bearing += generator.choice([0, 0, 5, -5, 15, -15, 40, -40, 90, -90, 160, 180])
+            distance = generator.choice([1, 2, 3, 4.5, 8, 20, 60, 150])
+            lat += distance * math.cos(math.radians(bearing)) / 111000
+            lon += distance * math.sin(math.radians(bearing)) / 68000
+            point_list.append(
+                    {"type":"point", "name":"p{}_{}".format(part_index, point_index),
+                        "lat":lat, "lon":lon})
+        # the part ends at an intersection
+        way_list = []
+        for way_index in range(generator.randint(2, 4)):
+            way_id = generator.randrange(1, 12)
+            way_class_by_osm_id.setdefault(way_id, generator.choice([1, 2, 3, 4, 5, 6, 7, None]))
+            way_list.append(
+                    {"way_id":way_id, "name":"way {}".format(way_id % 4),
+                        "bearing":generator.randrange(0, 360)})
+        intersection = {"type":"intersection",
+                "name":generator.choice(["crossing", "tram stop", "rail crossing", "corner"]),
+                "lat":lat, "lon":lon, "node_id":part_index, "way_list":way_list}
+        point_list[-1] = intersection
+        if generator.random() < 0.1:
+            # the same intersection again, which replaces the last point
+            point_list.append(copy.deepcopy(intersection))
+        part_list.append((segment, point_list))
+    return start_point, part_list, way_class_by_osm_id
+
+
+@pytest.mark.parametrize("add_all_intersections", [False, True])
+@pytest.mark.parametrize("seed", range(50))
+def test_route_builder_equals_reference(seed, add_all_intersections):
+    start_point, part_list, way_class_by_osm_id = create_route_section(seed)
+    reference_route = build_reference_route(
+            create_pedestrian_route(way_class_by_osm_id),
+            copy.deepcopy(start_point), copy.deepcopy(part_list), add_all_intersections)
+    route = build_route(
+            create_pedestrian_route(way_class_by_osm_id),
+            copy.deepcopy(start_point), copy.deepcopy(part_list), add_all_intersections)
+    assert json.dumps(route, sort_keys=True) == json.dumps(reference_route, sort_keys=True)
@@ -90,6 +90,14 @@ class Config:
                     self.paths.get("shell_folder"), "sql")
             if not os.path.exists(self.paths.get("sql_files_folder")):
                 exit("SQL functions folder not found.")
+            # contraction hierarchies of the maps
+            self.paths['contraction_hierarchy_folder'] = os.path.join(
+                    self.paths.get("project_root"), "contraction_hierarchies")
+            if not os.path.exists(self.paths.get("contraction_hierarchy_folder")):
+                try:
+                    os.makedirs(self.paths.get("contraction_hierarchy_folder"), exist_ok=True)
+                except OSError as e:
+                    exit("Could not create folder {}".format(self.paths.get("contraction_hierarchy_folder")))
             # temp subfolder
             self.paths['temp_folder'] = os.path.join(
                     self.paths.get("shell_folder"), "tmp")
@@ -163,6 +171,74 @@ class Config:
             self.database['password'] = self.config["database"].get("password", "")
             if not self.database.get("password"):
                 exit('Database: Missing password.')
+            # connection pool size per map
+            try:
+                self.database['pool_min_connections'] = int(
+                        self.config["database"].get("pool_min_connections", 1))
+                self.database['pool_max_connections'] = int(
+                        self.config["database"].get("pool_max_connections", 20))
+            except ValueError:
+                exit('Database: Malformed pool_min_connections or pool_max_connections.')
+            else:
+                if self.database.get("pool_min_connections") < 0 \
+                        or self.database.get("pool_max_connections") < 1 \
+                        or self.database.get("pool_min_connections") > self.database.get("pool_max_connections"):
+                    exit('Database: Invalid pool_min_connections or pool_max_connections.')
+            # max time in seconds to wait for a free connection of an exhausted pool
+            try:
+                self.database['pool_acquire_timeout'] = float(
+                        self.config["database"].get("pool_acquire_timeout", 5))
+            except ValueError:
+                exit('Database: Malformed pool_acquire_timeout.')
+            else:
+                if self.database.get("pool_acquire_timeout") < 0:
+                    exit('Database: Invalid pool_acquire_timeout.')
+            # queries, which take longer than this number of milliseconds, are logged with their
+            # query plan, 0 disables the slow query log
+            try:
+                self.database['slow_query_threshold'] = int(
+                        self.config["database"].get("slow_query_threshold", 1000))
+            except ValueError:
+                exit('Database: Malformed slow_query_threshold.')
+            else:
+                if self.database.get("slow_query_threshold") < 0:
+                    exit('Database: Invalid slow_query_threshold.')
+            # read replicas per map: map_id = host[:port], host[:port], ...
+            self.database['read_replicas'] = {}
+            for map_id, replica_list in self.config["database"].get("read_replicas", {}).items():
+                if isinstance(replica_list, str):
+                    replica_list = [replica_list]
+                self.database['read_replicas'][map_id] = []
+                for replica in replica_list:
+                    host_name, _, port = replica.strip().partition(":")
+                    try:
+                        port = int(port) if port else self.database.get("port")
+                    except ValueError:
+                        exit('Database: Malformed port of read replica %s.' % replica)
+                    if not host_name \
+                            or port <= 0 \
+                            or port >= 65536:
+                        exit('Database: Invalid read replica %s.' % replica)
+                    self.database['read_replicas'][map_id].append(
+                            {"host_name":host_name, "port":port})
+            # seconds until a failed read replica is tried again
+            try:
+                self.database['replica_retry_interval'] = float(
+                        self.config["database"].get("replica_retry_interval", 30))
+            except ValueError:
+                exit('Database: Malformed replica_retry_interval.')
+            else:
+                if self.database.get("replica_retry_interval") < 0:
+                    exit('Database: Invalid replica_retry_interval.')
+            # seconds until a map database, which failed to load, is tried again
+            try:
+                self.database['map_retry_interval'] = float(
+                        self.config["database"].get("map_retry_interval", 30))
+            except ValueError:
+                exit('Database: Malformed map_retry_interval.')
+            else:
+                if self.database.get("map_retry_interval") < 0:
+                    exit('Database: Invalid map_retry_interval.')
             # self-created database names
             self.database['intersection_table'] = "intersections"
             self.database['intersection_data_table'] = "intersection_data"
@@ -196,6 +272,46 @@ class Config:
             else:
                 if self.webserver.get("thread_pool") == 0:
                     self.webserver['thread_pool'] = 10
+            # request timeouts in seconds per endpoint, a client may only shorten them
+            self.webserver['request_timeouts'] = {}
+            for endpoint, default_timeout in [
+                    ("get_route", 120), ("get_next_intersections_for_way", 30),
+                    ("get_poi", 30), ("get_hiking_trails", 30)]:
+                try:
+                    timeout = float(
+                            self.config["webserver"].get("%s_timeout" % endpoint, default_timeout))
+                except ValueError:
+                    exit('webserver: Malformed %s_timeout.' % endpoint)
+                else:
+                    if timeout <= 0:
+                        exit('webserver: %s_timeout must be greater than 0.' % endpoint)
+                    self.webserver['request_timeouts'][endpoint] = timeout
+            # threads, which calculate the route sections between via points of all requests
+            try:
+                self.webserver['route_section_workers'] = int(
+                        self.config["webserver"].get("route_section_workers", 8))
+            except ValueError:
+                exit('webserver: Malformed route_section_workers.')
+            else:
+                if self.webserver.get("route_section_workers") <= 0:
+                    exit('webserver: route_section_workers must be greater than 0.')
+            # route cache: memory cap in mb (0 disables the cache) and time to live in seconds
+            try:
+                self.webserver['route_cache_size_in_mb'] = float(
+                        self.config["webserver"].get("route_cache_size_in_mb", 50))
+            except ValueError:
+                exit('webserver: Malformed route_cache_size_in_mb.')
+            else:
+                if self.webserver.get("route_cache_size_in_mb") < 0:
+                    exit('webserver: route_cache_size_in_mb must not be negative.')
+            try:
+                self.webserver['route_cache_ttl'] = float(
+                        self.config["webserver"].get("route_cache_ttl", 3600))
+            except ValueError:
+                exit('webserver: Malformed route_cache_ttl.')
+            else:
+                if self.webserver.get("route_cache_ttl") <= 0:
+                    exit('webserver: route_cache_ttl must be greater than 0.')
 
             # java settings
             if "java" not in self.config:
@@ -388,6 +504,22 @@ class Config:
                     exit('map %s: url list is empty.' % map_id)
                 map_data['urls'] = url_list
 
+                # routing engine
+                routing_engine = map_data.get("routing_engine", constants.supported_routing_engine_list[0])
+                if routing_engine not in constants.supported_routing_engine_list:
+                    exit('map %s: Invalid routing_engine %s. Supported: %s' \
+                            % (map_id, routing_engine, ', '.join(constants.supported_routing_engine_list)))
+                map_data['routing_engine'] = routing_engine
+                # routing algorithm
+                routing_algorithm = map_data.get("routing_algorithm", constants.supported_routing_algorithm_list[0])
+                if routing_algorithm not in constants.supported_routing_algorithm_list:
+                    exit('map %s: Invalid routing_algorithm %s. Supported: %s' \
+                            % (map_id, routing_algorithm, ', '.join(constants.supported_routing_algorithm_list)))
+                if routing_algorithm == "contraction_hierarchy" and routing_engine != "graph":
+                    exit('map %s: The routing_algorithm contraction_hierarchy requires the graph routing_engine' \
+                            % map_id)
+                map_data['routing_algorithm'] = routing_algorithm
+
                 # add to maps dict
                 self.maps[map_id] = map_data
 
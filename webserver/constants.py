@@ -7,6 +7,22 @@ supported_feedback_token_list = ["question", "map_request", "pt_provider_request
 max_distance_between_start_and_destination_in_meters = 30000
 supported_route_point_object_list = ["point", "entrance", "gps", "intersection", "pedestrian_crossing", "poi", "station", "street_address"]
 supported_way_class_list = ["big_streets", "small_streets", "paved_ways", "unpaved_ways", "unclassified_ways", "steps"]
+# larger way class weights are clamped, they and the penalty for ignored ways must stay finite sql literals
+max_way_class_weight = 1000.0
+# seconds between two checks for a rebuilt map database, see MapDatabase.check_map_created_if_due
+map_created_check_interval = 60
+# create-map-database skips the contraction hierarchy of larger routing graphs, its creation keeps
+# a python set per vertex, use the create-contraction-hierarchy action for them instead
+max_contraction_hierarchy_vertices = 2000000
+# pgrouting: pgr_dijkstra over the permanent routing table, restricted by a boundary box
+# temp_table: legacy mode with a temporary routing table per route section
+# graph: in-process search on the routing graph, which is loaded into memory at start
+supported_routing_engine_list = ["pgrouting", "temp_table", "graph"]
+# dijkstra: plain dijkstra
+# astar: goal-directed search with the great circle distance as lower bound
+# bidirectional: dijkstra from both start and destination
+# contraction_hierarchy: precomputed at map creation, only available for the graph routing engine
+supported_routing_algorithm_list = ["dijkstra", "astar", "bidirectional", "contraction_hierarchy"]
 # poi constants
 supported_poi_category_listp = [
         "transport_bus_tram", "transport_train_lightrail_subway",
@@ -29,6 +45,7 @@ class ReturnCode:
     # walkersguide specific errors
     # misc
     CANCELLED_BY_CLIENT = 550
+    DEADLINE_EXCEEDED = 551
     # map
     MAP_LOADING_FAILED = 555
     WRONG_MAP_SELECTED = 556
@@ -0,0 +1,422 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import bisect, collections, heapq, json, logging, math, os, threading, time
+from array import array
+
+
+class ContractionHierarchy():
+    """
+    Customizable contraction hierarchy of a routing graph
+
+    The contraction order and the shortcut topology don't depend on the edge
+    costs, so they are computed once after the map creation and stored on disk.
+    A request with different way class weights only needs a new customization,
+    which assigns a cost to every arc. Customized metrics are cached per weight
+    list. The customization takes some seconds on large maps, so it runs in the
+    background and the request, which triggered it, has to use another search.
+
+    Vertices are addressed by their rank in the contraction order. The upward
+    arcs of rank r lead to arc_head[arc_offset[r]:arc_offset[r+1]], sorted by
+    rank. Every arc is either an original edge or a shortcut over a lower
+    ranked vertex.
+    """
+    file_format_version = 1
+    # cells with at most this number of vertices are not dissected further
+    max_cell_size = 32
+    # number of cached customized metrics per map, each needs 32 bytes per arc
+    max_number_of_metrics = 4
+
+
+    #####
+    # creation and storage
+    #####
+
+    @staticmethod
+    def create(routing_graph):
+        start = time.time()
+        order = ContractionHierarchy.compute_nested_dissection_order(routing_graph)
+        number_of_vertices = routing_graph.number_of_vertices
+        rank_by_vertex = array('q', bytes(array('q').itemsize * number_of_vertices))
+        for rank, vertex in enumerate(order):
+            rank_by_vertex[vertex] = rank
+
+        # chordal completion: contracting a vertex connects all its upward neighbours,
+        # which is done by merging them into the lowest ranked one
+        upward_neighbours = [ set() for rank in range(number_of_vertices) ]
+        for edge_index in range(routing_graph.number_of_edges):
+            source_rank = rank_by_vertex[routing_graph.edge_source[edge_index]]
+            target_rank = rank_by_vertex[routing_graph.edge_target[edge_index]]
+            if source_rank < target_rank:
+                upward_neighbours[source_rank].add(target_rank)
+            elif target_rank < source_rank:
+                upward_neighbours[target_rank].add(source_rank)
+        arc_offset = array('q', [0])
+        arc_head = array('q')
+        for rank in range(number_of_vertices):
+            head_list = sorted(upward_neighbours[rank])
+            if head_list:
+                upward_neighbours[head_list[0]].update(head_list[1:])
+            arc_head.extend(head_list)
+            arc_offset.append(len(arc_head))
+            upward_neighbours[rank] = None
+
+        contraction_hierarchy = ContractionHierarchy(
+                routing_graph, routing_graph.map_created,
+                array('q', [ routing_graph.vertex_id[vertex] for vertex in order ]),
+                arc_offset, arc_head)
+        logging.info(
+                "Contraction hierarchy of map {}: {} arcs in {} seconds".format(
+                    routing_graph.map_id, len(arc_head), int(time.time() - start)))
+        return contraction_hierarchy
+
+    @staticmethod
+    def compute_nested_dissection_order(routing_graph):
+        """
+        Metric independent contraction order by geometric nested dissection
+
+        A cell is split at the median of the vertex positions along four
+        directions. The vertices of the smaller half, which have a neighbour
+        in the other half, form the separator of the best direction. Separators
+        are contracted after both halves, so they get the highest ranks of the
+        cell. Returns the vertex indices, ordered by rank.
+        """
+        vertex_lat = routing_graph.vertex_lat
+        vertex_lon = routing_graph.vertex_lon
+        adjacency_offset = routing_graph.adjacency_offset
+        adjacency_vertex = routing_graph.adjacency_vertex
+        cos_lat = math.cos(math.radians(
+            (min(vertex_lat) + max(vertex_lat)) / 2)) if vertex_lat else 1.0
+        direction_list = [
+                lambda vertex: vertex_lon[vertex] * cos_lat,
+                lambda vertex: vertex_lat[vertex],
+                lambda vertex: vertex_lon[vertex] * cos_lat + vertex_lat[vertex],
+                lambda vertex: vertex_lon[vertex] * cos_lat - vertex_lat[vertex]]
+        # side of every vertex within the current cell, -1 = outside
+        side = array('b', [-1]) * routing_graph.number_of_vertices
+
+        def get_boundary(vertex_list, own_side):
+            return [ vertex for vertex in vertex_list \
+                     if any(side[adjacency_vertex[position]] == 1 - own_side \
+                         for position in range(adjacency_offset[vertex], adjacency_offset[vertex+1])) ]
+
+        # ranks are assigned from the top, a cell takes the highest free ranks
+        order = array('q', bytes(array('q').itemsize * routing_graph.number_of_vertices))
+        next_rank = routing_graph.number_of_vertices - 1
+        cell_stack = [ list(range(routing_graph.number_of_vertices)) ]
+        while cell_stack:
+            cell = cell_stack.pop()
+            if len(cell) <= ContractionHierarchy.max_cell_size:
+                # high degree last
+                cell.sort(
+                        key=lambda vertex: adjacency_offset[vertex+1] - adjacency_offset[vertex],
+                        reverse=True)
+                for vertex in cell:
+                    order[next_rank] = vertex
+                    next_rank -= 1
+                continue
+            best = None
+            for direction in direction_list:
+                cell.sort(key=direction)
+                middle = len(cell) // 2
+                for vertex in cell[:middle]:
+                    side[vertex] = 0
+                for vertex in cell[middle:]:
+                    side[vertex] = 1
+                separator = min(
+                        get_boundary(cell[:middle], 0), get_boundary(cell[middle:], 1), key=len)
+                if best is None or len(separator) < len(best[0]):
+                    best = (separator, cell[:middle], cell[middle:])
+            for vertex in cell:
+                side[vertex] = -1
+            separator, first_half, second_half = best
+            for vertex in separator:
+                order[next_rank] = vertex
+                next_rank -= 1
+            separator_set = set(separator)
+            cell_stack.append([ vertex for vertex in first_half if vertex not in separator_set ])
+            cell_stack.append([ vertex for vertex in second_half if vertex not in separator_set ])
+        return order
+
+    def save(self, file_name):
+        header = {
+                "file_format_version"  : ContractionHierarchy.file_format_version,
+                "map_created"          : self.map_created,
+                "number_of_vertices"   : len(self.vertex_id_by_rank),
+                "number_of_arcs"       : len(self.arc_head) }
+        # write into a temp file first, the webserver may read the old one
+        with open(file_name + ".tmp", "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            for values in [self.vertex_id_by_rank, self.arc_offset, self.arc_head]:
+                values.tofile(f)
+        os.replace(file_name + ".tmp", file_name)
+
+    @staticmethod
+    def load(routing_graph, file_name):
+        """ returns the contraction hierarchy or None, if the file is missing or outdated """
+        if not os.path.exists(file_name):
+            return None
+        start = time.time()
+        with open(file_name, "rb") as f:
+            header = json.loads(f.readline().decode("utf-8"))
+            if header.get("file_format_version") != ContractionHierarchy.file_format_version \
+                    or header.get("map_created") != routing_graph.map_created \
+                    or header.get("number_of_vertices") != routing_graph.number_of_vertices:
+                logging.warning(
+                        "Contraction hierarchy {} doesn't match the routing graph".format(file_name))
+                return None
+            arrays = []
+            for length in [
+                    header.get("number_of_vertices"), header.get("number_of_vertices") + 1,
+                    header.get("number_of_arcs")]:
+                values = array('q')
+                values.fromfile(f, length)
+                arrays.append(values)
+        contraction_hierarchy = ContractionHierarchy(routing_graph, header.get("map_created"), *arrays)
+        logging.info(
+                "Contraction hierarchy of map {} loaded in {} seconds".format(
+                    routing_graph.map_id, int(time.time() - start)))
+        return contraction_hierarchy
+
+
+    #####
+    # customization
+    #####
+
+    def __init__(self, routing_graph, map_created, vertex_id_by_rank, arc_offset, arc_head):
+        self.routing_graph = routing_graph
+        self.map_created = map_created
+        self.vertex_id_by_rank = vertex_id_by_rank
+        self.arc_offset = arc_offset
+        self.arc_head = arc_head
+        # rank <-> vertex index of the routing graph
+        self.vertex_by_rank = array('q')
+        self.rank_by_vertex = array('q', bytes(array('q').itemsize * routing_graph.number_of_vertices))
+        for rank, vertex_id in enumerate(vertex_id_by_rank):
+            vertex = routing_graph.vertex_index_by_id[vertex_id]
+            self.vertex_by_rank.append(vertex)
+            self.rank_by_vertex[vertex] = rank
+        self.arc_tail = array('q')
+        for rank in range(len(vertex_id_by_rank)):
+            self.arc_tail.extend([rank] * (arc_offset[rank+1] - arc_offset[rank]))
+        # the arc of every original edge, -1 for loops
+        self.edge_arc = array('q')
+        for edge_index in range(routing_graph.number_of_edges):
+            source_rank = self.rank_by_vertex[routing_graph.edge_source[edge_index]]
+            target_rank = self.rank_by_vertex[routing_graph.edge_target[edge_index]]
+            if source_rank == target_rank:
+                self.edge_arc.append(-1)
+                continue
+            lower_rank, upper_rank = min(source_rank, target_rank), max(source_rank, target_rank)
+            self.edge_arc.append(
+                    bisect.bisect_left(
+                        arc_head, upper_rank, arc_offset[lower_rank], arc_offset[lower_rank+1]))
+        # (weight list, penalty) -> customized metric
+        self.metrics = collections.OrderedDict()
+        self.metrics_in_progress = set()
+        self.metrics_lock = threading.Lock()
+
+    def get_metric(self, weight_list, penalty=None, wait=True):
+        """
+        Customized metric for the weight list. If it's not cached and wait is
+        False, the customization is started in a background thread and None is
+        returned.
+        """
+        key = (tuple(weight_list), penalty)
+        with self.metrics_lock:
+            metric = self.metrics.get(key)
+            if metric:
+                self.metrics.move_to_end(key)
+                return metric
+            if not wait:
+                if key not in self.metrics_in_progress:
+                    self.metrics_in_progress.add(key)
+                    threading.Thread(
+                            target=self.add_metric_in_background, args=(key,), daemon=True).start()
+                return None
+        return self.add_metric(key)
+
+    def add_metric(self, key):
+        try:
+            metric = self.customize(list(key[0]), key[1])
+            with self.metrics_lock:
+                self.metrics[key] = metric
+                if len(self.metrics) > ContractionHierarchy.max_number_of_metrics:
+                    self.metrics.popitem(last=False)
+            return metric
+        finally:
+            # a failed customization is retried by the next request
+            with self.metrics_lock:
+                self.metrics_in_progress.discard(key)
+
+    def add_metric_in_background(self, key):
+        try:
+            self.add_metric(key)
+        except Exception as e:
+            logging.exception(
+                    "Customization of the contraction hierarchy of map {} failed: {}".format(
+                        self.routing_graph.map_id, e))
+
+    def customize(self, weight_list, penalty=None):
+        """
+        Arc costs for the given way class weights, see RoutingGraph.create_weight_list.
+        Impassable edges cost their length plus the penalty or are left out.
+        """
+        start = time.time()
+        routing_graph = self.routing_graph
+        number_of_arcs = len(self.arc_head)
+        metric = ContractionHierarchy.Metric(number_of_arcs)
+        arc_cost = metric.arc_cost
+        arc_edge = metric.arc_edge
+        arc_first_half = metric.arc_first_half
+        arc_second_half = metric.arc_second_half
+        # original edges
+        edge_arc = self.edge_arc
+        edge_km = routing_graph.edge_km
+        edge_way_class = routing_graph.edge_way_class
+        for edge_index in range(routing_graph.number_of_edges):
+            arc = edge_arc[edge_index]
+            if arc < 0:
+                continue
+            weight = weight_list[edge_way_class[edge_index]]
+            if weight is None:
+                if penalty is None:
+                    continue
+                cost = edge_km[edge_index] + penalty
+            else:
+                cost = edge_km[edge_index] * weight
+            if cost < arc_cost[arc]:
+                arc_cost[arc] = cost
+                arc_edge[arc] = edge_index
+        # shortcuts, bottom up over the lower triangles: the arcs r->x and r->y
+        # of rank r, x < y, form a path between x and y over r
+        arc_offset = self.arc_offset
+        arc_head = self.arc_head
+        bisect_left = bisect.bisect_left
+        for rank in range(len(arc_offset) - 1):
+            last_arc = arc_offset[rank+1]
+            for lower_arc in range(arc_offset[rank], last_arc):
+                lower_cost = arc_cost[lower_arc]
+                if lower_cost == math.inf:
+                    continue
+                lower_head = arc_head[lower_arc]
+                # both lists are sorted, so the search continues at the last found shortcut
+                shortcut = arc_offset[lower_head]
+                for upper_arc in range(lower_arc + 1, last_arc):
+                    shortcut = bisect_left(
+                            arc_head, arc_head[upper_arc], shortcut, arc_offset[lower_head+1])
+                    cost = lower_cost + arc_cost[upper_arc]
+                    if cost < arc_cost[shortcut]:
+                        arc_cost[shortcut] = cost
+                        arc_edge[shortcut] = -1
+                        arc_first_half[shortcut] = lower_arc
+                        arc_second_half[shortcut] = upper_arc
+        logging.info(
+                "Contraction hierarchy of map {} customized in {:.2f} seconds".format(
+                    routing_graph.map_id, time.time() - start))
+        return metric
+
+
+    #####
+    # query
+    #####
+
+    def search(self, metric, start_cost_by_index, dest_cost_by_index):
+        """
+        Bidirectional upward search (vertex indices of the routing graph), see
+        get_metric. Returns the start vertex, the edge index list and the number
+        of settled vertices like RoutingGraph.search or None.
+        """
+        arc_cost = metric.arc_cost
+        arc_offset = self.arc_offset
+        arc_head = self.arc_head
+        rank_by_vertex = self.rank_by_vertex
+
+        # index 0: forward, 1: backward
+        cost = (
+                { rank_by_vertex[vertex]: vertex_cost for vertex, vertex_cost in start_cost_by_index.items() },
+                { rank_by_vertex[vertex]: vertex_cost for vertex, vertex_cost in dest_cost_by_index.items() })
+        predecessor_arc = ({}, {})
+        settled = (set(), set())
+        heap = (
+                [ (rank_cost, rank) for rank, rank_cost in cost[0].items() ],
+                [ (rank_cost, rank) for rank, rank_cost in cost[1].items() ])
+        heapq.heapify(heap[0])
+        heapq.heapify(heap[1])
+        best_cost = math.inf
+        meeting_rank = None
+
+        while True:
+            # continue with the direction, which has the smaller open cost below the best one
+            open_cost = [ heap[direction][0][0] if heap[direction] else math.inf for direction in (0, 1) ]
+            direction = 0 if open_cost[0] <= open_cost[1] else 1
+            if open_cost[direction] >= best_cost:
+                break
+            rank_cost, rank = heapq.heappop(heap[direction])
+            if rank in settled[direction]:
+                continue
+            settled[direction].add(rank)
+            own_cost, other_cost = cost[direction], cost[1-direction]
+            if rank in other_cost and rank_cost + other_cost[rank] < best_cost:
+                best_cost = rank_cost + other_cost[rank]
+                meeting_rank = rank
+            for arc in range(arc_offset[rank], arc_offset[rank+1]):
+                head_cost = rank_cost + arc_cost[arc]
+                head = arc_head[arc]
+                if head_cost < own_cost.get(head, math.inf):
+                    own_cost[head] = head_cost
+                    predecessor_arc[direction][head] = arc
+                    heapq.heappush(heap[direction], (head_cost, head))
+
+        if meeting_rank is None:
+            return None
+        # arcs from the start up to the meeting vertex and down to the destination
+        # the bool tells, whether the arc is used from its head to its tail
+        arc_list = []
+        rank = meeting_rank
+        while rank in predecessor_arc[0]:
+            arc = predecessor_arc[0][rank]
+            arc_list.append((arc, False))
+            rank = self.arc_tail[arc]
+        start_rank = rank
+        arc_list.reverse()
+        rank = meeting_rank
+        while rank in predecessor_arc[1]:
+            arc = predecessor_arc[1][rank]
+            arc_list.append((arc, True))
+            rank = self.arc_tail[arc]
+        return (
+                self.vertex_by_rank[start_rank],
+                self.unpack(metric, arc_list),
+                len(settled[0]) + len(settled[1]))
+
+    def unpack(self, metric, arc_list):
+        """
+        Replaces the shortcuts by original edges. A shortcut x->y over the lower
+        vertex r consists of the arc r->x backwards and the arc r->y.
+        """
+        edge_list = []
+        stack = arc_list[::-1]
+        while stack:
+            arc, backwards = stack.pop()
+            edge_index = metric.arc_edge[arc]
+            if edge_index >= 0:
+                edge_list.append(edge_index)
+            elif backwards:
+                stack.append((metric.arc_first_half[arc], False))
+                stack.append((metric.arc_second_half[arc], True))
+            else:
+                stack.append((metric.arc_second_half[arc], False))
+                stack.append((metric.arc_first_half[arc], True))
+        return edge_list
+
+
+    class Metric:
+        """ customized arc costs and how to unpack the shortcuts """
+
+        def __init__(self, number_of_arcs):
+            self.arc_cost = array('d', [math.inf]) * number_of_arcs
+            # original edge index or -1 for a shortcut over the two half arcs
+            self.arc_edge = array('q', [-1]) * number_of_arcs
+            self.arc_first_half = array('q', [-1]) * number_of_arcs
+            self.arc_second_half = array('q', [-1]) * number_of_arcs
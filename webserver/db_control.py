@@ -3,33 +3,341 @@
 
 # python sql tutorial: http://initd.org/psycopg/docs/sql.html
 
+import itertools
 import logging
+import threading
+import time
 
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 from psycopg2 import pool, sql
 
 from . import constants
 from .constants import ReturnCode
 from .config import Config
-from .helper import WebserverException
+from .helper import Histogram, WebserverException
 
 
-class DBControl():
+class PooledConnection(psycopg2.extensions.connection):
+    """ database connection, which remembers its creation time and prepared statements """
 
-    def __init__(self, map_id):
-        if not map_id:
-            raise WebserverException(
-                    ReturnCode.MAP_LOADING_FAILED,
-                    'No map id')
-        elif map_id not in Config().maps.keys():
-            raise WebserverException(
-                    ReturnCode.MAP_LOADING_FAILED,
-                    'Map not available')
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_at = time.time()
+        self.backend_pid = self.get_backend_pid()
+        self.prepared_statement_name_set = set()
+        # pool and read replica of the current borrower, see DBControl.acquire_connection
+        self.connection_pool = None
+        self.read_replica = None
+        # set by DBControl.cancel_queries_of_session for the current borrower
+        self.cancelled_by_client = False
+
+
+class PreparedStatement():
+    """
+    Named server-side prepared statement
+
+    The query is declared once and prepared lazily on every pooled connection
+    it's executed on. Parameters are referenced as $1, $2, ... within the query
+    and mapped by position to the names in parameter_name_list.
+    """
+
+    def __init__(self, name, query, parameter_name_list):
+        self.name = name
+        self.query = query
+        self.parameter_name_list = parameter_name_list
+        self.execute_query = sql.SQL("EXECUTE {i_name} ({c_parameter_list})").format(
+                i_name=sql.Identifier(self.name),
+                c_parameter_list=sql.SQL(", ").join(
+                    [ sql.Placeholder(name=parameter_name) for parameter_name in self.parameter_name_list ]))
+
+    def execute(self, cursor, params, prefix=None):
+        con = cursor.connection
+        if self.name not in con.prepared_statement_name_set:
+            cursor.execute(
+                    sql.SQL("PREPARE {i_name} AS {c_query}").format(
+                        i_name=sql.Identifier(self.name), c_query=self.query))
+            con.prepared_statement_name_set.add(self.name)
+        cursor.execute(
+                prefix + self.execute_query if prefix else self.execute_query, params)
+
+    def __str__(self):
+        return "prepared statement {}".format(self.name)
+
+
+class QueryLiteral(sql.Composable):
+    """
+    Query as quoted string literal, e.g. the edge query argument of the
+    pgRouting functions
+
+    It's rendered with the connection, which executes the outer query. Percent
+    signs are doubled, because the outer query is executed with params.
+    """
+
+    def as_string(self, context):
+        return sql.Literal(self._wrapped.as_string(context)).as_string(context).replace("%", "%%")
+
+
+class BoundedConnectionPool():
+    """
+    Thread-safe connection pool with an upper connection limit
+
+    If all connections are in use, getconn waits up to acquire_timeout seconds
+    for a returned one instead of failing immediately.
+    """
+
+    class PoolTimeoutError(psycopg2.pool.PoolError):
+        """ no connection became available within the acquire timeout """
+
+    def __init__(self, min_connections, max_connections, acquire_timeout, **connection_kwargs):
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.acquire_timeout = acquire_timeout
+        self.connection_kwargs = connection_kwargs
+        self.closed = False
+        self.idle_connection_list = []
+        self.used_connection_list = []
+        self.number_of_waiters = 0
+        self.condition = threading.Condition()
+        # statistics
+        self.number_of_acquisitions = 0
+        self.number_of_timeouts = 0
+        self.acquire_wait_histogram = Histogram()
+        # open the minimum number of connections
+        for i in range(self.min_connections):
+            self.idle_connection_list.append(self._connect())
+
+    def _connect(self):
+        return psycopg2.connect(
+                connection_factory=PooledConnection, **self.connection_kwargs)
+
+    def getconn(self, timeout=None):
+        start = time.time()
+        deadline = start + (timeout if timeout is not None else self.acquire_timeout)
+        with self.condition:
+            self.number_of_waiters += 1
+            try:
+                while True:
+                    if self.closed:
+                        raise psycopg2.pool.PoolError("connection pool is closed")
+                    if self.idle_connection_list:
+                        con = self.idle_connection_list.pop()
+                        break
+                    if len(self.used_connection_list) < self.max_connections:
+                        # reserve the slot, the connection is opened outside of the lock
+                        con = None
+                        self.used_connection_list.append(con)
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.number_of_timeouts += 1
+                        raise BoundedConnectionPool.PoolTimeoutError(
+                                "No database connection available after {:.1f} seconds".format(time.time() - start))
+                    self.condition.wait(remaining)
+            finally:
+                self.number_of_waiters -= 1
+            if con:
+                self.used_connection_list.append(con)
+            self.number_of_acquisitions += 1
+
+        if not con:
+            try:
+                con = self._connect()
+            except psycopg2.Error as e:
+                with self.condition:
+                    self.used_connection_list.remove(None)
+                    self.condition.notify()
+                raise
+            with self.condition:
+                self.used_connection_list.remove(None)
+                self.used_connection_list.append(con)
+
+        self.acquire_wait_histogram.add((time.time() - start) * 1000)
+        return con
+
+    def putconn(self, con, close=False):
+        if not close and not con.closed:
+            status = con.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                # end the implicit transaction of read-only queries
+                try:
+                    con.rollback()
+                except psycopg2.Error as e:
+                    close = True
+        with self.condition:
+            if con in self.used_connection_list:
+                self.used_connection_list.remove(con)
+            if self.closed or close or con.closed:
+                if not con.closed:
+                    con.close()
+            else:
+                self.idle_connection_list.append(con)
+            self.condition.notify()
+            if self.closed:
+                raise psycopg2.pool.PoolError("connection pool is closed")
+
+    def closeall(self):
+        """
+        Close the idle connections. Connections in use are closed by putconn,
+        so running queries of other threads aren't interrupted.
+        """
+        with self.condition:
+            if self.closed:
+                raise psycopg2.pool.PoolError("connection pool is closed")
+            self.closed = True
+            for con in self.idle_connection_list:
+                if not con.closed:
+                    con.close()
+            self.idle_connection_list.clear()
+            self.condition.notify_all()
+
+    def get_statistics(self):
+        now = time.time()
+        with self.condition:
+            age_list = [ now - con.created_at \
+                    for con in self.idle_connection_list + self.used_connection_list if con ]
+            return {
+                    "max_connections"   : self.max_connections,
+                    "in_use"            : len(self.used_connection_list),
+                    "idle"              : len(self.idle_connection_list),
+                    "waiters"           : self.number_of_waiters,
+                    "acquisitions"      : self.number_of_acquisitions,
+                    "timeouts"          : self.number_of_timeouts,
+                    "acquire_wait_ms"   : self.acquire_wait_histogram.to_dict(),
+                    "connection_age_in_seconds" : {
+                        "min" : int(min(age_list)) if age_list else 0,
+                        "max" : int(max(age_list)) if age_list else 0,
+                        "avg" : int(sum(age_list) / len(age_list)) if age_list else 0 }
+                   }
+
+
+class QueryStatistics():
+    """ thread-safe per query name histograms of pool acquire, execute and fetch time """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.query_dict = {}
+
+    def get_entry(self, query_name):
+        with self.lock:
+            entry = self.query_dict.get(query_name)
+            if not entry:
+                entry = {
+                        "acquire_ms"    : Histogram(),
+                        "execute_ms"    : Histogram(),
+                        "fetch_ms"      : Histogram(),
+                        "errors"        : 0 }
+                self.query_dict[query_name] = entry
+            return entry
+
+    def add(self, query_name, acquire_ms, execute_ms, fetch_ms):
+        entry = self.get_entry(query_name)
+        entry['acquire_ms'].add(acquire_ms)
+        entry['execute_ms'].add(execute_ms)
+        entry['fetch_ms'].add(fetch_ms)
+
+    def add_error(self, query_name):
+        entry = self.get_entry(query_name)
+        with self.lock:
+            entry['errors'] += 1
+
+    def to_dict(self):
+        with self.lock:
+            query_dict = dict(self.query_dict)
+        statistics = {}
+        for query_name, entry in sorted(query_dict.items()):
+            statistics[query_name] = {
+                    "acquire_ms"    : entry['acquire_ms'].to_dict(),
+                    "execute_ms"    : entry['execute_ms'].to_dict(),
+                    "fetch_ms"      : entry['fetch_ms'].to_dict(),
+                    "errors"        : entry['errors'] }
+        return statistics
+
+
+class ReadReplica():
+    """
+    Connection pool of a read replica with a passive health state
+
+    A replica, which fails to connect or loses its connection during a query,
+    is skipped for replica_retry_interval seconds. Afterwards a new pool is
+    created on next use, which serves as health check.
+    """
 
+    def __init__(self, map_id, host_name, port):
+        self.map_id = map_id
+        self.host_name = host_name
+        self.port = port
+        self.name = "{}:{}".format(host_name, port)
+        self.connection_pool = None
+        self.unhealthy_until = 0
+        self.number_of_failures = 0
+        self.lock = threading.Lock()
+
+    def is_healthy(self):
+        return time.time() >= self.unhealthy_until
+
+    def get_connection_pool(self):
+        with self.lock:
+            if not self.connection_pool:
+                self.connection_pool = BoundedConnectionPool(
+                        Config().database.get("pool_min_connections"),
+                        Config().database.get("pool_max_connections"),
+                        Config().database.get("pool_acquire_timeout"),
+                        host = self.host_name,
+                        port = self.port,
+                        user = Config().database.get("user"),
+                        password = Config().database.get("password"),
+                        database=self.map_id)
+            return self.connection_pool
+
+    def mark_unhealthy(self, error):
+        logging.warning(
+                "Read replica {} of map {} failed, retry in {} seconds: {}".format(
+                    self.name, self.map_id, Config().database.get("replica_retry_interval"),
+                    str(error).strip()))
+        with self.lock:
+            self.unhealthy_until = time.time() + Config().database.get("replica_retry_interval")
+            self.number_of_failures += 1
+            connection_pool = self.connection_pool
+            self.connection_pool = None
+        if connection_pool:
+            try:
+                connection_pool.closeall()
+            except psycopg2.pool.PoolError as e:
+                pass
+
+    def close(self):
+        with self.lock:
+            connection_pool = self.connection_pool
+            self.connection_pool = None
+        if connection_pool:
+            try:
+                connection_pool.closeall()
+            except psycopg2.pool.PoolError as e:
+                pass
+
+    def get_statistics(self):
+        connection_pool = self.connection_pool
+        return {
+                "healthy"   : self.is_healthy(),
+                "failures"  : self.number_of_failures,
+                "connection_pool" : connection_pool.get_statistics() if connection_pool else None
+               }
+
+
+class MapDatabase():
+    """ long-lived connection pool and map meta data of a single map database """
+
+    def __init__(self, map_id):
+        self.map_id = map_id
         try:
-            self.connection_pool = psycopg2.pool.SimpleConnectionPool(
-                    1, 20,
+            self.connection_pool = BoundedConnectionPool(
+                    Config().database.get("pool_min_connections"),
+                    Config().database.get("pool_max_connections"),
+                    Config().database.get("pool_acquire_timeout"),
                     host = Config().database.get("host_name"),
                     port = Config().database.get("port"),
                     user = Config().database.get("user"),
@@ -39,30 +347,54 @@ class DBControl():
             raise WebserverException(
                     ReturnCode.MAP_LOADING_FAILED,
                     "Could not create database connection pool: {}".format(error))
+        # read replicas
+        self.read_replica_list = [
+                ReadReplica(map_id, replica.get("host_name"), replica.get("port")) \
+                for replica in Config().database.get("read_replicas").get(map_id, []) ]
+        self.read_replica_counter = itertools.count()
+        # only one thread checks for a map rebuild at a time, see check_map_created
+        self.map_created_check_lock = threading.Lock()
+        self.map_created_checked_at = time.time()
 
-        # create access statistics table, if it doesn't exist yet
-        self.edit_database(
-                sql.SQL(
-                    """
-                    CREATE TABLE IF NOT EXISTS {i_access_statistics_table} (
-                        session_id TEXT UNIQUE NOT NULL,
-                        timestamp BIGINT NOT NULL)
-                    """
-                    ).format(
-                        i_access_statistics_table=sql.Identifier(Config().database.get("access_statistics_table"))))
-
-        # query map version and creation date from database
-        map_info = self.fetch_one(
-                sql.SQL(
-                    """
-                    SELECT version, created
-                        FROM {i_map_info}
-                        WHERE id = {p_map_id}
-                    """
-                    ).format(
-                            i_map_info=sql.Identifier(Config().database.get("map_info")),
-                            p_map_id=sql.Placeholder(name='map_id')),
-                {'map_id':map_id})
+        # the following queries run only once per pool lifetime
+        db = DBControl(map_id, map_database=self, use_primary=True)
+        try:
+            # create access statistics table, if it doesn't exist yet
+            db.edit_database(
+                    sql.SQL(
+                        """
+                        CREATE TABLE IF NOT EXISTS {i_access_statistics_table} (
+                            session_id TEXT UNIQUE NOT NULL,
+                            timestamp BIGINT NOT NULL)
+                        """
+                        ).format(
+                            i_access_statistics_table=sql.Identifier(Config().database.get("access_statistics_table"))),
+                    query_name="create_access_statistics_table")
+            # query map version and creation date from database
+            map_info = self.fetch_map_info(db)
+            # the pgrouting engine filters blocked ways by osm id on the permanent routing table
+            if Config().maps.get(map_id, {}).get("routing_engine") == "pgrouting" \
+                    and not db.fetch_one(
+                        sql.SQL(
+                            """
+                            SELECT EXISTS(
+                                SELECT * FROM pg_index
+                                    JOIN pg_attribute ON pg_attribute.attrelid = pg_index.indrelid
+                                        AND pg_attribute.attnum = pg_index.indkey[0]
+                                    WHERE pg_index.indrelid = {p_routing_table}::regclass
+                                        AND pg_attribute.attname = 'osm_id') AS exists
+                            """
+                            ).format(
+                                p_routing_table=sql.Placeholder(name='routing_table')),
+                        {'routing_table':Config().database.get("routing_table")},
+                        query_name="routing_table_osm_id_index")['exists']:
+                logging.warning(
+                        "Map {}: The routing table has no osm_id index, blocked ways slow down routing.\n"
+                        "Create it with: CREATE INDEX ON {} (osm_id); or recreate the map".format(
+                            map_id, Config().database.get("routing_table")))
+        except DBControl.DatabaseError as e:
+            self.close()
+            raise
 
         # version and creation date
         map_version = None
@@ -75,6 +407,7 @@ class DBControl():
             if map_version:
                 self.map_version = map_version
             else:
+                self.close()
                 raise WebserverException(
                         ReturnCode.MAP_LOADING_FAILED,
                         'The map {} is not compatible.\nMap version: {} not in {}'.format(
@@ -90,83 +423,617 @@ class DBControl():
             if map_created:
                 self.map_created = map_created
             else:
+                self.close()
                 raise WebserverException(
                         ReturnCode.MAP_LOADING_FAILED,
                         'Invalid creation date {} for map id {}'.format(
                             map_info.get("created"), map_id))
 
+    def fetch_map_info(self, db):
+        return db.fetch_one(
+                sql.SQL(
+                    """
+                    SELECT version, created
+                        FROM {i_map_info}
+                        WHERE id = {p_map_id}
+                    """
+                    ).format(
+                            i_map_info=sql.Identifier(Config().database.get("map_info")),
+                            p_map_id=sql.Placeholder(name='map_id')),
+                {'map_id':self.map_id},
+                query_name="map_info")
+
+    def check_map_created(self):
+        """
+        Discard this map database, if the map was rebuilt in the meantime, so the
+        next DBControl instance reloads the map info. Called after a connection
+        was closed by the server and periodically by the route cache lookup. A
+        failed check is repeated with the next one.
+        """
+        if not self.map_created_check_lock.acquire(blocking=False):
+            return
+        self.map_created_checked_at = time.time()
+        try:
+            map_info = self.fetch_map_info(
+                    DBControl(self.map_id, map_database=self, use_primary=True))
+        except (DBControl.DatabaseError, WebserverException) as e:
+            logging.warning(
+                    "Map {}: creation date check failed: {}".format(self.map_id, e))
+        else:
+            if map_info.get("created") != self.map_created:
+                logging.warning(
+                        "Map {} was rebuilt: {} -> {}".format(
+                            self.map_id, self.map_created, map_info.get("created")))
+                DBControl.discard_map_database(self)
+        finally:
+            self.map_created_check_lock.release()
+
+    def check_map_created_if_due(self):
+        """ check_map_created at most once per map_created_check_interval seconds """
+        if time.time() - self.map_created_checked_at >= constants.map_created_check_interval:
+            self.check_map_created()
+
+    def get_read_replica_list(self):
+        """ healthy read replicas in round-robin order """
+        if not self.read_replica_list:
+            return []
+        start = next(self.read_replica_counter) % len(self.read_replica_list)
+        return [ replica \
+                for replica in self.read_replica_list[start:] + self.read_replica_list[:start] \
+                if replica.is_healthy() ]
 
-    def fetch_one(self, query, params={}):
+    def close(self):
+        for replica in self.read_replica_list:
+            replica.close()
+        try:
+            self.connection_pool.closeall()
+        except psycopg2.pool.PoolError as e:
+            pass
+
+
+class DBControl():
+    """
+    Cheap per-request handle onto the long-lived MapDatabase of a map
+
+    The map databases are kept in a process-wide registry, which is filled at
+    webserver start (see init_map_databases) or lazily on first use.
+    """
+    map_databases = {}
+    map_databases_lock = threading.RLock()
+    # a map database is built under its own lock, so a slow map doesn't stall the other ones
+    map_database_locks = {}
+    # map id -> (retry time, error message) of maps, which failed to load
+    map_database_failures = {}
+    # unique names for server-side cursors
+    cursor_counter = itertools.count()
+    # connections with running queries per session id, see cancel_queries_of_session
+    in_flight_connections = {}
+    in_flight_connections_lock = threading.Lock()
+    # timings per query name of all maps
+    query_statistics = QueryStatistics()
+
+    def __init__(self, map_id, session_id=None, map_database=None, deadline=None,
+            use_primary=False):
+        if not map_id:
+            raise WebserverException(
+                    ReturnCode.MAP_LOADING_FAILED,
+                    'No map id')
+        elif map_id not in Config().maps.keys():
+            raise WebserverException(
+                    ReturnCode.MAP_LOADING_FAILED,
+                    'Map not available')
+        self.map_id = map_id
+        self.session_id = session_id
+        # absolute unix timestamp, after which all queries of the request fail
+        self.deadline = deadline
+        # send read-only queries to the primary too, for example to read own writes
+        self.use_primary = use_primary
+        self.map_database = map_database if map_database else DBControl.get_map_database(map_id)
+        self.connection_pool = self.map_database.connection_pool
+
+    @property
+    def map_version(self):
+        return self.map_database.map_version
+
+    @property
+    def map_created(self):
+        return self.map_database.map_created
+
+
+    #####
+    # map database registry
+    #####
+
+    @staticmethod
+    def init_map_databases():
+        for map_id in Config().maps.keys():
+            try:
+                DBControl.get_map_database(map_id)
+            except (WebserverException, DBControl.DatabaseError) as e:
+                logging.warning(e)
+
+    @staticmethod
+    def close_map_databases():
+        with DBControl.map_databases_lock:
+            for map_database in DBControl.map_databases.values():
+                map_database.close()
+            DBControl.map_databases.clear()
+            DBControl.map_database_failures.clear()
+
+    @staticmethod
+    def get_map_database(map_id):
+        with DBControl.map_databases_lock:
+            map_database = DBControl.map_databases.get(map_id)
+            if map_database:
+                return map_database
+            map_lock = DBControl.map_database_locks.setdefault(map_id, threading.Lock())
+        with map_lock:
+            # another thread may have built it in the meantime
+            with DBControl.map_databases_lock:
+                map_database = DBControl.map_databases.get(map_id)
+                if map_database:
+                    return map_database
+                failure = DBControl.map_database_failures.get(map_id)
+            if failure and time.time() < failure[0]:
+                raise WebserverException(
+                        ReturnCode.MAP_LOADING_FAILED,
+                        "Map {} unavailable, next try in {:.0f} seconds: {}".format(
+                            map_id, failure[0] - time.time(), failure[1]))
+            try:
+                map_database = MapDatabase(map_id)
+            except (WebserverException, DBControl.DatabaseError) as e:
+                with DBControl.map_databases_lock:
+                    DBControl.map_database_failures[map_id] = (
+                            time.time() + Config().database.get("map_retry_interval"), str(e))
+                raise
+            with DBControl.map_databases_lock:
+                DBControl.map_databases[map_id] = map_database
+                DBControl.map_database_failures.pop(map_id, None)
+            return map_database
+
+    @staticmethod
+    def get_statistics():
+        with DBControl.map_databases_lock:
+            map_database_list = list(DBControl.map_databases.values())
+        statistics = {}
+        for map_database in map_database_list:
+            statistics[map_database.map_id] = {
+                    "connection_pool" : map_database.connection_pool.get_statistics() }
+            if map_database.read_replica_list:
+                statistics[map_database.map_id]['read_replicas'] = {
+                        replica.name : replica.get_statistics() \
+                        for replica in map_database.read_replica_list }
+        return statistics
+
+    @staticmethod
+    def get_query_statistics():
+        return DBControl.query_statistics.to_dict()
+
+    @staticmethod
+    def discard_map_database(map_database):
+        """
+        Remove the map database of a rebuilt map from the registry. The next
+        DBControl instance creates a new pool and reloads the map info.
+        """
+        with DBControl.map_databases_lock:
+            if DBControl.map_databases.get(map_database.map_id) is map_database:
+                DBControl.map_databases.pop(map_database.map_id)
+                logging.warning(
+                        "Map database {} discarded".format(map_database.map_id))
+        map_database.close()
+
+
+    #####
+    # cancellation of running queries
+    #####
+
+    @staticmethod
+    def cancel_queries_of_session(session_id):
+        """
+        Cancel the queries, which currently run on behalf of the given session
+        id. The affected fetch or edit call raises a WebserverException with
+        return code CANCELLED_BY_CLIENT.
+        """
+        with DBControl.in_flight_connections_lock:
+            for con in DBControl.in_flight_connections.get(session_id, []):
+                logging.info(
+                        "Cancel query of session {} on backend {}".format(session_id, con.backend_pid))
+                # tells create_error, that the query wasn't stopped by the deadline
+                con.cancelled_by_client = True
+                try:
+                    # same as pg_cancel_backend(backend_pid) but doesn't need a free pool connection
+                    con.cancel()
+                except psycopg2.Error as e:
+                    logging.warning("Cancel of backend {} failed: {}".format(con.backend_pid, e))
+
+    def create_error(self, e, con=None):
+        if isinstance(e, psycopg2.extensions.QueryCanceledError):
+            # cancelled by the client or stopped by the statement timeout of the request deadline
+            if self.deadline and not (con and con.cancelled_by_client):
+                return WebserverException(
+                        ReturnCode.DEADLINE_EXCEEDED, "Request deadline exceeded: {}".format(str(e).strip()))
+            return WebserverException(
+                    ReturnCode.CANCELLED_BY_CLIENT, "Query cancelled: {}".format(str(e).strip()))
+        return DBControl.DatabaseError(e)
+
+
+    #####
+    # request deadline
+    #####
+
+    def get_remaining_time(self):
+        """
+        Remaining seconds until the request deadline or None, if the request
+        has no deadline. Raises a WebserverException with return code
+        DEADLINE_EXCEEDED, if the deadline already passed.
+        """
+        if not self.deadline:
+            return None
+        remaining_time = self.deadline - time.time()
+        if remaining_time <= 0:
+            raise WebserverException(
+                    ReturnCode.DEADLINE_EXCEEDED,
+                    "Map {}: Request deadline exceeded".format(self.map_id))
+        return remaining_time
+
+    def get_statement_timeout_query(self):
+        """
+        SET LOCAL statement_timeout to the remaining time of the request. It's
+        valid until the end of the current transaction, so it doesn't leak to
+        the next user of the pooled connection.
+        """
+        remaining_time = self.get_remaining_time()
+        if remaining_time is None:
+            return None
+        return sql.SQL("SET LOCAL statement_timeout = {}; ").format(
+                sql.Literal(max(1, int(remaining_time * 1000))))
+
+
+    def acquire_connection(self, read_only=False):
+        """
+        Borrow a connection. Read-only queries go to the next healthy read
+        replica of the map, if there is one, and fall back to the primary.
+        """
+        if read_only and not self.use_primary:
+            for replica in self.map_database.get_read_replica_list():
+                try:
+                    con = self.acquire_connection_from_pool(
+                            replica.get_connection_pool())
+                except psycopg2.Error as e:
+                    replica.mark_unhealthy(e)
+                except WebserverException as e:
+                    if e.return_code == ReturnCode.DEADLINE_EXCEEDED:
+                        raise
+                    # exhausted replica pool, try the next one
+                    logging.warning("Read replica {}: {}".format(replica.name, e))
+                else:
+                    con.read_replica = replica
+                    return con
+        return self.acquire_connection_from_pool(self.connection_pool)
+
+    def acquire_connection_from_pool(self, connection_pool):
+        acquire_timeout = connection_pool.acquire_timeout
+        limited_by_deadline = False
+        remaining_time = self.get_remaining_time()
+        if remaining_time is not None and remaining_time < acquire_timeout:
+            acquire_timeout = remaining_time
+            limited_by_deadline = True
+        try:
+            con = connection_pool.getconn(acquire_timeout)
+        except BoundedConnectionPool.PoolTimeoutError as e:
+            if limited_by_deadline:
+                raise WebserverException(
+                        ReturnCode.DEADLINE_EXCEEDED,
+                        "Map {}: Request deadline exceeded: {}".format(self.map_id, e))
+            raise WebserverException(
+                    ReturnCode.SERVICE_UNAVAILABLE,
+                    "Map {}: {}".format(self.map_id, e))
+        con.connection_pool = connection_pool
+        con.read_replica = None
+        con.cancelled_by_client = False
+        if self.session_id:
+            with DBControl.in_flight_connections_lock:
+                DBControl.in_flight_connections.setdefault(self.session_id, []).append(con)
+        return con
+
+    def release_connection(self, con):
+        if self.session_id:
+            with DBControl.in_flight_connections_lock:
+                connection_list = DBControl.in_flight_connections.get(self.session_id, [])
+                if con in connection_list:
+                    connection_list.remove(con)
+                if not connection_list:
+                    DBControl.in_flight_connections.pop(self.session_id, None)
+        try:
+            if con.closed:
+                con.connection_pool.putconn(con, close=True)
+                if con.read_replica:
+                    if con.read_replica.is_healthy():
+                        con.read_replica.mark_unhealthy("Connection closed by server")
+                else:
+                    # only this connection is dropped, unless the map was rebuilt
+                    self.map_database.check_map_created()
+            else:
+                con.connection_pool.putconn(con)
+        except psycopg2.pool.PoolError as e:
+            # the pool was discarded in the meantime
+            con.close()
+
+
+    @staticmethod
+    def is_read_replica_failure(con, e):
+        """
+        True, if a read replica lost its connection during a query. The replica
+        is marked unhealthy and the query may be retried elsewhere.
+        """
+        if con and con.read_replica \
+                and isinstance(e, psycopg2.OperationalError) \
+                and not isinstance(e, psycopg2.extensions.QueryCanceledError):
+            con.read_replica.mark_unhealthy(e)
+            return True
+        return False
+
+
+    #####
+    # query timing and slow query log
+    #####
+
+    @staticmethod
+    def get_query_name(query, query_name):
+        if query_name:
+            return query_name
+        if isinstance(query, PreparedStatement):
+            return query.name
+        return "unnamed"
+
+    def record_query(self, query_name, query, params, cursor,
+            start, acquired, executed, fetched, explain=False):
+        acquire_ms = (acquired - start) * 1000
+        execute_ms = (executed - acquired) * 1000
+        fetch_ms = (fetched - executed) * 1000
+        DBControl.query_statistics.add(query_name, acquire_ms, execute_ms, fetch_ms)
+        slow_query_threshold = Config().database.get("slow_query_threshold")
+        if slow_query_threshold and execute_ms + fetch_ms >= slow_query_threshold:
+            self.log_slow_query(
+                    query_name, query, params, cursor, acquire_ms, execute_ms, fetch_ms, explain)
+
+    def log_slow_query(self, query_name, query, params, cursor,
+            acquire_ms, execute_ms, fetch_ms, explain):
+        """
+        Log the bound sql of a slow query and, for read-only queries, its
+        query plan. Must be called before the connection is released.
+        """
+        query_plan = ""
+        try:
+            bound_query = cursor.mogrify(
+                    query.execute_query if isinstance(query, PreparedStatement) else query,
+                    params)
+            if explain:
+                cursor.execute(b"EXPLAIN " + bound_query)
+                query_plan = "\n".join([ row[0] for row in cursor.fetchall() ])
+            bound_query = bound_query.decode("utf-8").strip()
+        except psycopg2.Error as e:
+            bound_query = "{} -- {}".format(query, params)
+            query_plan = "EXPLAIN failed: {}".format(str(e).strip())
+        logging.warning(
+                "Slow query {} on map {}: acquire {:.0f} ms, execute {:.0f} ms, fetch {:.0f} ms\n{}\n{}".format(
+                    query_name, self.map_id, acquire_ms, execute_ms, fetch_ms, bound_query, query_plan))
+
+
+    def execute(self, cursor, query, params):
+        # the statement timeout is sent within the same round trip as the query
+        prefix = self.get_statement_timeout_query()
+        if isinstance(query, PreparedStatement):
+            query.execute(cursor, params, prefix)
+        elif prefix:
+            if isinstance(query, str):
+                query = sql.SQL(query)
+            cursor.execute(prefix + query, params)
+        else:
+            cursor.execute(query, params)
+
+
+    def fetch_one(self, query, params={}, query_name=None):
+        query_name = DBControl.get_query_name(query, query_name)
         con = None
         row = None
         error = None
+        retry = False
         try:
-            con = self.connection_pool.getconn()
+            start = time.time()
+            con = self.acquire_connection(read_only=True)
+            acquired = time.time()
             cursor = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            cursor.execute(query, params)
+            self.execute(cursor, query, params)
+            executed = time.time()
             row = cursor.fetchone()
+            fetched = time.time()
         except psycopg2.Error as e:
-            logging.error(
-                    'SQL single-row query: {} -- {}'.format(query, params))
-            error = DBControl.DatabaseError(e)
+            DBControl.query_statistics.add_error(query_name)
+            if DBControl.is_read_replica_failure(con, e):
+                retry = True
+            else:
+                logging.error(
+                        'SQL single-row query {}: {} -- {}'.format(query_name, query, params))
+                error = self.create_error(e, con)
         else:
             logging.getLogger("database").debug(
-                    'SQL single-row query: {}'.format(cursor.query.decode("utf-8").strip()))
+                    'SQL single-row query {}: {}'.format(query_name, cursor.query.decode("utf-8").strip()))
+            self.record_query(
+                    query_name, query, params, cursor, start, acquired, executed, fetched, explain=True)
             if not row:
                 error = DBControl.DatabaseResultEmptyError("No result for query")
         finally:
             if con:
-                self.connection_pool.putconn(con)
+                self.release_connection(con)
             if error:
                 raise error
+        if retry:
+            return self.fetch_one(query, params, query_name)
         return row
 
 
-    def fetch_all(self, query, params={}):
+    def fetch_all(self, query, params={}, query_name=None):
+        query_name = DBControl.get_query_name(query, query_name)
         con = None
         row_list = None
         error = None
+        retry = False
         try:
-            con = self.connection_pool.getconn()
+            start = time.time()
+            con = self.acquire_connection(read_only=True)
+            acquired = time.time()
             cursor = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            cursor.execute(query, params)
+            self.execute(cursor, query, params)
+            executed = time.time()
             row_list = cursor.fetchall()
+            fetched = time.time()
         except psycopg2.Error as e:
-            logging.error(
-                    'Error: SQL multi-row query: {} -- {}'.format(query, params))
-            error = DBControl.DatabaseError(e)
+            DBControl.query_statistics.add_error(query_name)
+            if DBControl.is_read_replica_failure(con, e):
+                retry = True
+            else:
+                logging.error(
+                        'Error: SQL multi-row query {}: {} -- {}'.format(query_name, query, params))
+                error = self.create_error(e, con)
         else:
             logging.getLogger("database").debug(
-                    'SQL multi-row query: {}'.format(cursor.query.decode("utf-8").strip()))
+                    'SQL multi-row query {}: {}'.format(query_name, cursor.query.decode("utf-8").strip()))
+            self.record_query(
+                    query_name, query, params, cursor, start, acquired, executed, fetched, explain=True)
         finally:
             if con:
-                self.connection_pool.putconn(con)
+                self.release_connection(con)
             if error:
                 raise error
+        if retry:
+            return self.fetch_all(query, params, query_name)
         return row_list
 
 
-    def edit_database(self, query, params={}):
+    def fetch_iter(self, query, params={}, batch_size=10000, query_name=None):
+        """
+        Generator, which streams a large result set through a named server-side
+        cursor in batches of batch_size rows, so memory usage stays constant.
+
+        The pooled connection is held until the generator is exhausted or
+        closed. Wrap it into contextlib.closing() to release the connection
+        deterministically, if the loop may end early.
+        """
+        query_name = DBControl.get_query_name(query, query_name)
+        start = time.time()
+        con = self.acquire_connection(read_only=True)
+        acquired = time.time()
+        try:
+            cursor = con.cursor(
+                    name="fetch_iter_{}".format(next(DBControl.cursor_counter)),
+                    cursor_factory=psycopg2.extras.DictCursor)
+            cursor.itersize = batch_size
+            statement_timeout_query = self.get_statement_timeout_query()
+            if statement_timeout_query:
+                # a named cursor can't execute multiple statements at once
+                con.cursor().execute(statement_timeout_query)
+            cursor.execute(query, params)
+            executed = time.time()
+            logging.getLogger("database").debug(
+                    'SQL streamed query {}: {}'.format(query_name, cursor.query.decode("utf-8").strip()))
+            # the fetch time excludes the processing time of the caller
+            fetch_time = 0.0
+            while True:
+                self.get_remaining_time()
+                fetch_start = time.time()
+                row_list = cursor.fetchmany(batch_size)
+                fetch_time += time.time() - fetch_start
+                if not row_list:
+                    break
+                for row in row_list:
+                    yield row
+            cursor.close()
+            self.record_query(
+                    query_name, query, params, con.cursor(),
+                    start, acquired, executed, executed + fetch_time)
+        except psycopg2.Error as e:
+            logging.error(
+                    'Error: SQL streamed query {}: {} -- {}'.format(query_name, query, params))
+            DBControl.query_statistics.add_error(query_name)
+            DBControl.is_read_replica_failure(con, e)
+            raise self.create_error(e, con)
+        finally:
+            self.release_connection(con)
+
+
+    def fetch_by_ids(self, table_or_query, key_column, id_list, params={},
+            preserve_order=False, multiple_rows_per_id=False, query_name=None):
+        """
+        Fetch the rows of many ids with a single query
+
+        table_or_query is either a table name or a query, which selects the
+        key column and filters it with "= ANY({p_id_list})", where p_id_list
+        is sql.Placeholder(name='id_list').
+        Returns a dict id -> row or, if multiple_rows_per_id is set, a dict
+        id -> list of rows. Ids without result are missing from the dict. If
+        preserve_order is set, the dict follows the order of the id_list.
+        """
+        unique_id_list = list(dict.fromkeys(id_list))
+        if not unique_id_list:
+            return {}
+        if isinstance(table_or_query, str):
+            query = sql.SQL(
+                    """
+                    SELECT * FROM {i_table_name} WHERE {i_key_column} = ANY({p_id_list})
+                    """
+                    ).format(
+                        i_table_name=sql.Identifier(table_or_query),
+                        i_key_column=sql.Identifier(key_column),
+                        p_id_list=sql.Placeholder(name='id_list'))
+        else:
+            query = table_or_query
+
+        if not query_name and isinstance(table_or_query, str):
+            query_name = "fetch_by_ids_{}".format(table_or_query)
+
+        row_dict = {}
+        for row in self.fetch_all(
+                query, {**params, "id_list":unique_id_list}, query_name=query_name):
+            if multiple_rows_per_id:
+                row_dict.setdefault(row[key_column], []).append(row)
+            else:
+                row_dict[row[key_column]] = row
+        if preserve_order:
+            return { id : row_dict[id] for id in unique_id_list if id in row_dict }
+        return row_dict
+
+
+    def edit_database(self, query, params={}, query_name=None):
+        query_name = DBControl.get_query_name(query, query_name)
         con = None
         error = None
         try:
-            con = self.connection_pool.getconn()
+            start = time.time()
+            con = self.acquire_connection()
+            acquired = time.time()
             cursor = con.cursor()
-            cursor.execute(query, params)
+            self.execute(cursor, query, params)
+            executed = time.time()
             con.commit()
+            committed = time.time()
         except psycopg2.Error as e:
             logging.error(
-                    'Error: edit_database: {} -- {}'.format(query, params))
-            error = DBControl.DatabaseError(e)
+                    'Error: edit_database {}: {} -- {}'.format(query_name, query, params))
+            DBControl.query_statistics.add_error(query_name)
+            error = self.create_error(e, con)
             # roll back
-            if con:
+            if con and not con.closed:
                 con.rollback()
         else:
             logging.getLogger("database").debug(
-                    'edit_database: {}'.format(cursor.query.decode("utf-8").strip()))
+                    'edit_database {}: {}'.format(query_name, cursor.query.decode("utf-8").strip()))
+            # the commit time counts as fetch time, no query plan for data modifications
+            self.record_query(
+                    query_name, query, params, cursor, start, acquired, executed, committed)
         finally:
             if con:
-                self.connection_pool.putconn(con)
+                self.release_connection(con)
             if error:
                 raise error
 
@@ -176,9 +1043,10 @@ class DBControl():
         table_exists = False
         error = None
         try:
-            con = self.connection_pool.getconn()
+            con = self.acquire_connection()
             cursor = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            cursor.execute(
+            self.execute(
+                    cursor,
                     sql.SQL(
                         """
                             SELECT EXISTS(
@@ -192,10 +1060,10 @@ class DBControl():
         except psycopg2.Error as e:
             logging.error(
                     'SQL single-row query: {} -- {}'.format(query, params))
-            error = DBControl.DatabaseError(e)
+            error = self.create_error(e, con)
         finally:
             if con:
-                self.connection_pool.putconn(con)
+                self.release_connection(con)
             if error:
                 raise error
         return table_exists
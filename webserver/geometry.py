@@ -2,10 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import math
+import struct
+import sys
+from array import array
 
 from psycopg2 import sql
 
 
+# wkb geometry types
+WKB_POINT = 1
+WKB_LINESTRING = 2
+WKB_POLYGON = 3
+# flags of postgis extended wkb
+EWKB_Z_FLAG = 0x80000000
+EWKB_M_FLAG = 0x40000000
+EWKB_SRID_FLAG = 0x20000000
+
+
 def add_bearing_and_distance_to_segment(segment, lat1, lon1, lat2, lon2):
     segment['start']    = { "lat": lat1, "lon": lon1 }
     segment['end']     = { "lat": lat2, "lon": lon2 }
@@ -68,6 +81,28 @@ def bearing_between_two_points(lat1, lon1, lat2, lon2):
     return int(compass_bearing)
 
 
+def get_bearing_list(coordinates):
+    """
+    Bearings between all consecutive points of a flat coordinate array
+    [lon1, lat1, lon2, lat2, ...], equal to bearing_between_two_points, but
+    the sine and cosine of every latitude are only computed once and the
+    loop runs without function calls per point.
+    """
+    radians, sin, cos, atan2, degrees = math.radians, math.sin, math.cos, math.atan2, math.degrees
+    lat_list = list(map(radians, coordinates[1::2]))
+    sin_lat = list(map(sin, lat_list))
+    cos_lat = list(map(cos, lat_list))
+    lon_list = coordinates[0::2]
+    # radians of the longitude difference lon2 - lon1
+    diff_long_list = map(radians, map(float.__rsub__, lon_list, lon_list[1:]))
+    return array('q', [
+            int((degrees(atan2(
+                sin(diff_long) * cos_lat2,
+                cos_lat1 * sin_lat2 - (sin_lat1 * cos_lat2 * cos(diff_long)))) + 360) % 360) \
+            for diff_long, sin_lat1, cos_lat1, sin_lat2, cos_lat2 \
+                in zip(diff_long_list, sin_lat, cos_lat, sin_lat[1:], cos_lat[1:]) ])
+
+
 def distance_between_two_points(lat1, lon1, lat2, lon2):
     return int(distance_between_two_points_as_float(lat1, lon1, lat2, lon2))
 
@@ -122,3 +157,114 @@ def get_boundary_box(lat, lon, radius):
             lat, lon, lat, lon+1.0)
     return {'bottom':lat-lat_diff, 'top':lat+lat_diff, 'left':lon-lon_diff, 'right':lon+lon_diff}
 
+
+def decode_wkb(wkb):
+    """
+    Decode a point, linestring or polygon in WKB or EWKB format into a flat
+    array of doubles [x1, y1, x2, y2, ...], that's [lon1, lat1, ...] for WGS84.
+
+    wkb is the bytes or memoryview result of ST_AsBinary or the hex string,
+    which psycopg2 returns for plain geometry columns. Z and M values are
+    dropped and the rings of a polygon are concatenated.
+    """
+    if isinstance(wkb, str):
+        wkb = bytes.fromhex(wkb)
+    byte_order = "<" if wkb[0] == 1 else ">"
+    geometry_type, = struct.unpack_from(byte_order + "I", wkb, 1)
+    offset = 5
+    dimension = 2
+    # postgis extended wkb
+    if geometry_type & EWKB_Z_FLAG:
+        dimension += 1
+    if geometry_type & EWKB_M_FLAG:
+        dimension += 1
+    if geometry_type & EWKB_SRID_FLAG:
+        offset += 4
+    geometry_type &= 0x0fffffff
+    # iso wkb: 1000 = Z, 2000 = M, 3000 = ZM
+    dimension += (0, 1, 1, 2)[geometry_type // 1000]
+    geometry_type %= 1000
+
+    if geometry_type == WKB_POINT:
+        number_of_points = 1
+    elif geometry_type == WKB_LINESTRING:
+        number_of_points, = struct.unpack_from(byte_order + "I", wkb, offset)
+        offset += 4
+    elif geometry_type == WKB_POLYGON:
+        number_of_rings, = struct.unpack_from(byte_order + "I", wkb, offset)
+        offset += 4
+        coordinates = array('d')
+        for i in range(number_of_rings):
+            number_of_ring_points, = struct.unpack_from(byte_order + "I", wkb, offset)
+            offset += 4
+            coordinates.extend(
+                    _decode_wkb_points(wkb, offset, number_of_ring_points, dimension, byte_order))
+            offset += number_of_ring_points * dimension * 8
+        return coordinates
+    else:
+        raise ValueError("Unsupported wkb geometry type {}".format(geometry_type))
+    return _decode_wkb_points(wkb, offset, number_of_points, dimension, byte_order)
+
+
+def _decode_wkb_points(wkb, offset, number_of_points, dimension, byte_order):
+    coordinates = array('d')
+    coordinates.frombytes(wkb[offset : offset + number_of_points * dimension * 8])
+    if byte_order != ("<" if sys.byteorder == "little" else ">"):
+        coordinates.byteswap()
+    if dimension == 2:
+        return coordinates
+    # drop z and m
+    xy_coordinates = array('d', bytes(number_of_points * 16))
+    xy_coordinates[0::2] = coordinates[0::dimension]
+    xy_coordinates[1::2] = coordinates[1::dimension]
+    return xy_coordinates
+
+
+def decode_wkb_point(wkb):
+    """ returns the tuple (lat, lon) of a WKB encoded point """
+    coordinates = decode_wkb(wkb)
+    return coordinates[1], coordinates[0]
+
+
+def reverse_coordinates(coordinates):
+    """ reverse the point order of a flat coordinate array """
+    reversed_coordinates = array('d', coordinates)
+    reversed_coordinates.reverse()
+    reversed_coordinates[0::2], reversed_coordinates[1::2] = \
+            reversed_coordinates[1::2], reversed_coordinates[0::2]
+    return reversed_coordinates
+
+
+def get_line_substring(coordinates, start_fraction, end_fraction):
+    """
+    Part of a flat coordinate array between two fractions of its 2d length,
+    like ST_LineSubstring. The fractions match ST_LineLocatePoint. If the start
+    fraction is greater than the end fraction, the part is reversed.
+    """
+    if start_fraction > end_fraction:
+        return reverse_coordinates(
+                get_line_substring(coordinates, end_fraction, start_fraction))
+    # cumulative length at every point
+    length_list = [0.0]
+    for i in range(2, len(coordinates), 2):
+        length_list.append(
+                length_list[-1] + math.hypot(
+                    coordinates[i] - coordinates[i-2], coordinates[i+1] - coordinates[i-1]))
+    start_length = start_fraction * length_list[-1]
+    end_length = end_fraction * length_list[-1]
+
+    def interpolate(length):
+        for index in range(1, len(length_list)):
+            if length <= length_list[index] or index == len(length_list) - 1:
+                segment_length = length_list[index] - length_list[index-1]
+                factor = (length - length_list[index-1]) / segment_length if segment_length else 0.0
+                return [
+                        coordinates[2*index-2] + (coordinates[2*index] - coordinates[2*index-2]) * factor,
+                        coordinates[2*index-1] + (coordinates[2*index+1] - coordinates[2*index-1]) * factor ]
+
+    substring = array('d', interpolate(start_length))
+    for index in range(1, len(length_list) - 1):
+        if start_length < length_list[index] < end_length:
+            substring.extend(coordinates[2*index : 2*index+2])
+    substring.extend(interpolate(end_length))
+    return substring
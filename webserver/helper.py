@@ -7,6 +7,7 @@ import logging, logging.handlers
 import gzip
 import json
 import sys
+import threading
 
 from typing import List
 
@@ -85,6 +86,45 @@ def send_email(subject, body):
     logger.info(body, extra = {'email_subject' : subject})
 
 
+class Histogram:
+    """ Thread-safe histogram with fixed bucket upper bounds """
+    default_bucket_list = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+    def __init__(self, bucket_list=None):
+        self.bucket_list = bucket_list if bucket_list else Histogram.default_bucket_list
+        self.count_list = [0] * (len(self.bucket_list) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        index = len(self.bucket_list)
+        for i, upper_bound in enumerate(self.bucket_list):
+            if value <= upper_bound:
+                index = i
+                break
+        with self.lock:
+            self.count_list[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def to_dict(self):
+        with self.lock:
+            buckets = {}
+            for i, upper_bound in enumerate(self.bucket_list):
+                buckets["<={}".format(upper_bound)] = self.count_list[i]
+            buckets[">{}".format(self.bucket_list[-1])] = self.count_list[-1]
+            return {
+                    "count" : self.count,
+                    "avg"   : self.sum / self.count if self.count else 0.0,
+                    "max"   : self.max,
+                    "buckets" : buckets
+                   }
+
+
 class CustomSubjectSMTPHandler(logging.handlers.SMTPHandler):
     def getSubject(self, record):
         formatter = logging.Formatter(fmt=self.subject)
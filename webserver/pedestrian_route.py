@@ -1,30 +1,64 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import json, logging, re, time
+import concurrent.futures, copy, json, logging, math, re, threading, time
+from array import array
 from psycopg2 import sql
 
 from . import constants, geometry, statistics
 from .config import Config
 from .constants import ReturnCode
-from .db_control import DBControl
+from .db_control import DBControl, QueryLiteral
 from .helper import WebserverException
 from .poi import POI
+from .route_cache import RouteCache
+from .routing_graph import RoutingGraph
 from .translator import Translator
 
 
 class PedestrianRoute:
+    # the route sections of all requests share one bounded thread pool, see get_section_executor
+    section_executor = None
+    section_executor_lock = threading.Lock()
 
     def __init__(self, map_id, session_id, user_language,
             way_class_name_and_weight_map, way_ids_to_exclude,
-            prefer_translated_strings_in_osm_tags):
-        self.selected_db = DBControl(map_id)
+            prefer_translated_strings_in_osm_tags, deadline=None, routing_algorithm=None):
+        self.routing_engine = Config().maps.get(map_id, {}).get("routing_engine")
+        # routing algorithm: from the request or the map config
+        if routing_algorithm is None:
+            routing_algorithm = Config().maps.get(map_id, {}).get("routing_algorithm")
+        elif routing_algorithm not in constants.supported_routing_algorithm_list:
+            raise WebserverException(
+                    ReturnCode.BAD_REQUEST,
+                    "Invalid routing algorithm {}".format(routing_algorithm))
+        if routing_algorithm == "contraction_hierarchy" and self.routing_engine != "graph":
+            # only the in-memory graph has a contraction hierarchy
+            routing_algorithm = "bidirectional"
+        self.routing_algorithm = routing_algorithm
+        self.map_id = map_id
+        self.user_language = user_language
+        self.prefer_translated_strings_in_osm_tags = prefer_translated_strings_in_osm_tags
+        self.deadline = deadline
+        # set, if a route section failed, so the other sections of the request stop early
+        self.section_stop_event = threading.Event()
+        # the temp routing table is only available on the primary
+        self.selected_db = DBControl(
+                map_id, session_id, deadline=deadline,
+                use_primary=self.routing_engine == "temp_table")
         self.session_id = session_id
         self.translator = Translator(user_language)
-        self.poi = POI(map_id, session_id, user_language, prefer_translated_strings_in_osm_tags)
+        self.poi = POI(
+                map_id, session_id, user_language, prefer_translated_strings_in_osm_tags, deadline)
         self.routing_table_name = Config().database.get("routing_table")
         self.temp_routing_table_name = "tmp_routing_%s" \
                 % re.sub(r'[^a-zA-Z0-9]', '', self.session_id)
+        # boundary box of the current route section
+        self.boundaries = {}
+        # per route section: osm way id -> way class (None, if not part of the routing graph)
+        # and intersection node id -> number of street and impassable ways
+        self.way_class_by_osm_id = {}
+        self.important_intersection_cache = {}
         # way class weights
         self.way_class_id_and_weight_map = {}
         for way_class in constants.supported_way_class_list:
@@ -49,12 +83,21 @@ class PedestrianRoute:
             except Exception:
                 weight = 0.0
             finally:
+                # the weights become part of the routing sql query, so only accept finite numbers
+                if type(weight) not in [int, float] \
+                        or not math.isfinite(weight):
+                    weight = 0.0
                 if weight == 0.0:
                     # set to default
                     weight = 1.0
+                weight = min(weight, constants.max_way_class_weight)
             # add to map
-            self.way_class_id_and_weight_map[way_class_id] = weight
+            self.way_class_id_and_weight_map[way_class_id] = float(weight)
         logging.info(self.way_class_id_and_weight_map)
+        # weights <= 0 make a way class impassable
+        positive_weight_list = [ weight for weight in self.way_class_id_and_weight_map.values() if weight > 0 ]
+        self.min_weight = min(positive_weight_list, default=1.0)
+        self.max_weight = max(positive_weight_list, default=1.0)
         # exclude the following way ids from routing
         self.way_ids_to_exclude = []
         if type(way_ids_to_exclude) is list:
@@ -62,6 +105,14 @@ class PedestrianRoute:
                 if type(way_id) is int:
                     self.way_ids_to_exclude.append(way_id)
         logging.info("exclude: {}".format(self.way_ids_to_exclude))
+        # in-memory routing graph and the weights and blocked ways of this request
+        self.routing_graph = self.routing_overlay = None
+        if self.routing_engine == "graph":
+            self.routing_graph = RoutingGraph.get_routing_graph(map_id)
+            self.routing_overlay = RoutingGraph.RoutingOverlay(
+                    self.routing_graph,
+                    RoutingGraph.create_weight_list(self.way_class_id_and_weight_map),
+                    self.way_ids_to_exclude)
 
 
     def calculate_route(self, point_list):
@@ -82,10 +133,57 @@ class PedestrianRoute:
         if len(point_list) < 2:
             raise WebserverException(ReturnCode.START_OR_DESTINATION_MISSING)
 
-        # calculate route sections
+        # route cache
+        cache_key = None
+        if RouteCache.is_enabled():
+            cache_key = RouteCache.create_key(
+                    self.map_id, point_list, self.way_class_id_and_weight_map,
+                    self.way_ids_to_exclude, self.user_language,
+                    self.prefer_translated_strings_in_osm_tags, self.routing_algorithm)
+            # a rebuilt map invalidates the cached routes, it's detected within the check interval
+            self.selected_db.map_database.check_map_created_if_due()
+            map_created = self.selected_db.map_created
+            cached_route = RouteCache.get(cache_key, map_created)
+            if cached_route:
+                logging.info("route from cache")
+                # the key rounds the coordinates, so the requested points get their exact ones back
+                route = cached_route['route']
+                for route_index, point_index in cached_route['route_point_index_list']:
+                    route[route_index]['lat'] = point_list[point_index]['lat']
+                    route[route_index]['lon'] = point_list[point_index]['lon']
+                statistics.add_to_access_statistics(self.selected_db, self.session_id)
+                return route
+
+        # calculate the route sections concurrently
+        section_point_list = list(zip(point_list, point_list[1:]))
+        if len(section_point_list) == 1:
+            section_list = [ self.calculate_isolated_route_section(0, *section_point_list[0]) ]
+        else:
+            executor = PedestrianRoute.get_section_executor()
+            future_list = [ executor.submit(self.calculate_isolated_route_section, index, start, dest) \
+                            for index, (start, dest) in enumerate(section_point_list) ]
+            try:
+                # the first failed section fails the route, without waiting for the slower ones
+                done = concurrent.futures.wait(
+                        future_list, return_when=concurrent.futures.FIRST_EXCEPTION).done
+                for future in future_list:
+                    if future in done and future.exception():
+                        future.result()
+                section_list = [ future.result() for future in future_list ]
+            except BaseException as e:
+                # don't start the remaining sections and stop the running ones: they check the
+                # stop event and their database queries are cancelled
+                for future in future_list:
+                    future.cancel()
+                self.section_stop_event.set()
+                DBControl.cancel_queries_of_session(self.session_id)
+                # they must not outlive the request, which still owns the session and its temp tables
+                concurrent.futures.wait(future_list)
+                raise
+
+        # stitch route sections
         route = []
-        for i in range(1, len(point_list)):
-            section = self.calculate_route_section(point_list[i-1], point_list[i])
+        for i, section in enumerate(section_list, 1):
             # some via point corrections
             if route:
                 # prevent via point duplication
@@ -107,15 +205,53 @@ class PedestrianRoute:
                 except (IndexError, KeyError):
                     route[i]['turn'] = -1
         logging.debug(json.dumps(route, indent=4))
+        if cache_key:
+            # the route sections contain the requested point dicts themselves
+            point_index_by_id = { id(point) : index for index, point in enumerate(point_list) }
+            RouteCache.put(
+                    cache_key, map_created,
+                    {   "route" : route,
+                        "route_point_index_list" : [
+                            [ route_index, point_index_by_id[id(route[route_index])] ] \
+                            for route_index in range(0, len(route), 2) \
+                            if id(route[route_index]) in point_index_by_id ] })
 
         # add to access statistics and return
         statistics.add_to_access_statistics(self.selected_db, self.session_id)
         return route
 
 
+    @staticmethod
+    def get_section_executor():
+        with PedestrianRoute.section_executor_lock:
+            if not PedestrianRoute.section_executor:
+                PedestrianRoute.section_executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=Config().webserver.get("route_section_workers"),
+                        thread_name_prefix="route_section")
+            return PedestrianRoute.section_executor
+
+    def check_cancel_state(self):
+        if Config().has_session_id_to_remove(self.session_id) \
+                or self.section_stop_event.is_set():
+            raise WebserverException(ReturnCode.CANCELLED_BY_CLIENT)
+
+    def calculate_isolated_route_section(self, section_index, start_point, dest_point):
+        """
+        Runs calculate_route_section on a copy of this route with its own poi
+        caches and temp routing table, so sections can be calculated in parallel.
+        The routing graph, the db handle and the request params are shared.
+        """
+        section_route = copy.copy(self)
+        section_route.poi = POI(
+                self.map_id, self.session_id, self.user_language,
+                self.prefer_translated_strings_in_osm_tags, self.deadline)
+        section_route.temp_routing_table_name = "%s_%d" % (self.temp_routing_table_name, section_index)
+        try:
+            return section_route.calculate_route_section(start_point, dest_point)
+        finally:
+            section_route.delete_temp_routing_database()
+
     def calculate_route_section(self, start_point, dest_point):
-        # temp routing database table
-        #
         # prepare
         minimum_radius = 750        # in meters
         distance_between_start_and_destination = geometry.distance_between_two_points(
@@ -132,386 +268,236 @@ class PedestrianRoute:
         boundaries = geometry.get_boundary_box(center_point['lat'], center_point['lon'],
                 minimum_radius + int(distance_between_start_and_destination / 2))
 
-        # delete old table if it exists
-        self.delete_temp_routing_database()
-        # create
-        self.selected_db.edit_database(
-                sql.SQL(
-                    """
-                    CREATE TABLE {i_temp_routing_table} AS
-                        SELECT * FROM {i_routing_table} LIMIT 0
-                    """
-                    ).format(
-                        i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
-                        i_routing_table=sql.Identifier(self.routing_table_name)))
-        # fill
-        self.selected_db.edit_database(
-                sql.SQL(
-                    """
-                    INSERT INTO {i_temp_routing_table}
-                        SELECT * from {i_routing_table}
-                        WHERE geom_way && ST_MakeEnvelope(
-                                {p_b_left}, {p_b_bottom}, {p_b_right}, {p_b_top})
-                    """
-                    ).format(
-                        i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
-                        i_routing_table=sql.Identifier(self.routing_table_name),
-                        p_b_left=sql.Placeholder(name='b_left'),
-                        p_b_bottom=sql.Placeholder(name='b_bottom'),
-                        p_b_right=sql.Placeholder(name='b_right'),
-                        p_b_top=sql.Placeholder(name='b_top')),
-                    {'b_left':boundaries['left'], 'b_bottom':boundaries['bottom'],
-                        'b_right':boundaries['right'], 'b_top':boundaries['top']})
-
-        # update routing table cost column
-        for way_class_id, weight in self.way_class_id_and_weight_map.items():
-            self.selected_db.edit_database(
-                    sql.SQL(
-                        """
-                        UPDATE {i_temp_routing_table}
-                            SET cost = km * {p_weight}
-                            WHERE kmh = {p_way_class_id}
-                        """
-                        ).format(
-                            i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
-                            p_weight=sql.Placeholder(name='weight'),
-                            p_way_class_id=sql.Placeholder(name='way_class_id')),
-                        {'weight':weight, "way_class_id":way_class_id})
-        # ways to be excluded from routing
-        if self.way_ids_to_exclude:
-            self.selected_db.edit_database(
-                    sql.SQL(
-                        """
-                        UPDATE {i_temp_routing_table}
-                            SET cost = -1
-                            WHERE osm_id = ANY({p_way_id_list})
-                        """
-                        ).format(
-                            i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
-                            p_way_id_list=sql.Placeholder(name='way_id_list')),
-                        {'way_id_list':self.way_ids_to_exclude})
-        # column index
-        self.selected_db.edit_database(
-                sql.SQL(
-                    """
-                    ALTER TABLE ONLY {i_temp_routing_table}
-                        ADD CONSTRAINT {i_primary_key} PRIMARY KEY (id);
-                    CREATE INDEX {i_source_index} ON {i_temp_routing_table} USING btree (source);
-                    CREATE INDEX {i_target_index} ON {i_temp_routing_table} USING btree (target);
-                    CREATE INDEX {i_osm_source_id_index} ON {i_temp_routing_table} USING btree (osm_source_id);
-                    CREATE INDEX {i_osm_target_id_index} ON {i_temp_routing_table} USING btree (osm_target_id);
-                    CREATE INDEX {i_geom_way_index} ON {i_temp_routing_table} USING gist (geom_way);
-                    ALTER TABLE {i_temp_routing_table} CLUSTER ON {i_geom_way_index};
-                    SELECT recreate_vertex_of_routing_table({l_temp_routing_table});
-                    ANALYZE {i_temp_routing_table};
-                    """
-                    ).format(
-                        i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
-                        l_temp_routing_table=sql.Literal(self.temp_routing_table_name),
-                        i_primary_key=sql.Identifier("pkey_{}".format(self.temp_routing_table_name)),
-                        i_source_index=sql.Identifier("idx_{}_source".format(self.temp_routing_table_name)),
-                        i_target_index=sql.Identifier("idx_{}_target".format(self.temp_routing_table_name)),
-                        i_osm_source_id_index=sql.Identifier("idx_{}_osm_source_id".format(self.temp_routing_table_name)),
-                        i_osm_target_id_index=sql.Identifier("idx_{}_osm_target_id".format(self.temp_routing_table_name)),
-                        i_geom_way_index=sql.Identifier("idx_{}_geom_way".format(self.temp_routing_table_name))))
+        # the pgrouting engine works on the permanent routing table, restricted by the boundary box
+        self.boundaries = boundaries
+        self.way_class_by_osm_id = {}
+        self.important_intersection_cache = {}
+        if self.routing_engine == "temp_table":
+            self.create_temp_routing_table()
 
-        # check if table is empty
+        # check if the routing graph is empty
+        routing_table, routing_table_filter = self.get_routing_table_and_filter()
         try:
             self.selected_db.fetch_one(
                     sql.SQL(
                         """
-                        SELECT * FROM {i_temp_routing_table} LIMIT 1
+                        SELECT id FROM {i_routing_table} WHERE {c_filter} LIMIT 1
                         """
                         ).format(
-                            i_temp_routing_table=sql.Identifier(self.temp_routing_table_name)))
+                            i_routing_table=routing_table,
+                            c_filter=routing_table_filter),
+                    query_name="route_graph_not_empty")
         except DBControl.DatabaseResultEmptyError as e:
             raise WebserverException(ReturnCode.WRONG_MAP_SELECTED)
         else:
-            if Config().has_session_id_to_remove(self.session_id):
-                raise WebserverException(ReturnCode.CANCELLED_BY_CLIENT)
-
-        # get start and destination vertex
-        start_vertex_list = self.get_closest_vertex_list(start_point['lat'], start_point['lon'])
-        logging.info("{} / {} -- sv_list: {}".format(
-            start_point['lat'], start_point['lon'], start_vertex_list))
-        dest_vertex_list = self.get_closest_vertex_list(dest_point['lat'], dest_point['lon'])
-        logging.info("{} / {} -- dv_list: {}".format(
-            dest_point['lat'], dest_point['lon'], dest_vertex_list))
-        if Config().has_session_id_to_remove(self.session_id):
-            raise WebserverException(ReturnCode.CANCELLED_BY_CLIENT)
+            self.check_cancel_state()
+
+        # project start and destination onto the closest passable way
+        start_snap_point = self.snap_to_closest_edge(start_point['lat'], start_point['lon'])
+        logging.info("{} / {} -- start: {}".format(
+            start_point['lat'], start_point['lon'], start_snap_point))
+        dest_snap_point = self.snap_to_closest_edge(dest_point['lat'], dest_point['lon'])
+        logging.info("{} / {} -- destination: {}".format(
+            dest_point['lat'], dest_point['lon'], dest_snap_point))
+        self.check_cancel_state()
 
         # route calculation
-        best_route = None
-        max_vertex_list_length = min(
-                15, max(len(start_vertex_list), len(dest_vertex_list)))
-        for x in range(0, max_vertex_list_length):
-            for y in range(0, x+1):
-
-                def calculate(start_vertex_tuple, dest_vertex_tuple):
-                    result = self.selected_db.fetch_all(
-                            sql.SQL(
-                                """
-                                SELECT seq, node, edge, cost FROM pgr_dijkstra(
-                                    'SELECT id, source, target, cost from {i_temp_routing_table}',
-                                    {p_start_vertex}, {p_dest_vertex}, false)
-                                """
-                                ).format(
-                                    i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
-                                    p_start_vertex=sql.Placeholder(name='start_vertex'),
-                                    p_dest_vertex=sql.Placeholder(name='dest_vertex')),
-                                {   "start_vertex" : start_vertex_tuple.point_id,
-                                    "dest_vertex"  : dest_vertex_tuple.point_id })
-                    if result:
-                        return PedestrianRoute.RawRoute(
-                                result, start_vertex_tuple, dest_vertex_tuple)
-                    return None
-
-                if x < len(start_vertex_list) and y < len(dest_vertex_list):
-                    logging.info("{} / {}".format(x,y))
-                    best_route = calculate(
-                            start_vertex_list[x], dest_vertex_list[y])
-                    if best_route:
-                        break
-
-                if y < len(start_vertex_list) and x < len(dest_vertex_list) and x != y:
-                    logging.info("{} / {}".format(y,x))
-                    best_route = calculate(
-                            start_vertex_list[y], dest_vertex_list[x])
-                    if best_route:
-                        break
-
-                # cancel
-                if Config().has_session_id_to_remove(self.session_id):
-                    raise WebserverException(ReturnCode.CANCELLED_BY_CLIENT)
-
-            # outer loop, just break, if a route was found
-            else:
-                continue  # only executed if the inner loop did NOT break
-            break  # only executed if the inner loop DID break
+        # a single search between the virtual start and destination vertex at the projected points,
+        # which are connected to both end vertices of their edge
+        start_cost_map = self.get_snap_cost_map(start_snap_point)
+        dest_cost_map = self.get_snap_cost_map(dest_snap_point)
+        # blocked and impassable ways are penalized instead of removed, so the same search
+        # tells, whether a route would exist without them
+        penalty = RoutingGraph.ignored_edge_penalty * self.max_weight
+        vertex_id_list = edge_id_list = None
+        total_cost = math.inf
+        uses_ignored_edges = False
 
-        # error handling
-        if not best_route:
+        if self.routing_graph:
+            path = self.routing_graph.find_path_between_candidates(
+                    start_cost_map, dest_cost_map, self.routing_overlay, self.boundaries,
+                    self.routing_algorithm, penalty)
+            logging.info("{}: {} settled vertices".format(
+                self.routing_algorithm, path.number_of_settled_vertices if path else "-"))
+            if path:
+                vertex_id_list, edge_id_list = path.vertex_id_list, path.edge_id_list
+                total_cost = start_cost_map[vertex_id_list[0]] + path.cost + dest_cost_map[vertex_id_list[-1]]
+                uses_ignored_edges = path.number_of_ignored_edges > 0
+
+        else:
             result = self.selected_db.fetch_all(
-                    sql.SQL(
-                        """
-                        SELECT seq, node, edge, cost FROM pgr_dijkstra(
-                            'SELECT id, source, target, km AS cost from {i_temp_routing_table}',
-                            {p_start_vertex}, {p_dest_vertex}, false)
-                        """
-                        ).format(
-                            i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
-                            p_start_vertex=sql.Placeholder(name='start_vertex'),
-                            p_dest_vertex=sql.Placeholder(name='dest_vertex')),
-                        {   "start_vertex" : start_vertex_list[0].point_id,
-                            "dest_vertex"  : dest_vertex_list[0].point_id })
+                    self.get_path_query(
+                        sql.SQL("{c_edges_query} UNION ALL {c_virtual_edges_query}").format(
+                            c_edges_query=self.get_edges_query(penalty),
+                            c_virtual_edges_query=self.get_virtual_edges_query(
+                                start_snap_point, start_cost_map, dest_snap_point, dest_cost_map))),
+                    { "start_vertex" : -1, "dest_vertex" : -2 },
+                    query_name="route_{}".format(self.routing_algorithm))
             if result:
-                raise WebserverException(ReturnCode.TOO_MANY_WAY_CLASSES_IGNORED)
-            else:
-                raise WebserverException(ReturnCode.NO_ROUTE_BETWEEN_START_AND_DESTINATION)
+                # skip the virtual vertices and edges (negative ids)
+                vertex_id_list = [ row['node'] for row in result if row['node'] >= 0 ]
+                edge_id_list = [ row['edge'] for row in result if row['node'] >= 0 and row['edge'] >= 0 ]
+                total_cost = sum([ row['cost'] for row in result ])
+                uses_ignored_edges = len(
+                        [ row for row in result if row['edge'] >= 0 and row['cost'] >= penalty ]) > 0
 
-        route = []
-        last_target_id = -1
-        reverse = False
-        for r in best_route.route:
-            if r['edge'] == -1:
-                continue
-            part = self.selected_db.fetch_one(
-                    sql.SQL(
-                        """
-                        SELECT * FROM {i_temp_routing_table} WHERE id={p_edge}
-                        """
-                        ).format(
-                            i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
-                            p_edge=sql.Placeholder(name='edge')),
-                        {"edge" : r['edge']})
+        # start and destination on the same edge: maybe the direct way between them is shorter
+        direct_cost = None
+        if start_snap_point.edge_id == dest_snap_point.edge_id:
+            direct_cost = abs(dest_snap_point.fraction - start_snap_point.fraction) \
+                    * start_snap_point.km * self.get_weight(start_snap_point.way_class)
+        use_direct_way = direct_cost is not None and direct_cost <= total_cost
+        if use_direct_way:
+            edge_id_list = []
+        elif not vertex_id_list:
+            raise WebserverException(ReturnCode.NO_ROUTE_BETWEEN_START_AND_DESTINATION)
+        elif uses_ignored_edges:
+            raise WebserverException(ReturnCode.TOO_MANY_WAY_CLASSES_IGNORED)
+        self.check_cancel_state()
+
+        # fetch all route edges at once, including their geometry
+        edge_dict = self.selected_db.fetch_by_ids(
+                sql.SQL(
+                    """
+                    SELECT id, osm_id, osm_source_id, osm_target_id, source, target, kmh,
+                            ST_AsBinary(geom_way) AS geom_way
+                        FROM {i_routing_table}
+                        WHERE id = ANY({p_id_list})
+                    """
+                    ).format(
+                        i_routing_table=routing_table,
+                        p_id_list=sql.Placeholder(name='id_list')),
+                "id",
+                list(set(edge_id_list + [ start_snap_point.edge_id, dest_snap_point.edge_id ])),
+                query_name="route_edges")
+
+        # edge parts: edge id, start and end fraction, where 0 is the source and 1 the target vertex
+        if use_direct_way:
+            edge_part_list = [
+                    (start_snap_point.edge_id, start_snap_point.fraction, dest_snap_point.fraction) ]
+        else:
+            edge_part_list = []
+            vertex_id = vertex_id_list[0]
+            # from the projected start point to the first vertex
+            edge_part_list.append(
+                    (   start_snap_point.edge_id,
+                        start_snap_point.fraction,
+                        0.0 if edge_dict[start_snap_point.edge_id]['source'] == vertex_id else 1.0))
+            for edge_id in edge_id_list:
+                if edge_dict[edge_id]['source'] == vertex_id:
+                    edge_part_list.append((edge_id, 0.0, 1.0))
+                    vertex_id = edge_dict[edge_id]['target']
+                else:
+                    edge_part_list.append((edge_id, 1.0, 0.0))
+                    vertex_id = edge_dict[edge_id]['source']
+            # from the last vertex to the projected destination point
+            edge_part_list.append(
+                    (   dest_snap_point.edge_id,
+                        0.0 if edge_dict[dest_snap_point.edge_id]['source'] == vertex_id else 1.0,
+                        dest_snap_point.fraction))
+            # drop empty parts at the ends, if a point was projected exactly onto a vertex
+            if edge_part_list[0][1] == edge_part_list[0][2]:
+                del edge_part_list[0]
+            if len(edge_part_list) > 1 and edge_part_list[-1][1] == edge_part_list[-1][2]:
+                del edge_part_list[-1]
+
+        # load the route points and way segments of all edge parts at once
+        osm_node_id_list = []
+        for edge_id, start_fraction, end_fraction in edge_part_list:
+            for fraction in (start_fraction, end_fraction):
+                if fraction == 0.0:
+                    osm_node_id_list.append(edge_dict[edge_id]['osm_source_id'])
+                elif fraction == 1.0:
+                    osm_node_id_list.append(edge_dict[edge_id]['osm_target_id'])
+        self.poi.prefetch_route_objects(
+                osm_node_id_list,
+                [ edge_dict[edge_id]['osm_id'] for edge_id, _, _ in edge_part_list ])
+        # way classes of the route ways and all ways at the route intersections
+        for part in edge_dict.values():
+            self.way_class_by_osm_id.setdefault(part['osm_id'], part['kmh'])
+        self.load_way_classes(
+                [ street['way_id'] \
+                    for street_list in self.poi.intersection_data_cache.values() for street in street_list ])
+
+        # geometries of all edge parts in a single flat coordinate array: lon1, lat1, lon2, lat2, ...
+        # edge part n covers the points part_offset[n] to part_offset[n+1]-1
+        route_coordinates = array('d')
+        part_offset = [0]
+        for edge_id, start_fraction, end_fraction in edge_part_list:
+            route_coordinates.extend(
+                    geometry.get_line_substring(
+                        geometry.decode_wkb(edge_dict[edge_id]['geom_way']), start_fraction, end_fraction))
+            part_offset.append(len(route_coordinates) // 2)
+        # bearing from point i to i+1, the ones between two parts are unused
+        bearing_list = geometry.get_bearing_list(route_coordinates)
+
+        route = PedestrianRoute.RouteBuilder(self)
+        for part_index, (edge_id, start_fraction, end_fraction) in enumerate(edge_part_list):
+            part = edge_dict.get(edge_id)
+            reverse = start_fraction > end_fraction
 
-            # exception for the first route segment
             # add start point of route first
-            if part['source'] == best_route.start_vertex_tuple.point_id:
-                logging.info("start point added")
-                # check if current point is an intersection
-                next_point = self.poi.create_intersection_by_id(part['osm_source_id'])
-                if not next_point:
-                    next_point = self.poi.create_way_point_by_id(part['osm_source_id'])
-                route.append(next_point)
-                last_target_id = part['source']
-            elif part['target'] == best_route.start_vertex_tuple.point_id:
-                logging.info("target point added")
-                # check if current point is an intersection
-                next_point = self.poi.create_intersection_by_id(part['osm_target_id'])
-                if not next_point:
-                    next_point = self.poi.create_way_point_by_id(part['osm_target_id'])
-                route.append(next_point)
-                last_target_id = part['target']
+            if not route.point_list:
+                route.add_point(
+                        self.create_point_on_edge(part, start_fraction, start_snap_point), None)
 
             # create next point
-            if last_target_id == part['source']:
-                next_point = self.poi.create_intersection_by_id(part['osm_target_id'])
-                if not next_point:
-                    next_point = self.poi.create_way_point_by_id(part['osm_target_id'])
-                reverse = False
-                last_target_id = part['target']
-            else:
-                next_point = self.poi.create_intersection_by_id(part['osm_source_id'])
-                if not next_point:
-                    next_point = self.poi.create_way_point_by_id(part['osm_source_id'])
-                reverse = True
-                last_target_id = part['source']
+            next_point = self.create_point_on_edge(part, end_fraction, dest_snap_point)
 
             # create next segment
             next_segment = self.poi.create_way_segment_by_id(part['osm_id'], reverse )
             next_segment['way_class'] = part['kmh']
 
-            # extract points of a curved graph edge
-            coordinates_list = self.selected_db.fetch_all(
-                    sql.SQL(
-                        """
-                        SELECT ST_Y(geom) AS lat, ST_X(geom) AS lon
-                        FROM (
-                            SELECT ST_PointN(geom_way, generate_series(1, ST_NPoints(geom_way))) AS geom
-                            FROM {i_temp_routing_table}
-                            WHERE id = {p_routing_table_id}) AS points
-                        """
-                        ).format(
-                            i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
-                            p_routing_table_id=sql.Placeholder(name='routing_table_id')),
-                        {"routing_table_id":part['id']})
-            if reverse:
-                coordinates_list = coordinates_list[::-1]
-
-            # get relevant points
+            # keep the inner points of a curved graph edge, where the way turns by more
+            # than 22 degrees compared to the last kept point
             next_point_list = []
-            last_accepted_bearing = geometry.bearing_between_two_points(
-                        coordinates_list[0]['lat'], coordinates_list[0]['lon'],
-                        coordinates_list[1]['lat'], coordinates_list[1]['lon'])
-            for i in range(1, len(coordinates_list)-1):
-                new_bearing = geometry.bearing_between_two_points(
-                        coordinates_list[i]['lat'], coordinates_list[i]['lon'],
-                        coordinates_list[i+1]['lat'], coordinates_list[i+1]['lon'])
-                turn = geometry.turn_between_two_segments(
-                        new_bearing, last_accepted_bearing)
+            first_point, last_point = part_offset[part_index], part_offset[part_index+1] - 1
+            last_accepted_bearing = bearing_list[first_point]
+            for i in range(first_point + 1, last_point):
+                turn = bearing_list[i] - last_accepted_bearing
+                if turn < 0:
+                    turn += 360
                 if turn > 22 and turn < 338:
-                    last_accepted_bearing = new_bearing
+                    last_accepted_bearing = bearing_list[i]
                     next_point_list.append(
                             self.poi.create_way_point(
-                                -1, coordinates_list[i]['lat'], coordinates_list[i]['lon'], {}))
+                                -1, route_coordinates[2*i+1], route_coordinates[2*i], {}))
             next_point_list.append(next_point)
 
-            # add next points to route
+            # add next points to route, they share the segment dict
             for point in next_point_list:
-                route = self.add_point_to_route(route, point, next_segment.copy())
+                route.add_point(point, next_segment)
             # check cancel state
-            if Config().has_session_id_to_remove(self.session_id):
-                raise WebserverException(ReturnCode.CANCELLED_BY_CLIENT)
+            self.check_cancel_state()
 
         # add start point
-        first_segment = None
+        # the route begins at the projection of the start point onto the closest way,
+        # so a remaining gap is the way from the start point to this way
+        first_point = route.point_list[0]
         distance_start_p0 = geometry.distance_between_two_points(
-                start_point['lat'], start_point['lon'], route[0]['lat'], route[0]['lon'])
-        bearing_start_p0 = geometry.bearing_between_two_points(
-                start_point['lat'], start_point['lon'], route[0]['lat'], route[0]['lon'])
-        turn = geometry.turn_between_two_segments(route[1]['bearing'], bearing_start_p0)
-        logging.info("start: turn = %d, distance = %d" % (turn, distance_start_p0))
-        if distance_start_p0 <= 5:
-            route[0] = start_point
-        elif best_route.start_vertex_tuple.way_distance <= 5 \
-                or (best_route.start_vertex_tuple.way_class in [1,2] and best_route.start_vertex_tuple.way_distance <= 15):
-            if turn >= 158 and turn <= 202:
-                route[1]['distance'] -= distance_start_p0
-                route[0] = start_point
-            elif not self.important_intersection(route[0]) \
-                    and (turn <= 22 or turn >= 338):
-                route[1]['distance'] += distance_start_p0
-                route[0] = start_point
-            else:
-                first_segment = self.poi.create_way_segment_by_id(
-                        best_route.start_vertex_tuple.way_id)
+                start_point['lat'], start_point['lon'], first_point['lat'], first_point['lon'])
+        logging.info("start: distance = %d" % distance_start_p0)
+        if distance_start_p0 <= 5 or len(route.point_list) < 2:
+            route.point_list[0] = start_point
         else:
             first_segment = {"name":self.translator.translate("footway_creator", "first_segment"),
                     "type":"footway", "sub_type":"", "way_id":-1, "pois":[]}
-        # add first way segment
-        if first_segment:
-            route[0]['turn'] = turn
-            first_segment = geometry.add_bearing_and_distance_to_segment(
-                    first_segment,
-                    start_point['lat'], start_point['lon'],
-                    route[0]['lat'], route[0]['lon'])
-            first_segment['type'] = "footway_route"
-            route.insert(0, first_segment)
-            route.insert(0, start_point)
+            route.insert_first_point(start_point, first_segment)
 
         # destination point
+        last_point = route.point_list[-1]
         distance_plast_dest = geometry.distance_between_two_points(
-                route[-1]['lat'], route[-1]['lon'], dest_point['lat'], dest_point['lon'])
-        bearing_plast_dest = geometry.bearing_between_two_points(
-                route[-1]['lat'], route[-1]['lon'], dest_point['lat'], dest_point['lon'])
-        turn = geometry.turn_between_two_segments(bearing_plast_dest, route[-2]['bearing'])
-        logging.info("destination: turn = %d, distance = %d" % (turn, distance_plast_dest))
+                last_point['lat'], last_point['lon'], dest_point['lat'], dest_point['lon'])
+        logging.info("destination: distance = %d" % distance_plast_dest)
         if distance_plast_dest <= 5:
-            route[-1] = dest_point
-        elif best_route.dest_vertex_tuple.way_distance <= 5 \
-                or (best_route.dest_vertex_tuple.way_class in [1,2] and best_route.dest_vertex_tuple.way_distance <= 15):
-            if turn >= 158 and turn <= 202:
-                # turn around
-                route[-2]['distance'] -= distance_plast_dest
-                route[-1] = dest_point
-            elif not self.important_intersection(route[-1]) \
-                    and (turn <= 22 or turn >= 338):
-                # streight ahead
-                route[-2]['distance'] += distance_plast_dest
-                route[-1] = dest_point
-            else:
-                dest_segment = self.poi.create_way_segment_by_id(
-                        best_route.dest_vertex_tuple.way_id)
-                route = self.add_point_to_route(route, dest_point, dest_segment.copy())
+            route.point_list[-1] = dest_point
         else:
             dest_segment = {"name":self.translator.translate("footway_creator", "last_segment"),
                     "type":"footway", "sub_type":"", "way_id":-1, "pois":[]}
-            route = self.add_point_to_route(route, dest_point, dest_segment.copy())
-
-        # part of route parameters
-        for i in range(0, len(route), 2):
-            if route[i].get("type") == "intersection":
-                intersection = route[i]
-                # previous route segment
-                minimal_bearing_difference_previous = 180
-                index_of_previous = -1
-                bearing_of_previous_route_segment = None
-                if (i-1) > 0 \
-                        and route[i-1].get("bearing"):
-                    bearing_of_previous_route_segment = route[i-1].get("bearing")
-                # next route segment
-                minimal_bearing_difference_next = 180
-                index_of_next = -1
-                bearing_of_next_route_segment = None
-                if (i+1) < len(route) \
-                        and route[i+1].get("bearing"):
-                    bearing_of_next_route_segment = route[i+1].get("bearing")
-                # walk through the intersection segment list
-                for index, intersection_segment in enumerate(intersection.get("way_list")):
-                    if bearing_of_previous_route_segment:
-                        bearing_difference_previous = geometry.bearing_difference_between_two_segments(
-                                (bearing_of_previous_route_segment + 180) % 360,
-                                intersection_segment.get("bearing"))
-                        if bearing_difference_previous < minimal_bearing_difference_previous:
-                            minimal_bearing_difference_previous = bearing_difference_previous
-                            index_of_previous = index
-                    if bearing_of_next_route_segment:
-                        bearing_difference_next = geometry.bearing_difference_between_two_segments(
-                                bearing_of_next_route_segment,
-                                intersection_segment.get("bearing"))
-                        if bearing_difference_next < minimal_bearing_difference_next:
-                            minimal_bearing_difference_next = bearing_difference_next
-                            index_of_next = index
-                # set values if available and reset in route
-                if index_of_previous > -1:
-                    intersection['way_list'][index_of_previous]['part_of_previous_route_segment'] = True
-                if index_of_next > -1:
-                    intersection['way_list'][index_of_next]['part_of_next_route_segment'] = True
-                route[i] = intersection
+            route.add_point(dest_point, dest_segment)
 
         # return route section
-        return route
+        return route.to_list()
 
 
 ### hiking trails begin
@@ -587,7 +573,104 @@ class PedestrianRoute:
                     % (route_length, number_of_intersections)
 
 
+    #####
+    # routing table
+    #####
+
+    def create_temp_routing_table(self):
+        """ legacy routing engine: temporary routing table of the current boundary box """
+        # delete old table if it exists
+        self.delete_temp_routing_database()
+        # create
+        self.selected_db.edit_database(
+                sql.SQL(
+                    """
+                    CREATE TABLE {i_temp_routing_table} AS
+                        SELECT * FROM {i_routing_table} LIMIT 0
+                    """
+                    ).format(
+                        i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
+                        i_routing_table=sql.Identifier(self.routing_table_name)),
+                query_name="route_create_temp_table")
+        # fill
+        self.selected_db.edit_database(
+                sql.SQL(
+                    """
+                    INSERT INTO {i_temp_routing_table}
+                        SELECT * from {i_routing_table}
+                        WHERE geom_way && ST_MakeEnvelope(
+                                {p_b_left}, {p_b_bottom}, {p_b_right}, {p_b_top})
+                    """
+                    ).format(
+                        i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
+                        i_routing_table=sql.Identifier(self.routing_table_name),
+                        p_b_left=sql.Placeholder(name='b_left'),
+                        p_b_bottom=sql.Placeholder(name='b_bottom'),
+                        p_b_right=sql.Placeholder(name='b_right'),
+                        p_b_top=sql.Placeholder(name='b_top')),
+                    {'b_left':self.boundaries['left'], 'b_bottom':self.boundaries['bottom'],
+                        'b_right':self.boundaries['right'], 'b_top':self.boundaries['top']},
+                query_name="route_fill_temp_table")
+
+        # update routing table cost column
+        for way_class_id, weight in self.way_class_id_and_weight_map.items():
+            self.selected_db.edit_database(
+                    sql.SQL(
+                        """
+                        UPDATE {i_temp_routing_table}
+                            SET cost = km * {p_weight}
+                            WHERE kmh = {p_way_class_id}
+                        """
+                        ).format(
+                            i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
+                            p_weight=sql.Placeholder(name='weight'),
+                            p_way_class_id=sql.Placeholder(name='way_class_id')),
+                        {'weight':weight, "way_class_id":way_class_id},
+                    query_name="route_update_way_class_cost")
+        # ways to be excluded from routing
+        if self.way_ids_to_exclude:
+            self.selected_db.edit_database(
+                    sql.SQL(
+                        """
+                        UPDATE {i_temp_routing_table}
+                            SET cost = -1
+                            WHERE osm_id = ANY({p_way_id_list})
+                        """
+                        ).format(
+                            i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
+                            p_way_id_list=sql.Placeholder(name='way_id_list')),
+                        {'way_id_list':self.way_ids_to_exclude},
+                    query_name="route_block_ways")
+        # renumber the vertices before the indexes exist, so the update doesn't have to maintain them
+        # then add the column indexes
+        self.selected_db.edit_database(
+                sql.SQL(
+                    """
+                    SELECT recreate_vertex_of_routing_table({l_temp_routing_table});
+                    ALTER TABLE ONLY {i_temp_routing_table}
+                        ADD CONSTRAINT {i_primary_key} PRIMARY KEY (id);
+                    CREATE INDEX {i_source_index} ON {i_temp_routing_table} USING btree (source);
+                    CREATE INDEX {i_target_index} ON {i_temp_routing_table} USING btree (target);
+                    CREATE INDEX {i_osm_source_id_index} ON {i_temp_routing_table} USING btree (osm_source_id);
+                    CREATE INDEX {i_osm_target_id_index} ON {i_temp_routing_table} USING btree (osm_target_id);
+                    CREATE INDEX {i_geom_way_index} ON {i_temp_routing_table} USING gist (geom_way);
+                    ALTER TABLE {i_temp_routing_table} CLUSTER ON {i_geom_way_index};
+                    ANALYZE {i_temp_routing_table};
+                    """
+                    ).format(
+                        i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
+                        l_temp_routing_table=sql.Literal(self.temp_routing_table_name),
+                        i_primary_key=sql.Identifier("pkey_{}".format(self.temp_routing_table_name)),
+                        i_source_index=sql.Identifier("idx_{}_source".format(self.temp_routing_table_name)),
+                        i_target_index=sql.Identifier("idx_{}_target".format(self.temp_routing_table_name)),
+                        i_osm_source_id_index=sql.Identifier("idx_{}_osm_source_id".format(self.temp_routing_table_name)),
+                        i_osm_target_id_index=sql.Identifier("idx_{}_osm_target_id".format(self.temp_routing_table_name)),
+                        i_geom_way_index=sql.Identifier("idx_{}_geom_way".format(self.temp_routing_table_name))),
+                query_name="route_temp_table_indexes")
+
     def delete_temp_routing_database(self):
+        if self.routing_engine != "temp_table":
+            return
         try:
             self.selected_db.edit_database(
                     sql.SQL(
@@ -595,150 +678,247 @@ class PedestrianRoute:
                         DROP TABLE IF EXISTS {i_temp_routing_table}
                         """
                         ).format(
-                            i_temp_routing_table=sql.Identifier(self.temp_routing_table_name)))
+                            i_temp_routing_table=sql.Identifier(self.temp_routing_table_name)),
+                    query_name="route_drop_temp_table")
         except DBControl.DatabaseError as e:
             pass
 
-
-    def get_closest_vertex_list(self, lat, lon):
-        tuple_list = []
-        # get closest edges from graph
-        edge_list = self.selected_db.fetch_all(
+    def get_routing_table_and_filter(self):
+        """
+        Routing table and where clause, which restrict the graph to the
+        boundary box of the current route section.
+        """
+        if self.routing_engine == "temp_table":
+            return sql.Identifier(self.temp_routing_table_name), sql.SQL("TRUE")
+        return (
+                sql.Identifier(self.routing_table_name),
                 sql.SQL(
-                    """
-                    SELECT id, osm_id, osm_name, osm_source_id, osm_target_id,
-                            source, target, kmh as type, x1, y1, x2, y2,
-                            ST_Distance(geom_way::geography, 'POINT({p_lon} {p_lat})'::geography) as way_distance
-                        FROM {i_temp_routing_table}
-                        WHERE kmh != 7
-                        ORDER BY ST_Distance(geom_way::geography, 'POINT({p_lon} {p_lat})'::geography)
-                        LIMIT 20
-                    """
+                    "geom_way && ST_MakeEnvelope({l_left}, {l_bottom}, {l_right}, {l_top})"
                     ).format(
-                        i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
-                        p_lon=sql.Placeholder(name='lon'),
-                        p_lat=sql.Placeholder(name='lat')),
-                    {"lat":lat, "lon":lon})
-        # insert into tuple vertex_list
-        for edge in edge_list:
-            # check, if source or target vertex of found edge is closer
-            source_dist = geometry.distance_between_two_points_as_float(
-                    edge['y1'], edge['x1'], lat, lon)
-            target_dist = geometry.distance_between_two_points_as_float(
-                    edge['y2'], edge['x2'], lat, lon)
-            if source_dist < target_dist:
-                tuple_list.append(
-                        PedestrianRoute.VertexTuple(
-                            edge['source'], source_dist, edge['osm_id'],
-                            edge['type'], edge['way_distance'], edge['osm_name']))
-            else:
-                tuple_list.append(
-                        PedestrianRoute.VertexTuple(
-                            edge['target'], target_dist, edge['osm_id'], 
-                            edge['type'], edge['way_distance'], edge['osm_name']))
-        return tuple_list
+                        l_left=sql.Literal(self.boundaries['left']),
+                        l_bottom=sql.Literal(self.boundaries['bottom']),
+                        l_right=sql.Literal(self.boundaries['right']),
+                        l_top=sql.Literal(self.boundaries['top'])))
 
+    def get_edges_query(self, penalty=None):
+        """
+        Edge query for pgr_dijkstra. By default the cost is computed on the fly
+        from the way class weights and the blocked ways. The temp table mode
+        uses its precomputed cost column instead.
 
-    def add_point_to_route(self, route, next_point, next_segment, add_all_intersections=False):
-        # calculate distance and bearing of new segment
-        try:
-            next_segment = geometry.add_bearing_and_distance_to_segment(
-                    next_segment,
-                    route[-1]['lat'], route[-1]['lon'],
-                    next_point['lat'], next_point['lon'])
-            if next_segment['distance'] == 0 and next_point['type'] == "intersection":
-                # replace last point
-                route[-1] = next_point
-                return route
-        except IndexError as e:
-            # if the route is still empty, add the next route point and exit
-            route.append(next_point)
-            return route
-        # try to find and delete unimportant intersections and way points
-        try:
-            turn = geometry.turn_between_two_segments(
-                    next_segment['bearing'], route[-2]['bearing'])
-            if (not add_all_intersections \
-                        or (add_all_intersections and route[-1]['type'] != "intersection")) \
-                    and (turn <= 22 or turn >= 338) \
-                    and route[-2]['name'] == next_segment['name'] \
-                    and route[-2]['sub_type'] == next_segment['sub_type'] \
-                    and not self.important_intersection(route[-1], route[-2]):
-                # delete unimportant waypoint or intersection
-                del route[-2:]
-        except IndexError as e:
-            pass
-        # find and delete zigzag
-        try:
-            turn = geometry.turn_between_two_segments(
-                    next_segment['bearing'], route[-4]['bearing'])
-            if not add_all_intersections \
-                    and (turn <= 22 or turn >= 338) \
-                    and route[-2]['distance'] < 4 \
-                    and not self.important_intersection(route[-1], route[-2]) \
-                    and not self.important_intersection(route[-3], route[-4]):
-                del route[-4:]
-        except IndexError as e:
-            pass
-        # delete double train intersection but leave first of two intersections
-        try:
-            turn = geometry.turn_between_two_segments(
-                    next_segment['bearing'], route[-4]['bearing'])
-            if not add_all_intersections \
-                    and (turn <= 22 or turn >= 338) \
-                    and route[-2]['distance'] < 5 \
-                    and ( \
-                        self.translator.translate("railway", "tram") in route[-1]['name'] \
-                        or self.translator.translate("railway", "rail") in route[-1]['name'] \
-                        ) \
-                    and ( \
-                        self.translator.translate("railway", "tram") in route[-3]['name'] \
-                        or self.translator.translate("railway", "rail") in route[-3]['name'] \
-                        ):
-                del route[-2:]
-        except IndexError as e:
-            pass
-        # calculate the updated distance and bearing to the potentially new prev point
-        next_segment = geometry.add_bearing_and_distance_to_segment(
-                next_segment,
-                route[-1]['lat'], route[-1]['lon'],
-                next_point['lat'], next_point['lon'])
-        next_segment['type'] = "footway_route"
-        # update turn value
+        Blocked and impassable ways get a negative cost, which excludes them.
+        If a penalty is given, they cost their length plus the penalty instead.
+        """
+        routing_table, routing_table_filter = self.get_routing_table_and_filter()
+        if penalty is None:
+            ignored_cost_query = sql.SQL("-1")
+        else:
+            ignored_cost_query = sql.SQL("km + {l_penalty}").format(
+                    l_penalty=sql.Literal(penalty))
+        if self.routing_engine == "temp_table":
+            cost_query = sql.SQL("CASE WHEN cost < 0 THEN {c_ignored_cost_query} ELSE cost END").format(
+                    c_ignored_cost_query=ignored_cost_query)
+        else:
+            when_query_list = []
+            if self.way_ids_to_exclude:
+                when_query_list.append(
+                        sql.SQL("WHEN osm_id = ANY({l_way_id_list}) THEN {c_ignored_cost_query}").format(
+                            l_way_id_list=sql.Literal(self.way_ids_to_exclude),
+                            c_ignored_cost_query=ignored_cost_query))
+            for way_class_id, weight in self.way_class_id_and_weight_map.items():
+                if weight > 0:
+                    when_query_list.append(
+                            sql.SQL("WHEN kmh = {l_way_class_id} THEN km * {l_weight}").format(
+                                l_way_class_id=sql.Literal(way_class_id),
+                                l_weight=sql.Literal(weight)))
+            # impassable ways (class 7)
+            cost_query = sql.SQL("CASE {c_when_query_list} ELSE {c_ignored_cost_query} END").format(
+                    c_when_query_list=sql.SQL(" ").join(when_query_list),
+                    c_ignored_cost_query=ignored_cost_query)
+        # a* needs the vertex coordinates
+        return sql.SQL(
+                "SELECT id, source, target, {c_cost_query} AS cost{c_coordinates} FROM {i_routing_table} WHERE {c_filter}"
+                ).format(
+                    c_cost_query=cost_query,
+                    c_coordinates=sql.SQL(", x1, y1, x2, y2" if self.routing_algorithm == "astar" else ""),
+                    i_routing_table=routing_table,
+                    c_filter=routing_table_filter)
+
+    def get_virtual_edges_query(self, start_snap_point, start_cost_map, dest_snap_point, dest_cost_map):
+        """
+        Edges from the virtual start vertex -1 to the end vertices of the start
+        edge and from the end vertices of the destination edge to the virtual
+        destination vertex -2. Their cost is the cost along the edge to the
+        projected point, where the virtual vertex is placed.
+        """
+        value_list = []
+        def add_virtual_edge(source, target, cost, x1, y1, x2, y2):
+            value_list.append(
+                    sql.SQL("({})").format(
+                        sql.SQL(", ").join(
+                            [ sql.Literal(-1 - len(value_list)), sql.Literal(source), sql.Literal(target), sql.Literal(cost) ] \
+                            + ([ sql.Literal(x1), sql.Literal(y1), sql.Literal(x2), sql.Literal(y2) ] \
+                                if self.routing_algorithm == "astar" else []))))
+        for vertex_id, cost in start_cost_map.items():
+            x, y = start_snap_point.get_vertex_coordinates(vertex_id)
+            add_virtual_edge(-1, vertex_id, cost, start_snap_point.lon, start_snap_point.lat, x, y)
+        for vertex_id, cost in dest_cost_map.items():
+            x, y = dest_snap_point.get_vertex_coordinates(vertex_id)
+            add_virtual_edge(vertex_id, -2, cost, x, y, dest_snap_point.lon, dest_snap_point.lat)
+        return sql.SQL("SELECT * FROM (VALUES {c_value_list}) AS virtual_edges").format(
+                c_value_list=sql.SQL(", ").join(value_list))
+
+    def get_path_query(self, edges_query):
+        """
+        Path search for the selected routing algorithm. The start and destination
+        vertex are passed as start_vertex and dest_vertex params. The edge query
+        is passed as quoted string literal.
+
+        pgr_aStar measures the euclidean distance in degrees. Scaled by the
+        length of a degree of longitude at the latitude farthest from the equator
+        it's a lower bound of the great circle distance within the boundary box.
+        """
+        if self.routing_algorithm == "astar":
+            max_abs_lat = max(abs(self.boundaries['bottom']), abs(self.boundaries['top']))
+            factor = 6367 * math.pi / 180 * math.cos(math.radians(max_abs_lat)) \
+                    * self.min_weight * RoutingGraph.heuristic_slack
+            path_function = sql.SQL(
+                    "pgr_aStar({c_edges_query}, {p_start_vertex}, {p_dest_vertex}, "
+                    "directed := false, heuristic := 4, factor := {l_factor})"
+                    ).format(
+                        c_edges_query=QueryLiteral(edges_query),
+                        p_start_vertex=sql.Placeholder(name='start_vertex'),
+                        p_dest_vertex=sql.Placeholder(name='dest_vertex'),
+                        l_factor=sql.Literal(factor))
+        else:
+            path_function = sql.SQL(
+                    "{c_function}({c_edges_query}, {p_start_vertex}, {p_dest_vertex}, false)"
+                    ).format(
+                        c_function=sql.SQL(
+                            "pgr_bdDijkstra" if self.routing_algorithm == "bidirectional" else "pgr_dijkstra"),
+                        c_edges_query=QueryLiteral(edges_query),
+                        p_start_vertex=sql.Placeholder(name='start_vertex'),
+                        p_dest_vertex=sql.Placeholder(name='dest_vertex'))
+        return sql.SQL("SELECT seq, node, edge, cost FROM {c_path_function}").format(
+                c_path_function=path_function)
+
+
+    def snap_to_closest_edge(self, lat, lon):
+        """
+        Projects the point onto the closest passable edge. The inner query uses
+        the index-ordered knn distance of the geometry, the few nearest edges are
+        then ranked by their exact distance in meters. The graph engine uses the
+        spatial index of the in-memory routing graph instead.
+        """
+        if self.routing_graph:
+            return self.snap_to_closest_edge_of_routing_graph(lat, lon)
+        routing_table, routing_table_filter = self.get_routing_table_and_filter()
         try:
-            if "turn" not in route[-1]:
-                route[-1]['turn'] = geometry.turn_between_two_segments(
-                        next_segment['bearing'], route[-2]['bearing'])
-        except IndexError as e:
-            pass
-        # append new segment and point
-        route.append(next_segment)
-        route.append(next_point)
-        return route
+            edge = self.selected_db.fetch_one(
+                    sql.SQL(
+                        """
+                        SELECT id, osm_id, source, target, kmh, km, x1, y1, x2, y2, fraction,
+                                ST_X(ST_LineInterpolatePoint(geom_way, fraction)) AS lon,
+                                ST_Y(ST_LineInterpolatePoint(geom_way, fraction)) AS lat,
+                                ST_Distance(geom_way::geography, {c_point}::geography) AS way_distance
+                            FROM (
+                                SELECT id, osm_id, source, target, kmh, km, x1, y1, x2, y2, geom_way,
+                                        ST_LineLocatePoint(geom_way, {c_point}) AS fraction
+                                    FROM {i_routing_table}
+                                    WHERE kmh = ANY({p_way_class_list})
+                                        AND NOT osm_id = ANY({p_way_id_list})
+                                        AND {c_filter}
+                                    ORDER BY geom_way <-> {c_point}
+                                    LIMIT 10
+                                ) AS nearest_edges
+                            ORDER BY way_distance
+                            LIMIT 1
+                        """
+                        ).format(
+                            c_point=sql.SQL("ST_SetSRID(ST_MakePoint({p_lon}, {p_lat}), 4326)").format(
+                                p_lon=sql.Placeholder(name='lon'),
+                                p_lat=sql.Placeholder(name='lat')),
+                            i_routing_table=routing_table,
+                            c_filter=routing_table_filter,
+                            p_way_class_list=sql.Placeholder(name='way_class_list'),
+                            p_way_id_list=sql.Placeholder(name='way_id_list')),
+                        {   "lat" : lat, "lon" : lon,
+                            "way_class_list" : [ way_class_id \
+                                for way_class_id, weight in self.way_class_id_and_weight_map.items() if weight > 0 ],
+                            "way_id_list" : self.way_ids_to_exclude },
+                    query_name="route_snap_to_closest_edge")
+        except DBControl.DatabaseResultEmptyError as e:
+            raise WebserverException(ReturnCode.NO_ROUTE_BETWEEN_START_AND_DESTINATION)
+        return PedestrianRoute.SnapPoint(edge)
+
+    def snap_to_closest_edge_of_routing_graph(self, lat, lon):
+        routing_graph = self.routing_graph
+        projection_list = routing_graph.find_nearest_edges(
+                lat, lon, 1, self.routing_overlay.is_passable)
+        if not projection_list:
+            raise WebserverException(ReturnCode.NO_ROUTE_BETWEEN_START_AND_DESTINATION)
+        projection = projection_list[0]
+        edge_index = projection.edge_index
+        source = routing_graph.edge_source[edge_index]
+        target = routing_graph.edge_target[edge_index]
+        return PedestrianRoute.SnapPoint(
+                {   "id"           : routing_graph.edge_id[edge_index],
+                    "osm_id"       : routing_graph.edge_osm_id[edge_index],
+                    "kmh"          : routing_graph.edge_way_class[edge_index],
+                    "way_distance" : projection.distance,
+                    "km"           : routing_graph.edge_km[edge_index],
+                    "fraction"     : projection.fraction,
+                    "lat"          : projection.lat,
+                    "lon"          : projection.lon,
+                    "source"       : routing_graph.vertex_id[source],
+                    "x1"           : routing_graph.vertex_lon[source],
+                    "y1"           : routing_graph.vertex_lat[source],
+                    "target"       : routing_graph.vertex_id[target],
+                    "x2"           : routing_graph.vertex_lon[target],
+                    "y2"           : routing_graph.vertex_lat[target] })
+
+    def get_weight(self, way_class_id):
+        weight = self.way_class_id_and_weight_map.get(way_class_id, 0.0)
+        return weight if weight > 0 else self.max_weight
+
+    def get_snap_cost_map(self, snap_point):
+        """ cost from the projected point along its edge to both end vertices """
+        weighted_km = snap_point.km * self.get_weight(snap_point.way_class)
+        return {
+                snap_point.source : snap_point.fraction * weighted_km,
+                snap_point.target : (1 - snap_point.fraction) * weighted_km }
+
+    def create_point_on_edge(self, part, fraction, snap_point):
+        """
+        Intersection or way point at the source (fraction 0) or target (fraction 1)
+        vertex of the edge, otherwise a way point at the projected point
+        """
+        if fraction == 0.0 or fraction == 1.0:
+            osm_node_id = part['osm_source_id'] if fraction == 0.0 else part['osm_target_id']
+            # check if current point is an intersection
+            point = self.poi.create_intersection_by_id(osm_node_id)
+            if not point:
+                point = self.poi.create_way_point_by_id(osm_node_id)
+            return point
+        return self.poi.create_way_point(-1, snap_point.lat, snap_point.lon, {})
 
 
     def important_intersection(self, intersection, prev_segment={}):
-        street_traffic_way_list = []
-        impassable_way_list = []
-        for way in intersection.get("way_list", {}):
-            try:
-                way_type = self.selected_db.fetch_one(
-                        sql.SQL(
-                            """
-                            SELECT kmh AS type
-                                FROM {i_temp_routing_table}
-                                WHERE osm_id = {p_osm_id}
-                                LIMIT 1
-                            """
-                            ).format(
-                                i_temp_routing_table=sql.Identifier(self.temp_routing_table_name),
-                                p_osm_id=sql.Placeholder(name='osm_id')),
-                            {"osm_id":way.get("way_id", 0)}
-                        ).get("type", 0)
-            except DBControl.DatabaseResultEmptyError as e:
-                impassable_way_list.append(way.get("name"))
-            else:
-                if way_type in [1,2] \
+        node_id = intersection.get("node_id")
+        if node_id in self.important_intersection_cache:
+            number_of_street_traffic_ways, number_of_impassable_ways = \
+                    self.important_intersection_cache[node_id]
+        else:
+            street_traffic_way_list = []
+            impassable_way_list = []
+            way_list = intersection.get("way_list", {})
+            self.load_way_classes(
+                    [ way.get("way_id", 0) for way in way_list ])
+            for way in way_list:
+                way_type = self.way_class_by_osm_id.get(way.get("way_id", 0))
+                if way_type is None:
+                    impassable_way_list.append(way.get("name"))
+                elif way_type in [1,2] \
                         and way.get("name") \
                         and way.get("name") not in street_traffic_way_list:
                     street_traffic_way_list.append(way.get("name"))
@@ -746,30 +926,247 @@ class PedestrianRoute:
                         and way.get("name") \
                         and way.get("name") not in impassable_way_list:
                     impassable_way_list.append(way.get("name"))
-        if len(street_traffic_way_list) > 1:
+            number_of_street_traffic_ways = len(street_traffic_way_list)
+            number_of_impassable_ways = len(impassable_way_list)
+            if node_id is not None:
+                self.important_intersection_cache[node_id] = \
+                        (number_of_street_traffic_ways, number_of_impassable_ways)
+        if number_of_street_traffic_ways > 1:
             return True
-        elif len(street_traffic_way_list) > 0 \
+        elif number_of_street_traffic_ways > 0 \
                 and prev_segment.get("way_class", 0) in [3,4,5,6,7]:
             return True
-        elif len(impassable_way_list) > 0:
+        elif number_of_impassable_ways > 0:
             return True
         else:
             return False
 
+    def load_way_classes(self, osm_way_id_list):
+        """
+        Adds the way class of all given ways, which are not known yet, to
+        way_class_by_osm_id with a single query or from the osm way index of the
+        in-memory routing graph. Ways outside of the routing graph of the
+        current route section get None.
+        """
+        osm_way_id_list = [ osm_way_id \
+                for osm_way_id in set(osm_way_id_list) if osm_way_id not in self.way_class_by_osm_id ]
+        if not osm_way_id_list:
+            return
+        if self.routing_graph:
+            for osm_way_id in osm_way_id_list:
+                self.way_class_by_osm_id[osm_way_id] = self.routing_graph.get_way_class(
+                        osm_way_id, self.boundaries)
+            return
+        routing_table, routing_table_filter = self.get_routing_table_and_filter()
+        way_class_dict = self.selected_db.fetch_by_ids(
+                sql.SQL(
+                    """
+                    SELECT DISTINCT ON (osm_id) osm_id, kmh
+                        FROM {i_routing_table}
+                        WHERE osm_id = ANY({p_id_list}) AND {c_filter}
+                        ORDER BY osm_id, id
+                    """
+                    ).format(
+                        i_routing_table=routing_table,
+                        c_filter=routing_table_filter,
+                        p_id_list=sql.Placeholder(name='id_list')),
+                "osm_id", osm_way_id_list,
+                query_name="route_intersection_way_classes")
+        for osm_way_id in osm_way_id_list:
+            row = way_class_dict.get(osm_way_id)
+            self.way_class_by_osm_id[osm_way_id] = row['kmh'] if row else None
+
+
+    class RouteBuilder:
+        """
+        Route section of alternating points and segments, built point by point
+
+        Every added point may remove unimportant points from the end of the
+        route, so the route is only simplified at its tail in a single pass.
+        The points are the dicts of the poi module. Segments are stored column
+        by column: the way segment dict, which all segments of the same edge
+        share, and bearing, distance and end coordinates in typed arrays. The
+        segment dicts of the result are created by to_list.
+        """
+
+        def __init__(self, pedestrian_route, add_all_intersections=False):
+            self.pedestrian_route = pedestrian_route
+            self.add_all_intersections = add_all_intersections
+            self.point_list = []
+            # segment i connects point i and i+1
+            self.segment_way_list = []
+            self.segment_bearing = array('q')
+            self.segment_distance = array('q')
+            # start lat, start lon, end lat, end lon per segment
+            self.segment_coordinates = array('d')
+            self.railway_name_list = [
+                    pedestrian_route.translator.translate("railway", "tram"),
+                    pedestrian_route.translator.translate("railway", "rail")]
+
+        def add_point(self, next_point, next_segment):
+            point_list = self.point_list
+            if not point_list:
+                point_list.append(next_point)
+                return
+            segment_way_list = self.segment_way_list
+            segment_bearing = self.segment_bearing
+            important_intersection = self.pedestrian_route.important_intersection
+            bearing = geometry.bearing_between_two_points(
+                    point_list[-1]['lat'], point_list[-1]['lon'], next_point['lat'], next_point['lon'])
+            if next_point['type'] == "intersection" \
+                    and geometry.distance_between_two_points(
+                        point_list[-1]['lat'], point_list[-1]['lon'],
+                        next_point['lat'], next_point['lon']) == 0:
+                # replace last point
+                point_list[-1] = next_point
+                return
+
+            # delete unimportant intersections and way points
+            if segment_way_list \
+                    and (not self.add_all_intersections or point_list[-1]['type'] != "intersection") \
+                    and self.is_straight(bearing, segment_bearing[-1]) \
+                    and segment_way_list[-1]['name'] == next_segment['name'] \
+                    and segment_way_list[-1]['sub_type'] == next_segment['sub_type'] \
+                    and not important_intersection(point_list[-1], segment_way_list[-1]):
+                self.delete_last_segments(1)
+            # delete zigzag
+            if len(segment_way_list) > 1 \
+                    and not self.add_all_intersections \
+                    and self.is_straight(bearing, segment_bearing[-2]) \
+                    and self.segment_distance[-1] < 4 \
+                    and not important_intersection(point_list[-1], segment_way_list[-1]) \
+                    and not important_intersection(point_list[-2], segment_way_list[-2]):
+                self.delete_last_segments(2)
+            # delete double train intersection but leave first of two intersections
+            if len(segment_way_list) > 1 \
+                    and not self.add_all_intersections \
+                    and self.is_straight(bearing, segment_bearing[-2]) \
+                    and self.segment_distance[-1] < 5 \
+                    and self.is_railway(point_list[-1]) \
+                    and self.is_railway(point_list[-2]):
+                self.delete_last_segments(1)
+
+            # new segment from the potentially new last point
+            last_point = point_list[-1]
+            bearing = geometry.bearing_between_two_points(
+                    last_point['lat'], last_point['lon'], next_point['lat'], next_point['lon'])
+            if segment_way_list and "turn" not in last_point:
+                last_point['turn'] = geometry.turn_between_two_segments(bearing, segment_bearing[-1])
+            point_list.append(next_point)
+            segment_way_list.append(next_segment)
+            segment_bearing.append(bearing)
+            self.segment_distance.append(
+                    geometry.distance_between_two_points(
+                        last_point['lat'], last_point['lon'], next_point['lat'], next_point['lon']))
+            self.segment_coordinates.extend(
+                    (last_point['lat'], last_point['lon'], next_point['lat'], next_point['lon']))
+
+        def insert_first_point(self, point, segment):
+            """ prepends the point, which is connected to the current first one by the segment """
+            first_point = self.point_list[0]
+            bearing = geometry.bearing_between_two_points(
+                    point['lat'], point['lon'], first_point['lat'], first_point['lon'])
+            first_point['turn'] = geometry.turn_between_two_segments(self.segment_bearing[0], bearing)
+            self.point_list.insert(0, point)
+            self.segment_way_list.insert(0, segment)
+            self.segment_bearing.insert(0, bearing)
+            self.segment_distance.insert(
+                    0,
+                    geometry.distance_between_two_points(
+                        point['lat'], point['lon'], first_point['lat'], first_point['lon']))
+            self.segment_coordinates[0:0] = array(
+                    'd', (point['lat'], point['lon'], first_point['lat'], first_point['lon']))
+
+        def delete_last_segments(self, number_of_segments):
+            """ deletes the last segments together with their end points """
+            del self.point_list[-number_of_segments:]
+            del self.segment_way_list[-number_of_segments:]
+            del self.segment_bearing[-number_of_segments:]
+            del self.segment_distance[-number_of_segments:]
+            del self.segment_coordinates[-4*number_of_segments:]
+
+        def is_railway(self, point):
+            return any(railway_name in point['name'] for railway_name in self.railway_name_list)
+
+        @staticmethod
+        def is_straight(bearing, previous_bearing):
+            turn = geometry.turn_between_two_segments(bearing, previous_bearing)
+            return turn <= 22 or turn >= 338
+
+        def to_list(self):
+            """
+            The route as list of point and segment dicts. Marks the ways of every
+            intersection, which belong to the previous and next route segment.
+            """
+            segment_bearing = self.segment_bearing
+            segment_coordinates = self.segment_coordinates
+            number_of_segments = len(self.segment_way_list)
+            route = []
+            for index, point in enumerate(self.point_list):
+                if point.get("type") == "intersection":
+                    # a bearing of 0 counts as unknown
+                    previous_bearing = segment_bearing[index-1] if index > 0 else None
+                    next_bearing = segment_bearing[index] if index < number_of_segments else None
+                    self.mark_route_ways_of_intersection(point, previous_bearing, next_bearing)
+                route.append(point)
+                if index < number_of_segments:
+                    segment = dict(self.segment_way_list[index])
+                    segment['start'] = {
+                            "lat":segment_coordinates[4*index], "lon":segment_coordinates[4*index+1] }
+                    segment['end'] = {
+                            "lat":segment_coordinates[4*index+2], "lon":segment_coordinates[4*index+3] }
+                    segment['bearing'] = segment_bearing[index]
+                    segment['distance'] = self.segment_distance[index]
+                    segment['type'] = "footway_route"
+                    route.append(segment)
+            return route
+
+        @staticmethod
+        def mark_route_ways_of_intersection(intersection, previous_bearing, next_bearing):
+            minimal_bearing_difference_previous = 180
+            index_of_previous = -1
+            minimal_bearing_difference_next = 180
+            index_of_next = -1
+            for index, intersection_segment in enumerate(intersection.get("way_list")):
+                if previous_bearing:
+                    bearing_difference_previous = geometry.bearing_difference_between_two_segments(
+                            (previous_bearing + 180) % 360, intersection_segment.get("bearing"))
+                    if bearing_difference_previous < minimal_bearing_difference_previous:
+                        minimal_bearing_difference_previous = bearing_difference_previous
+                        index_of_previous = index
+                if next_bearing:
+                    bearing_difference_next = geometry.bearing_difference_between_two_segments(
+                            next_bearing, intersection_segment.get("bearing"))
+                    if bearing_difference_next < minimal_bearing_difference_next:
+                        minimal_bearing_difference_next = bearing_difference_next
+                        index_of_next = index
+            if index_of_previous > -1:
+                intersection['way_list'][index_of_previous]['part_of_previous_route_segment'] = True
+            if index_of_next > -1:
+                intersection['way_list'][index_of_next]['part_of_next_route_segment'] = True
 
-    class VertexTuple:
-        def __init__(self, point_id, point_distance, way_id, way_class, way_distance, way_name):
-            self.point_id = point_id
-            self.point_distance = point_distance
-            self.way_id = way_id
-            self.way_class = way_class
-            self.way_distance = way_distance
-            self.way_name = way_name
 
+    class SnapPoint:
+        """ projection of a route point onto its closest edge """
+        def __init__(self, edge):
+            self.edge_id = edge['id']
+            self.way_id = edge['osm_id']
+            self.way_class = edge['kmh']
+            self.way_distance = edge['way_distance']
+            self.km = edge['km']
+            # position along the edge: 0 = source, 1 = target
+            self.fraction = edge['fraction']
+            self.lat = edge['lat']
+            self.lon = edge['lon']
+            # end vertices
+            self.source = edge['source']
+            self.source_coordinates = (edge['x1'], edge['y1'])
+            self.target = edge['target']
+            self.target_coordinates = (edge['x2'], edge['y2'])
 
-    class RawRoute:
-        def __init__(self, route, start_vertex_tuple, dest_vertex_tuple):
-            self.route = route
-            self.start_vertex_tuple = start_vertex_tuple
-            self.dest_vertex_tuple = dest_vertex_tuple
+        def get_vertex_coordinates(self, vertex_id):
+            return self.source_coordinates if vertex_id == self.source else self.target_coordinates
 
+        def __str__(self):
+            return "edge {}, fraction {:.3f}, distance {:.1f} m".format(
+                    self.edge_id, self.fraction, self.way_distance)
@@ -7,18 +7,90 @@ from psycopg2 import sql
 from . import constants, geometry, statistics
 from .config import Config
 from .constants import ReturnCode
-from .db_control import DBControl
+from .db_control import DBControl, PreparedStatement
 from .helper import WebserverException
 from .translator import Translator 
 
 
 class POI:
+    # server-side prepared statements for the hot single-row lookups
+    prepared_statements = {}
 
-    def __init__(self, map_id, session_id, user_language, prefer_translated_strings_in_osm_tags):
-        self.selected_db = DBControl(map_id)
+    def __init__(self, map_id, session_id, user_language, prefer_translated_strings_in_osm_tags,
+            deadline=None):
+        self.selected_db = DBControl(map_id, session_id, deadline=deadline)
         self.session_id = session_id
         self.translator = Translator(user_language)
         self.prefer_translated_strings_in_osm_tags = prefer_translated_strings_in_osm_tags
+        # outer buildings and entrances, prefetched for a whole poi query result
+        self.outer_building_cache = {}
+        self.entrance_cache = {}
+        # way points, way segments and intersections, prefetched for a whole route section
+        self.way_point_cache = {}
+        self.way_segment_cache = {}
+        self.intersection_cache = {}
+        self.intersection_data_cache = {}
+        self.pedestrian_crossing_cache = {}
+        if not POI.prepared_statements:
+            POI.prepared_statements = POI.create_prepared_statements()
+
+
+    @staticmethod
+    def create_prepared_statements():
+        statement_list = [
+                PreparedStatement(
+                    "poi_way_point_by_id",
+                    sql.SQL(
+                        """
+                        SELECT ST_AsBinary(geom) AS geom, tags
+                            FROM nodes
+                            WHERE id = $1
+                        """),
+                    ["osm_node_id"]),
+                PreparedStatement(
+                    "poi_way_segment_by_id",
+                    sql.SQL(
+                        """
+                        SELECT tags
+                            FROM ways
+                            WHERE id = $1
+                        """),
+                    ["osm_way_id"]),
+                PreparedStatement(
+                    "poi_intersection_by_id",
+                    sql.SQL(
+                        """
+                        SELECT ST_AsBinary(geom) AS geom, name, tags,
+                                number_of_streets, number_of_streets_with_name, number_of_traffic_signals
+                            FROM {i_intersection_table_name}
+                            WHERE id = $1
+                        """
+                        ).format(
+                                i_intersection_table_name=sql.Identifier(Config().database.get("intersection_table"))),
+                    ["osm_id"]),
+                PreparedStatement(
+                    "poi_intersection_data",
+                    sql.SQL(
+                        """
+                        SELECT way_id, node_id, direction, way_tags, node_tags,
+                                ST_AsBinary(geom) AS geom
+                            FROM {i_intersection_data_table_name}
+                            WHERE id = $1
+                        """
+                        ).format(
+                                i_intersection_data_table_name=sql.Identifier(Config().database.get("intersection_data_table"))),
+                    ["osm_id"]),
+                PreparedStatement(
+                    "poi_pedestrian_crossings",
+                    sql.SQL(
+                        """
+                        SELECT id, ST_AsBinary(geom) AS geom, crossing_street_name, tags
+                            FROM pedestrian_crossings
+                            WHERE intersection_id = $1
+                        """),
+                    ["osm_id"])
+                ]
+        return { statement.name : statement for statement in statement_list }
 
 
     def get_hiking_trails(self, lat, lon, radius, order_by="closest"):
@@ -67,7 +139,8 @@ class POI:
                             p_lon=sql.Placeholder(name='lon'),
                             p_lat=sql.Placeholder(name='lat'),
                             c_order_by_query=order_by_query),
-                    { **boundary_box_query_params, **{"lat":lat, "lon":lon}})
+                    { **boundary_box_query_params, **{"lat":lat, "lon":lon}},
+                query_name="hiking_trails_search")
 
         trail_list = []
         for row in result:
@@ -169,7 +242,6 @@ class POI:
         intersection_tag_list = ["named_intersection", "partially_named_intersection",
                                  "other_intersection", "railway_intersection"]
         if [True for tag in tag_list if tag in intersection_tag_list]:
-            t1 = time.time()
             where_clause_query_list = \
                     [ boundary_box_query, access_exclude_private ]
 
@@ -266,8 +338,8 @@ class POI:
                                 c_boundary_box_query=geometry.get_boundary_box_query("i"),
                                 c_where_clause_query=sql.SQL(" AND ").join(where_clause_query_list),
                                 c_order_by_and_limit_query=order_by_and_limit_query),
-                    where_clause_param_dict)
-            t2 = time.time()
+                    where_clause_param_dict,
+                    query_name="poi_search_intersections")
 
             for row in result:
                 intersection_id = int(row['id'])
@@ -279,8 +351,6 @@ class POI:
                 if Config().has_session_id_to_remove(self.session_id):
                     raise WebserverException(
                             ReturnCode.CANCELLED_BY_CLIENT, "Cancelled by client")
-            t3 = time.time()
-            logging.debug("intersection gesamt = %.2f, dbquery = %.2f, parsing = %.2f" % ((t3-t1), (t2-t1), (t3-t2)))
 
 
         ##########
@@ -289,7 +359,6 @@ class POI:
         station_tag_list = ["transportation_class_1", "transportation_class_2",
                 "transport_bus_tram", "transport_train_lightrail_subway", "transport_airport_ferry_aerialway"]
         if [True for tag in tag_list if tag in station_tag_list]:
-            t1 = time.time()
             where_clause_query_list = \
                     [ boundary_box_query, access_exclude_private ]
 
@@ -359,9 +428,10 @@ class POI:
                                 c_where_clause_query=sql.SQL(" AND ").join(where_clause_query_list),
                                 c_order_by_and_limit_query=order_by_and_limit_query),
                     # double number of results limit to counter redundant stations
-                    { **where_clause_param_dict, "number_of_results" : number_of_results*2 })
-            t2 = time.time()
+                    { **where_clause_param_dict, "number_of_results" : number_of_results*2 },
+                    query_name="poi_search_stations")
 
+            self.prefetch_outer_buildings_and_entrances(result)
             for row in result:
                 station_id = int(row['id'])
                 osm_id = int(row['osm_id'])
@@ -393,7 +463,8 @@ class POI:
                                 ).format(
                                         i_table_name=sql.Identifier(table_name),
                                         c_station_boundary_box_query=station_boundary_box_query),
-                            station_boundary_box_query_params)
+                            station_boundary_box_query_params,
+                            query_name="poi_station_stop_position_exists")
                     if station_exists_result.get("exists"):
                         # the station already is represented by another one with
                         # a stop position, so skip this one
@@ -408,8 +479,6 @@ class POI:
                 if Config().has_session_id_to_remove(self.session_id):
                     raise WebserverException(
                             ReturnCode.CANCELLED_BY_CLIENT, "Cancelled by client")
-            t3 = time.time()
-            logging.debug("station gesamt = %.2f, dbquery = %.2f, parsing = %.2f" % ((t3-t1), (t2-t1), (t3-t2)))
 
 
         #####
@@ -420,7 +489,6 @@ class POI:
                 "health", "elevator", "sanitary", "public_service", "other_service", "all_buildings_with_name",
                 "post_box", "surveillance", "bench", "trash", "bridge", "sport"]
         if [True for tag in tag_list if tag in poi_tag_list]:
-            t1 = time.time()
             where_clause_query_list = \
                     [ boundary_box_query, access_exclude_private ]
 
@@ -661,9 +729,10 @@ class POI:
                                 i_table_name=sql.Identifier(table_name),
                                 c_where_clause_query=sql.SQL(" AND ").join(where_clause_query_list),
                                 c_order_by_and_limit_query=order_by_and_limit_query),
-                    where_clause_param_dict)
-            t2 = time.time()
+                    where_clause_param_dict,
+                    query_name="poi_search_poi")
 
+            self.prefetch_outer_buildings_and_entrances(result)
             for row in result:
                 poi_id = int(row['id'])
                 osm_id = int(row['osm_id']) if row['osm_type'] == "N" else 0
@@ -675,8 +744,6 @@ class POI:
                 if Config().has_session_id_to_remove(self.session_id):
                     raise WebserverException(
                             ReturnCode.CANCELLED_BY_CLIENT, "Cancelled by client")
-            t3 = time.time()
-            logging.debug("poi gesamt = %.2f, dbquery = %.2f, parsing = %.2f" % ((t3-t1), (t2-t1), (t3-t2)))
 
 
         ###########
@@ -684,7 +751,6 @@ class POI:
         ###########
         entrance_tag_list = [ "entrance", "entrance_without_name" ]
         if [True for tag in tag_list if tag in entrance_tag_list]:
-            t1 = time.time()
             where_clause_query_list = \
                     [ boundary_box_query, access_exclude_private ]
 
@@ -713,8 +779,8 @@ class POI:
                                 c_where_clause_query=sql.SQL(" AND ").join(where_clause_query_list),
                                 c_order_by_and_limit_query=order_by_and_limit_query),
                     # multiply number of results limit to counter many entrances without name
-                    { **where_clause_param_dict, "number_of_results" : number_of_results*4 })
-            t2 = time.time()
+                    { **where_clause_param_dict, "number_of_results" : number_of_results*4 },
+                    query_name="poi_search_entrances")
 
             for row in result:
                 entrance = self.create_entrance(int(row['entrance_id']), row['lat'], row['lon'],
@@ -731,15 +797,12 @@ class POI:
                 if Config().has_session_id_to_remove(self.session_id):
                     raise WebserverException(
                             ReturnCode.CANCELLED_BY_CLIENT, "Cancelled by client")
-            t3 = time.time()
-            logging.debug("entrances gesamt = %.2f, dbquery = %.2f, parsing = %.2f" % ((t3-t1), (t2-t1), (t3-t2)))
 
 
         ######################
         # pedestrian crossings
         ######################
         if "pedestrian_crossings" in tag_list:
-            t1 = time.time()
             where_clause_query_list = \
                     [ boundary_box_query, access_exclude_private ]
 
@@ -767,8 +830,8 @@ class POI:
                                 i_table_name=sql.Identifier(table_name),
                                 c_where_clause_query=sql.SQL(" AND ").join(where_clause_query_list),
                                 c_order_by_and_limit_query=order_by_and_limit_query),
-                    where_clause_param_dict)
-            t2 = time.time()
+                    where_clause_param_dict,
+                    query_name="poi_search_pedestrian_crossings")
 
             for row in result:
                 signal = self.create_pedestrian_crossing(int(row['id']), row['lat'], row['lon'],
@@ -778,8 +841,6 @@ class POI:
                 if Config().has_session_id_to_remove(self.session_id):
                     raise WebserverException(
                             ReturnCode.CANCELLED_BY_CLIENT, "Cancelled by client")
-            t3 = time.time()
-            logging.debug("pedestrian crossings gesamt = %.2f, dbquery = %.2f, parsing = %.2f" % ((t3-t1), (t2-t1), (t3-t2)))
 
 
         # filter out entries above given radius
@@ -832,7 +893,8 @@ class POI:
                             """
                             ).format(
                                     p_way_id=sql.Placeholder(name='way_id')),
-                        {"way_id":way_id})
+                        {"way_id":way_id},
+                        query_name="next_intersections_way_tags")
                     ['tags'])
         except DBControl.DatabaseResultEmptyError as e:
             raise WebserverException(
@@ -850,10 +912,12 @@ class POI:
                             p_node_id=sql.Placeholder(name='node_id'))
             node_id_seq_nr = self.selected_db.fetch_one(
                     sequence_id_query,
-                    {"way_id":way_id, "node_id": node_id})['sequence_id']
+                    {"way_id":way_id, "node_id": node_id},
+                    query_name="next_intersections_sequence_id")['sequence_id']
             next_node_id_seq_nr = self.selected_db.fetch_one(
                     sequence_id_query,
-                    {"way_id":way_id, "node_id": next_node_id})['sequence_id']
+                    {"way_id":way_id, "node_id": next_node_id},
+                    query_name="next_intersections_sequence_id")['sequence_id']
         except DBControl.DatabaseResultEmptyError as e:
             raise WebserverException(
                     ReturnCode.BAD_REQUEST, "node id not found")
@@ -898,7 +962,8 @@ class POI:
                                 p_sequence_id=sql.Placeholder(name='sequence_id'))
             next_node_id_list += self.selected_db.fetch_all(
                     next_node_id_list_query,
-                    {"way_id":way_id, "sequence_id":node_id_seq_nr})
+                    {"way_id":way_id, "sequence_id":node_id_seq_nr},
+                    query_name="next_intersections_next_nodes")
 
             # find start of the next potential way
             node_id = next_node_id_list[-1]['node_id']
@@ -913,7 +978,8 @@ class POI:
                         ).format(
                                 p_node_id=sql.Placeholder(name='node_id'),
                                 p_way_id=sql.Placeholder(name='way_id')),
-                    {"node_id":node_id, "way_id":way_id}):
+                    {"node_id":node_id, "way_id":way_id},
+                    query_name="next_intersections_potential_next_ways"):
                 potential_next_way_tags = self.parse_hstore_column(potential_next_way['way_tags'])
                 if potential_next_way_tags.get("name"):
                     # potential next way contains name
@@ -961,22 +1027,19 @@ class POI:
     #####
 
     def create_way_point_by_id(self, osm_node_id):
-        try:
-            result = self.selected_db.fetch_one(
-                    sql.SQL(
-                        """
-                        SELECT ST_X(geom) as x, ST_Y(geom) as y, tags
-                            FROM nodes
-                            WHERE id = {p_osm_node_id}
-                        """
-                        ).format(
-                                p_osm_node_id=sql.Placeholder(name='osm_node_id')),
-                    {"osm_node_id":osm_node_id})
-        except DBControl.DatabaseError as e:
-            return {}
+        if osm_node_id in self.way_point_cache:
+            result = self.way_point_cache.get(osm_node_id)
+            if not result:
+                return {}
+        else:
+            try:
+                result = self.selected_db.fetch_one(
+                        POI.prepared_statements.get("poi_way_point_by_id"),
+                        {"osm_node_id":osm_node_id})
+            except DBControl.DatabaseError as e:
+                return {}
         osm_node_id = int(osm_node_id)
-        lat = result['y']
-        lon = result['x']
+        lat, lon = geometry.decode_wkb_point(result['geom'])
         tags = self.parse_hstore_column(result['tags'])
         return self.create_way_point(osm_node_id, lat, lon, tags)
 
@@ -1039,23 +1102,17 @@ class POI:
         return point
 
     def create_way_segment_by_id(self, osm_way_id, walking_reverse=False):
-        try:
-            result = self.selected_db.fetch_one(
-                    sql.SQL(
-                        """
-                        SELECT tags,
-                               ST_Y(ST_PointN(linestring, 1)) AS start_lat,
-                               ST_X(ST_PointN(linestring, 1)) AS start_lon,
-                               ST_Y(ST_PointN(linestring, -1)) AS dest_lat,
-                               ST_X(ST_PointN(linestring, -1)) AS dest_lon
-                            FROM ways
-                            WHERE id = {p_osm_way_id}
-                        """
-                        ).format(
-                                p_osm_way_id=sql.Placeholder(name='osm_way_id')),
-                    {"osm_way_id":osm_way_id})
-        except DBControl.DatabaseError as e:
-            return {}
+        if osm_way_id in self.way_segment_cache:
+            result = self.way_segment_cache.get(osm_way_id)
+            if not result:
+                return {}
+        else:
+            try:
+                result = self.selected_db.fetch_one(
+                        POI.prepared_statements.get("poi_way_segment_by_id"),
+                        {"osm_way_id":osm_way_id})
+            except DBControl.DatabaseError as e:
+                return {}
         osm_way_id = int(osm_way_id)
         tags = self.parse_hstore_column(result['tags'])
         return self.create_way_segment(osm_way_id, tags, walking_reverse)
@@ -1175,24 +1232,19 @@ class POI:
         return segment
 
     def create_intersection_by_id(self, osm_id):
-        try:
-            result = self.selected_db.fetch_one(
-                    sql.SQL(
-                        """
-                        SELECT ST_X(geom) as x, ST_Y(geom) as y, name, tags,
-                                number_of_streets, number_of_streets_with_name, number_of_traffic_signals
-                            FROM {i_intersection_table_name}
-                            WHERE id = {p_osm_id}
-                        """
-                        ).format(
-                                i_intersection_table_name=sql.Identifier(Config().database.get("intersection_table")),
-                                p_osm_id=sql.Placeholder(name='osm_id')),
-                    {"osm_id":osm_id})
-        except DBControl.DatabaseError as e:
-            return {}
+        if osm_id in self.intersection_cache:
+            result = self.intersection_cache.get(osm_id)
+            if not result:
+                return {}
+        else:
+            try:
+                result = self.selected_db.fetch_one(
+                        POI.prepared_statements.get("poi_intersection_by_id"),
+                        {"osm_id":osm_id})
+            except DBControl.DatabaseError as e:
+                return {}
         osm_id = int(osm_id)
-        lat = result['y']
-        lon = result['x']
+        lat, lon = geometry.decode_wkb_point(result['geom'])
         name = result['name']
         tags = self.parse_hstore_column(result['tags'])
         number_of_streets = result['number_of_streets']
@@ -1243,26 +1295,22 @@ class POI:
 
         # ways
         intersection['way_list'] = []
-        for street in self.selected_db.fetch_all(
-                sql.SQL(
-                    """
-                    SELECT way_id, node_id, direction, way_tags, node_tags,
-                            ST_X(geom) as lon, ST_Y(geom) as lat
-                        FROM {i_intersection_data_table_name}
-                        WHERE id = {p_osm_id}
-                    """
-                    ).format(
-                            i_intersection_data_table_name=sql.Identifier(Config().database.get("intersection_data_table")),
-                            p_osm_id=sql.Placeholder(name='osm_id')),
-                {"osm_id":osm_id}):
+        if osm_id in self.intersection_data_cache:
+            street_list = self.intersection_data_cache.get(osm_id)
+        else:
+            street_list = self.selected_db.fetch_all(
+                    POI.prepared_statements.get("poi_intersection_data"),
+                    {"osm_id":osm_id})
+        for street in street_list:
             sub_segment = self.create_way_segment(
                     street['way_id'],
                     self.parse_hstore_column(street['way_tags']),
                     street['direction'] == "B")
+            street_lat, street_lon = geometry.decode_wkb_point(street['geom'])
             sub_segment = geometry.add_bearing_and_distance_to_segment(
                     sub_segment,
                     intersection['lat'], intersection['lon'],
-                    street['lat'], street['lon'])
+                    street_lat, street_lon)
             sub_segment['intersection_node_id'] = osm_id
             sub_segment['next_node_id'] = street['node_id']
             sub_segment['type'] = "footway_intersection"
@@ -1272,17 +1320,15 @@ class POI:
         # crossings
         intersection['pedestrian_crossing_list'] = []
         if number_of_traffic_signals > 0:
-            for row in self.selected_db.fetch_all(
-                    sql.SQL(
-                        """
-                        SELECT id, ST_X(geom) as lon, ST_Y(geom) as lat, crossing_street_name, tags
-                            FROM pedestrian_crossings
-                            WHERE intersection_id = {p_osm_id}
-                        """
-                        ).format(
-                                p_osm_id=sql.Placeholder(name='osm_id')),
-                    {"osm_id":osm_id}):
-                signal = self.create_pedestrian_crossing(int(row['id']), row['lat'], row['lon'],
+            if osm_id in self.pedestrian_crossing_cache:
+                crossing_list = self.pedestrian_crossing_cache.get(osm_id)
+            else:
+                crossing_list = self.selected_db.fetch_all(
+                        POI.prepared_statements.get("poi_pedestrian_crossings"),
+                        {"osm_id":osm_id})
+            for row in crossing_list:
+                signal_lat, signal_lon = geometry.decode_wkb_point(row['geom'])
+                signal = self.create_pedestrian_crossing(int(row['id']), signal_lat, signal_lon,
                         self.parse_hstore_column(row['tags']), row['crossing_street_name'])
                 intersection['pedestrian_crossing_list'].append(signal)
         return intersection
@@ -1536,16 +1582,15 @@ class POI:
         poi['is_inside'] = {}
         if outer_building_id > 0:
             try:
-                result = self.selected_db.fetch_one(
-                        sql.SQL(
-                            """
-                            SELECT ST_X(geom) as x, ST_Y(geom) as y, tags
-                                FROM outer_buildings
-                                WHERE id = {p_outer_building_id}
-                            """
-                            ).format(
-                                    p_outer_building_id=sql.Placeholder(name='outer_building_id')),
-                        {"outer_building_id":outer_building_id})
+                if outer_building_id in self.outer_building_cache:
+                    result = self.outer_building_cache.get(outer_building_id)
+                    if not result:
+                        raise DBControl.DatabaseResultEmptyError("No result for query")
+                else:
+                    result = self.selected_db.fetch_one(
+                            self.get_outer_building_query(),
+                            {"id_list":[outer_building_id]},
+                            query_name="poi_outer_building")
             except DBControl.DatabaseError as e:
                 poi['is_inside'] = {}
             else:
@@ -1557,17 +1602,13 @@ class POI:
         # entrances
         poi['entrance_list'] = []
         if number_of_entrances > 0:
-            for row in self.selected_db.fetch_all(
-                    sql.SQL(
-                        """
-                        SELECT entrance_id, ST_X(geom) as lon, ST_Y(geom) as lat, label, tags
-                            FROM entrances
-                            WHERE poi_id = {p_poi_id}
-                            ORDER BY class
-                        """
-                        ).format(
-                                p_poi_id=sql.Placeholder(name='poi_id')),
-                    {"poi_id":poi_id}):
+            if poi_id in self.entrance_cache:
+                entrance_row_list = self.entrance_cache.get(poi_id)
+            else:
+                entrance_row_list = self.selected_db.fetch_all(
+                        self.get_entrance_query(), {"id_list":[poi_id]},
+                        query_name="poi_entrances")
+            for row in entrance_row_list:
                 entrance = self.create_entrance(row['entrance_id'], row['lat'], row['lon'],
                         self.parse_hstore_column(row['tags']), row['label'])
                 poi['entrance_list'].append(entrance)
@@ -1651,7 +1692,8 @@ class POI:
                         """
                         ).format(
                                 p_station_id=sql.Placeholder(name='station_id')),
-                    {"station_id":station_id}):
+                    {"station_id":station_id},
+                    query_name="station_lines"):
                 if "line" not in row:
                     continue
                 line = {"nr":row['line'], "to":""}
@@ -1680,6 +1722,136 @@ class POI:
     # some helper functions
     #####
 
+    def prefetch_outer_buildings_and_entrances(self, poi_row_list):
+        """
+        Load the outer buildings and entrances of all rows of a poi or station
+        query with two queries instead of one query per row
+        """
+        outer_building_id_list = [ int(row['outer_building_id']) \
+                for row in poi_row_list if row['outer_building_id'] > 0 ]
+        outer_building_dict = self.selected_db.fetch_by_ids(
+                self.get_outer_building_query(), "id", outer_building_id_list,
+                query_name="poi_prefetch_outer_buildings")
+        for outer_building_id in outer_building_id_list:
+            self.outer_building_cache[outer_building_id] = outer_building_dict.get(outer_building_id)
+
+        poi_id_list = [ int(row['id']) \
+                for row in poi_row_list if row['number_of_entrances'] > 0 ]
+        entrance_dict = self.selected_db.fetch_by_ids(
+                self.get_entrance_query(), "poi_id", poi_id_list, multiple_rows_per_id=True,
+                query_name="poi_prefetch_entrances")
+        for poi_id in poi_id_list:
+            self.entrance_cache[poi_id] = entrance_dict.get(poi_id, [])
+
+    def prefetch_route_objects(self, osm_node_id_list, osm_way_id_list):
+        """
+        Load the way points, intersections with their ways and crossings and
+        the way segments of a route section with a fixed number of queries
+        instead of several queries per route point
+        """
+        osm_node_id_list = list(set(osm_node_id_list))
+        osm_way_id_list = list(set(osm_way_id_list))
+        # way points
+        way_point_dict = self.selected_db.fetch_by_ids(
+                sql.SQL(
+                    """
+                    SELECT id, ST_AsBinary(geom) AS geom, tags
+                        FROM nodes
+                        WHERE id = ANY({p_id_list})
+                    """
+                    ).format(
+                        p_id_list=sql.Placeholder(name='id_list')),
+                "id", osm_node_id_list,
+                query_name="poi_prefetch_way_points")
+        for osm_node_id in osm_node_id_list:
+            self.way_point_cache[osm_node_id] = way_point_dict.get(osm_node_id)
+
+        # intersections
+        intersection_dict = self.selected_db.fetch_by_ids(
+                sql.SQL(
+                    """
+                    SELECT id, ST_AsBinary(geom) AS geom, name, tags,
+                            number_of_streets, number_of_streets_with_name, number_of_traffic_signals
+                        FROM {i_intersection_table_name}
+                        WHERE id = ANY({p_id_list})
+                    """
+                    ).format(
+                        i_intersection_table_name=sql.Identifier(Config().database.get("intersection_table")),
+                        p_id_list=sql.Placeholder(name='id_list')),
+                "id", osm_node_id_list,
+                query_name="poi_prefetch_intersections")
+        for osm_node_id in osm_node_id_list:
+            self.intersection_cache[osm_node_id] = intersection_dict.get(osm_node_id)
+        # their ways
+        intersection_id_list = list(intersection_dict.keys())
+        intersection_data_dict = self.selected_db.fetch_by_ids(
+                sql.SQL(
+                    """
+                    SELECT id, way_id, node_id, direction, way_tags, node_tags,
+                            ST_AsBinary(geom) AS geom
+                        FROM {i_intersection_data_table_name}
+                        WHERE id = ANY({p_id_list})
+                    """
+                    ).format(
+                        i_intersection_data_table_name=sql.Identifier(Config().database.get("intersection_data_table")),
+                        p_id_list=sql.Placeholder(name='id_list')),
+                "id", intersection_id_list, multiple_rows_per_id=True,
+                query_name="poi_prefetch_intersection_data")
+        for intersection_id in intersection_id_list:
+            self.intersection_data_cache[intersection_id] = intersection_data_dict.get(intersection_id, [])
+        # and crossings
+        intersection_id_list = [ intersection_id \
+                for intersection_id, row in intersection_dict.items() if row['number_of_traffic_signals'] > 0 ]
+        pedestrian_crossing_dict = self.selected_db.fetch_by_ids(
+                sql.SQL(
+                    """
+                    SELECT id, intersection_id, ST_AsBinary(geom) AS geom, crossing_street_name, tags
+                        FROM pedestrian_crossings
+                        WHERE intersection_id = ANY({p_id_list})
+                    """
+                    ).format(
+                        p_id_list=sql.Placeholder(name='id_list')),
+                "intersection_id", intersection_id_list, multiple_rows_per_id=True,
+                query_name="poi_prefetch_pedestrian_crossings")
+        for intersection_id in intersection_id_list:
+            self.pedestrian_crossing_cache[intersection_id] = pedestrian_crossing_dict.get(intersection_id, [])
+
+        # way segments
+        way_segment_dict = self.selected_db.fetch_by_ids(
+                sql.SQL(
+                    """
+                    SELECT id, tags
+                        FROM ways
+                        WHERE id = ANY({p_id_list})
+                    """
+                    ).format(
+                        p_id_list=sql.Placeholder(name='id_list')),
+                "id", osm_way_id_list,
+                query_name="poi_prefetch_way_segments")
+        for osm_way_id in osm_way_id_list:
+            self.way_segment_cache[osm_way_id] = way_segment_dict.get(osm_way_id)
+
+    def get_outer_building_query(self):
+        return sql.SQL(
+                """
+                SELECT id, ST_X(geom) as x, ST_Y(geom) as y, tags
+                    FROM outer_buildings
+                    WHERE id = ANY({p_id_list})
+                """
+                ).format(
+                        p_id_list=sql.Placeholder(name='id_list'))
+
+    def get_entrance_query(self):
+        return sql.SQL(
+                """
+                SELECT poi_id, entrance_id, ST_X(geom) as lon, ST_Y(geom) as lat, label, tags
+                    FROM entrances
+                    WHERE poi_id = ANY({p_id_list})
+                    ORDER BY poi_id, class
+                """
+                ).format(
+                        p_id_list=sql.Placeholder(name='id_list'))
+
     def get_boundary_box_query_and_params(self, lat, lon, radius):
         # check params
         try:
@@ -1738,7 +1910,8 @@ class POI:
                         ).format(
                             i_table_name=sql.Identifier("nodes"),
                             c_boundary_box_query=boundary_box_query),
-                        boundary_box_query_params)
+                        boundary_box_query_params,
+                    query_name="map_boundary_check")
         except DBControl.DatabaseResultEmptyError as e:
             raise WebserverException(ReturnCode.WRONG_MAP_SELECTED)
 
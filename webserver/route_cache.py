@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections, json, sys, threading, time
+
+from .config import Config
+
+
+class RouteCache():
+    """
+    Process wide LRU cache of calculated routes
+
+    Routes are stored as json strings, so the memory cap is measured in bytes
+    and every hit returns a fresh copy, which the caller may modify. Entries
+    expire after the configured time to live and all entries of a map are
+    dropped, once the map database was recreated.
+    """
+    # key -> CacheEntry, least recently used first
+    entries = collections.OrderedDict()
+    lock = threading.Lock()
+    # map id -> creation timestamp of the map database, the cached routes belong to
+    map_created_by_map_id = {}
+    size_in_bytes = 0
+    # counters
+    hits = 0
+    misses = 0
+    evictions = 0
+    invalidations = 0
+    # route point coordinates are rounded to about one meter
+    coordinate_precision = 5
+
+
+    @staticmethod
+    def create_key(map_id, point_list, way_class_id_and_weight_map, way_ids_to_exclude,
+            user_language, prefer_translated_strings_in_osm_tags, routing_algorithm):
+        # the route points become part of the route, so all their properties are relevant
+        rounded_point_list = []
+        for point in point_list:
+            rounded_point = dict(point)
+            rounded_point['lat'] = round(point['lat'], RouteCache.coordinate_precision)
+            rounded_point['lon'] = round(point['lon'], RouteCache.coordinate_precision)
+            rounded_point_list.append(rounded_point)
+        return (
+                map_id,
+                json.dumps(rounded_point_list, sort_keys=True),
+                tuple(sorted(way_class_id_and_weight_map.items())),
+                tuple(sorted(set(way_ids_to_exclude))),
+                user_language,
+                bool(prefer_translated_strings_in_osm_tags),
+                routing_algorithm)
+
+    @staticmethod
+    def is_enabled():
+        return Config().webserver.get("route_cache_size_in_mb") > 0
+
+
+    @staticmethod
+    def get(key, map_created):
+        """ returns a copy of the cached route or None """
+        with RouteCache.lock:
+            RouteCache.check_map_created(key[0], map_created)
+            entry = RouteCache.entries.get(key)
+            if entry and entry.expires < time.time():
+                RouteCache.remove(key)
+                entry = None
+            if not entry:
+                RouteCache.misses += 1
+                return None
+            RouteCache.entries.move_to_end(key)
+            RouteCache.hits += 1
+            route_json = entry.route_json
+        return json.loads(route_json)
+
+    @staticmethod
+    def put(key, map_created, route):
+        route_json = json.dumps(route)
+        entry = RouteCache.CacheEntry(
+                route_json, time.time() + Config().webserver.get("route_cache_ttl"))
+        max_size_in_bytes = Config().webserver.get("route_cache_size_in_mb") * 1024 * 1024
+        if entry.size_in_bytes > max_size_in_bytes:
+            return
+        with RouteCache.lock:
+            RouteCache.check_map_created(key[0], map_created)
+            if key in RouteCache.entries:
+                RouteCache.remove(key)
+            RouteCache.entries[key] = entry
+            RouteCache.size_in_bytes += entry.size_in_bytes
+            # evict least recently used routes
+            while RouteCache.size_in_bytes > max_size_in_bytes:
+                RouteCache.remove(next(iter(RouteCache.entries)))
+                RouteCache.evictions += 1
+
+    @staticmethod
+    def get_statistics():
+        with RouteCache.lock:
+            return {
+                    "number_of_routes" : len(RouteCache.entries),
+                    "size_in_bytes"    : RouteCache.size_in_bytes,
+                    "hits"             : RouteCache.hits,
+                    "misses"           : RouteCache.misses,
+                    "evictions"        : RouteCache.evictions,
+                    "invalidations"    : RouteCache.invalidations }
+
+
+    # the following methods must be called with the lock held
+
+    @staticmethod
+    def check_map_created(map_id, map_created):
+        if RouteCache.map_created_by_map_id.get(map_id) == map_created:
+            return
+        # the map database was recreated, drop all routes of the old one
+        for key in [ key for key in RouteCache.entries if key[0] == map_id ]:
+            RouteCache.remove(key)
+            RouteCache.invalidations += 1
+        RouteCache.map_created_by_map_id[map_id] = map_created
+
+    @staticmethod
+    def remove(key):
+        entry = RouteCache.entries.pop(key)
+        RouteCache.size_in_bytes -= entry.size_in_bytes
+
+
+    class CacheEntry:
+
+        def __init__(self, route_json, expires):
+            self.route_json = route_json
+            self.expires = expires
+            # memory of the string object, including its header
+            self.size_in_bytes = sys.getsizeof(route_json)
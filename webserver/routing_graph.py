@@ -0,0 +1,780 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import bisect, contextlib, heapq, logging, math, os, threading, time
+from array import array
+from psycopg2 import sql
+
+from . import geometry
+from .config import Config
+from .constants import ReturnCode
+from .contraction_hierarchy import ContractionHierarchy
+from .db_control import DBControl
+from .helper import WebserverException
+
+
+class RoutingGraph():
+    """
+    Compact in-memory copy of the routing table of a map
+
+    Vertices are renumbered to 0..n-1. The undirected adjacency is stored in
+    compressed sparse row format: the neighbours of vertex v are
+    adjacency_vertex[adjacency_offset[v]:adjacency_offset[v+1]], connected by
+    the edges at the same positions of adjacency_edge. All per vertex and per
+    edge attributes live in typed arrays.
+
+    The graph is read-only after loading, so it's shared by all request
+    threads. Per-request way class weights and blocked ways are a small
+    RoutingOverlay, which is applied during the search.
+    """
+    # map id -> routing graph
+    routing_graphs = {}
+    routing_graphs_lock = threading.Lock()
+    # map id -> lock, which serializes the loading of a single map
+    loading_locks = {}
+    # lowers the a* heuristic a little, see create_heuristic
+    heuristic_slack = 0.99
+    # cost of a blocked or impassable edge in km, if the search may use them
+    # multiplied with the largest weight it exceeds every path within a boundary box
+    ignored_edge_penalty = 1000000.0
+    # spatial index
+    edges_per_grid_cell = 8
+    meters_per_degree = 6367000 * math.pi / 180
+
+
+    #####
+    # routing graph registry
+    #####
+
+    @staticmethod
+    def init_routing_graphs():
+        for map_id, map_data in Config().maps.items():
+            if map_data.get("routing_engine") == "graph":
+                try:
+                    RoutingGraph.get_routing_graph(map_id)
+                except (WebserverException, DBControl.DatabaseError) as e:
+                    logging.warning("Routing graph of map {}: {}".format(map_id, e))
+
+    @staticmethod
+    def get_routing_graph(map_id):
+        """
+        Returns the routing graph of the map. It's loaded on first use and
+        reloaded, if the map database was recreated in the meantime.
+        """
+        map_created = DBControl(map_id).map_created
+        with RoutingGraph.routing_graphs_lock:
+            routing_graph = RoutingGraph.routing_graphs.get(map_id)
+            if routing_graph and routing_graph.map_created == map_created:
+                return routing_graph
+            loading_lock = RoutingGraph.loading_locks.setdefault(map_id, threading.Lock())
+        with loading_lock:
+            # another thread may have loaded the graph in the meantime
+            with RoutingGraph.routing_graphs_lock:
+                routing_graph = RoutingGraph.routing_graphs.get(map_id)
+                if routing_graph and routing_graph.map_created == map_created:
+                    return routing_graph
+            routing_graph = RoutingGraph(map_id)
+            with RoutingGraph.routing_graphs_lock:
+                RoutingGraph.routing_graphs[map_id] = routing_graph
+            return routing_graph
+
+    @staticmethod
+    def get_statistics():
+        with RoutingGraph.routing_graphs_lock:
+            routing_graph_list = list(RoutingGraph.routing_graphs.values())
+        statistics = {}
+        for routing_graph in routing_graph_list:
+            statistics[routing_graph.map_id] = {
+                    "number_of_vertices" : routing_graph.number_of_vertices,
+                    "number_of_edges"    : routing_graph.number_of_edges,
+                    "loading_time_in_seconds" : routing_graph.loading_time,
+                    "spatial_index_built"     : routing_graph.grid_offset is not None,
+                    "contraction_hierarchy_loaded" : bool(routing_graph.contraction_hierarchy) }
+        return statistics
+
+
+    #####
+    # loading
+    #####
+
+    def __init__(self, map_id):
+        start = time.time()
+        db = DBControl(map_id)
+        self.map_id = map_id
+        self.map_created = db.map_created
+
+        # vertices
+        self.vertex_index_by_id = {}
+        self.vertex_id = array('q')
+        self.vertex_lat = array('d')
+        self.vertex_lon = array('d')
+        # edges
+        self.edge_id = array('q')
+        self.edge_source = array('l')
+        self.edge_target = array('l')
+        self.edge_km = array('d')
+        self.edge_way_class = array('b')
+        self.edge_osm_id = array('q')
+        self.edge_osm_source_id = array('q')
+        self.edge_osm_target_id = array('q')
+        # edge geometries: the flat coordinates of edge e are
+        # edge_coordinates[edge_coordinate_offset[e]:edge_coordinate_offset[e+1]]
+        self.edge_coordinate_offset = array('l', [0])
+        self.edge_coordinates = array('d')
+
+        with contextlib.closing(
+                db.fetch_iter(
+                    sql.SQL(
+                        """
+                        SELECT id, source, target, km, kmh, osm_id, osm_source_id, osm_target_id,
+                                x1, y1, x2, y2, ST_AsBinary(geom_way) AS geom_way
+                            FROM {i_routing_table}
+                        """
+                        ).format(
+                            i_routing_table=sql.Identifier(Config().database.get("routing_table"))),
+                    batch_size=50000,
+                    query_name="routing_graph_edges")
+                ) as row_iterator:
+            for row in row_iterator:
+                self.edge_id.append(row['id'])
+                self.edge_source.append(
+                        self.add_vertex(row['source'], row['y1'], row['x1']))
+                self.edge_target.append(
+                        self.add_vertex(row['target'], row['y2'], row['x2']))
+                self.edge_km.append(row['km'])
+                self.edge_way_class.append(row['kmh'])
+                self.edge_osm_id.append(row['osm_id'])
+                self.edge_osm_source_id.append(row['osm_source_id'])
+                self.edge_osm_target_id.append(row['osm_target_id'])
+                self.edge_coordinates.extend(geometry.decode_wkb(row['geom_way']))
+                self.edge_coordinate_offset.append(len(self.edge_coordinates))
+        self.number_of_vertices = len(self.vertex_id)
+        self.number_of_edges = len(self.edge_id)
+        if not self.number_of_edges:
+            raise WebserverException(
+                    ReturnCode.MAP_LOADING_FAILED,
+                    "Routing table of map {} is empty".format(map_id))
+
+        # undirected csr adjacency: count the degree of every vertex
+        self.adjacency_offset = array('l', bytes(array('l').itemsize * (self.number_of_vertices + 1)))
+        for edge_index in range(self.number_of_edges):
+            self.adjacency_offset[self.edge_source[edge_index] + 1] += 1
+            self.adjacency_offset[self.edge_target[edge_index] + 1] += 1
+        for vertex_index in range(self.number_of_vertices):
+            self.adjacency_offset[vertex_index + 1] += self.adjacency_offset[vertex_index]
+        # fill
+        self.adjacency_vertex = array('l', bytes(array('l').itemsize * 2 * self.number_of_edges))
+        self.adjacency_edge = array('l', bytes(array('l').itemsize * 2 * self.number_of_edges))
+        next_position = array('l', self.adjacency_offset[:-1])
+        for edge_index in range(self.number_of_edges):
+            source = self.edge_source[edge_index]
+            target = self.edge_target[edge_index]
+            self.adjacency_vertex[next_position[source]] = target
+            self.adjacency_edge[next_position[source]] = edge_index
+            next_position[source] += 1
+            self.adjacency_vertex[next_position[target]] = source
+            self.adjacency_edge[next_position[target]] = edge_index
+            next_position[target] += 1
+
+        # osm way id -> edge indices: the edges of the way way_osm_id[i] are
+        # way_edge[way_edge_offset[i]:way_edge_offset[i+1]], ordered by edge id
+        self.way_osm_id = array('q')
+        self.way_edge_offset = array('l')
+        self.way_edge = array(
+                'l',
+                sorted(
+                    range(self.number_of_edges),
+                    key=lambda edge_index: (self.edge_osm_id[edge_index], self.edge_id[edge_index])))
+        for position, edge_index in enumerate(self.way_edge):
+            if not self.way_osm_id or self.way_osm_id[-1] != self.edge_osm_id[edge_index]:
+                self.way_osm_id.append(self.edge_osm_id[edge_index])
+                self.way_edge_offset.append(position)
+        self.way_edge_offset.append(self.number_of_edges)
+
+        # the spatial index is built on first use
+        self.spatial_index_lock = threading.Lock()
+        self.grid_offset = None
+        # the contraction hierarchy is loaded on first use, False = not yet tried
+        self.contraction_hierarchy_lock = threading.Lock()
+        self.contraction_hierarchy = False
+
+        self.loading_time = int(time.time() - start)
+        logging.info(
+                "Routing graph of map {} loaded: {} vertices, {} edges in {} seconds".format(
+                    map_id, self.number_of_vertices, self.number_of_edges, self.loading_time))
+
+    def get_edges_of_way(self, osm_id):
+        """ edge indices of the osm way, ordered by edge id """
+        position = bisect.bisect_left(self.way_osm_id, osm_id)
+        if position == len(self.way_osm_id) or self.way_osm_id[position] != osm_id:
+            return array('l')
+        return self.way_edge[self.way_edge_offset[position] : self.way_edge_offset[position+1]]
+
+    def get_way_class(self, osm_id, boundaries=None):
+        """
+        Way class of the osm way like the routing table query
+        SELECT DISTINCT ON (osm_id) kmh ... ORDER BY osm_id, id: the one of the
+        edge with the lowest id, whose bounding box intersects the boundaries.
+        None, if there is no such edge.
+        """
+        for edge_index in self.get_edges_of_way(osm_id):
+            if not boundaries or self.edge_intersects_boundaries(edge_index, boundaries):
+                return self.edge_way_class[edge_index]
+        return None
+
+    def add_vertex(self, vertex_id, lat, lon):
+        vertex_index = self.vertex_index_by_id.get(vertex_id)
+        if vertex_index is None:
+            vertex_index = len(self.vertex_id)
+            self.vertex_index_by_id[vertex_id] = vertex_index
+            self.vertex_id.append(vertex_id)
+            self.vertex_lat.append(lat)
+            self.vertex_lon.append(lon)
+        return vertex_index
+
+
+    #####
+    # spatial index
+    #####
+
+    def build_spatial_index(self):
+        """
+        Uniform grid over the bounding boxes of the edge geometries with about
+        edges_per_grid_cell edges per cell. Like the adjacency, the cells are
+        stored in compressed sparse row format: grid cell c contains the edges
+        grid_edge[grid_offset[c]:grid_offset[c+1]].
+        """
+        start = time.time()
+        left, right = min(self.vertex_lon), max(self.vertex_lon)
+        bottom, top = min(self.vertex_lat), max(self.vertex_lat)
+        # edge geometries may exceed their end vertices
+        for edge_index in range(self.number_of_edges):
+            coordinates = self.get_edge_coordinates(edge_index)
+            left, right = min(left, min(coordinates[0::2])), max(right, max(coordinates[0::2]))
+            bottom, top = min(bottom, min(coordinates[1::2])), max(top, max(coordinates[1::2]))
+        # square cells in meters
+        cos_lat = math.cos(math.radians((bottom + top) / 2))
+        area = max((right - left) * cos_lat, 1e-6) * max(top - bottom, 1e-6)
+        number_of_cells = max(1, self.number_of_edges // RoutingGraph.edges_per_grid_cell)
+        cell_height = math.sqrt(area / number_of_cells)
+        cell_width = cell_height / cos_lat
+        columns = int((right - left) / cell_width) + 1
+        rows = int((top - bottom) / cell_height) + 1
+
+        def get_cell_range(edge_index):
+            coordinates = self.get_edge_coordinates(edge_index)
+            return (
+                    int((min(coordinates[0::2]) - left) / cell_width),
+                    int((max(coordinates[0::2]) - left) / cell_width),
+                    int((min(coordinates[1::2]) - bottom) / cell_height),
+                    int((max(coordinates[1::2]) - bottom) / cell_height))
+
+        # count the edges per cell
+        grid_offset = array('l', bytes(array('l').itemsize * (columns * rows + 1)))
+        for edge_index in range(self.number_of_edges):
+            first_column, last_column, first_row, last_row = get_cell_range(edge_index)
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    grid_offset[row * columns + column + 1] += 1
+        for cell in range(columns * rows):
+            grid_offset[cell + 1] += grid_offset[cell]
+        # fill
+        grid_edge = array('l', bytes(array('l').itemsize * grid_offset[-1]))
+        next_position = array('l', grid_offset[:-1])
+        for edge_index in range(self.number_of_edges):
+            first_column, last_column, first_row, last_row = get_cell_range(edge_index)
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    cell = row * columns + column
+                    grid_edge[next_position[cell]] = edge_index
+                    next_position[cell] += 1
+
+        self.grid_left, self.grid_bottom = left, bottom
+        self.grid_cell_width, self.grid_cell_height = cell_width, cell_height
+        self.grid_columns, self.grid_rows = columns, rows
+        self.grid_edge = grid_edge
+        # set last, it marks the index as complete for other threads
+        self.grid_offset = grid_offset
+        logging.info(
+                "Spatial index of map {}: {}x{} cells in {} seconds".format(
+                    self.map_id, columns, rows, int(time.time() - start)))
+
+    def get_edge_coordinates(self, edge_index):
+        """ flat coordinate array of the edge geometry: lon1, lat1, lon2, lat2, ... """
+        return self.edge_coordinates[
+                self.edge_coordinate_offset[edge_index] : self.edge_coordinate_offset[edge_index+1]]
+
+    def edge_intersects_boundaries(self, edge_index, boundaries):
+        """ bounding box of the edge geometry overlaps the boundaries, like geom_way && ST_MakeEnvelope(...) """
+        coordinates = self.get_edge_coordinates(edge_index)
+        return max(coordinates[0::2]) >= boundaries['left'] \
+                and min(coordinates[0::2]) <= boundaries['right'] \
+                and max(coordinates[1::2]) >= boundaries['bottom'] \
+                and min(coordinates[1::2]) <= boundaries['top']
+
+    def find_nearest_edges(self, lat, lon, number_of_edges=1, edge_filter=None):
+        """
+        The closest edges to the point, ordered by distance. Impassable edges
+        (way class 7) are skipped. edge_filter: optional function, which gets
+        the edge index and returns False for edges to skip.
+
+        The search visits the grid cells in growing square rings around the
+        point. Edges outside of the visited rings are at least as far away as
+        the ring border, so it stops, when enough closer edges are found.
+        Returns a list of RoutingGraph.EdgeProjection.
+        """
+        if self.grid_offset is None:
+            with self.spatial_index_lock:
+                if self.grid_offset is None:
+                    self.build_spatial_index()
+        grid_offset = self.grid_offset
+        grid_edge = self.grid_edge
+        columns, rows = self.grid_columns, self.grid_rows
+        point_column = int((lon - self.grid_left) / self.grid_cell_width)
+        point_row = int((lat - self.grid_bottom) / self.grid_cell_height)
+        # minimal distance between the point and a not yet visited cell per ring
+        ring_distance = min(
+                self.grid_cell_height,
+                self.grid_cell_width * math.cos(math.radians(lat))) * RoutingGraph.meters_per_degree
+
+        visited_edge_set = set()
+        projection_list = []
+        max_radius = max(columns, rows) + abs(point_column) + abs(point_row)
+        for radius in range(max_radius + 1):
+            for row in range(point_row - radius, point_row + radius + 1):
+                if row < 0 or row >= rows:
+                    continue
+                # the whole first and last row of the ring, otherwise only both ends
+                if row in (point_row - radius, point_row + radius):
+                    column_list = range(point_column - radius, point_column + radius + 1)
+                else:
+                    column_list = (point_column - radius, point_column + radius) if radius else (point_column,)
+                for column in column_list:
+                    if column < 0 or column >= columns:
+                        continue
+                    cell = row * columns + column
+                    for position in range(grid_offset[cell], grid_offset[cell+1]):
+                        edge_index = grid_edge[position]
+                        if edge_index in visited_edge_set:
+                            continue
+                        visited_edge_set.add(edge_index)
+                        if self.edge_way_class[edge_index] == 7 \
+                                or (edge_filter and not edge_filter(edge_index)):
+                            continue
+                        projection_list.append(self.project_onto_edge(edge_index, lat, lon))
+            projection_list.sort(key=lambda projection: projection.distance)
+            del projection_list[number_of_edges:]
+            if len(projection_list) == number_of_edges \
+                    and projection_list[-1].distance <= radius * ring_distance:
+                break
+        return projection_list
+
+    def project_onto_edge(self, edge_index, lat, lon):
+        """
+        Closest point on the edge geometry. The distance is measured with an
+        equirectangular projection around the point, the fraction refers to the
+        planar length in degrees like ST_LineLocatePoint.
+        """
+        coordinates = self.get_edge_coordinates(edge_index)
+        cos_lat = math.cos(math.radians(lat))
+        best = None
+        length = 0.0
+        for i in range(0, len(coordinates) - 2, 2):
+            x1, y1, x2, y2 = coordinates[i], coordinates[i+1], coordinates[i+2], coordinates[i+3]
+            # scaled coordinates, relative to the point
+            ax, ay = (x1 - lon) * cos_lat, y1 - lat
+            dx, dy = (x2 - x1) * cos_lat, y2 - y1
+            squared_segment_length = dx * dx + dy * dy
+            t = min(1.0, max(0.0, -(ax * dx + ay * dy) / squared_segment_length)) \
+                    if squared_segment_length else 0.0
+            squared_distance = (ax + t * dx) ** 2 + (ay + t * dy) ** 2
+            segment_length = math.hypot(x2 - x1, y2 - y1)
+            if best is None or squared_distance < best[0]:
+                best = (squared_distance, length + t * segment_length,
+                        y1 + t * (y2 - y1), x1 + t * (x2 - x1))
+            length += segment_length
+        squared_distance, position, projection_lat, projection_lon = best
+        return RoutingGraph.EdgeProjection(
+                edge_index,
+                math.sqrt(squared_distance) * RoutingGraph.meters_per_degree,
+                position / length if length else 0.0,
+                projection_lat, projection_lon)
+
+
+    #####
+    # contraction hierarchy
+    #####
+
+    @staticmethod
+    def get_contraction_hierarchy_file(map_id):
+        return os.path.join(
+                Config().paths.get("contraction_hierarchy_folder"), "%s.cch" % map_id)
+
+    def create_contraction_hierarchy(self):
+        """ computes the contraction hierarchy and stores it next to the other maps """
+        contraction_hierarchy = ContractionHierarchy.create(self)
+        contraction_hierarchy.save(RoutingGraph.get_contraction_hierarchy_file(self.map_id))
+        with self.contraction_hierarchy_lock:
+            self.contraction_hierarchy = contraction_hierarchy
+
+    def get_contraction_hierarchy(self):
+        """ returns None, if the contraction hierarchy of the map wasn't created yet """
+        if self.contraction_hierarchy is False:
+            with self.contraction_hierarchy_lock:
+                if self.contraction_hierarchy is False:
+                    self.contraction_hierarchy = ContractionHierarchy.load(
+                            self, RoutingGraph.get_contraction_hierarchy_file(self.map_id))
+                    if not self.contraction_hierarchy:
+                        logging.warning(
+                                "No contraction hierarchy for map {}, run create-contraction-hierarchy".format(
+                                    self.map_id))
+        return self.contraction_hierarchy
+
+
+    #####
+    # path search
+    #####
+
+    @staticmethod
+    def create_weight_list(way_class_id_and_weight_map):
+        """
+        Cost multiplier per way class id, None for impassable classes. Like
+        pgRouting, edges with a negative cost are ignored.
+        """
+        weight_list = [None] * 8
+        for way_class_id, weight in way_class_id_and_weight_map.items():
+            if 0 <= way_class_id < 7 and weight > 0:
+                weight_list[way_class_id] = weight
+        return weight_list
+
+    def find_path(self, start_vertex_id, dest_vertex_id, routing_overlay,
+            boundaries=None, algorithm="dijkstra"):
+        """
+        Shortest path from the start to the destination vertex (original vertex ids)
+        See find_path_between_candidates for the other params.
+        """
+        return self.find_path_between_candidates(
+                {start_vertex_id: 0.0}, {dest_vertex_id: 0.0}, routing_overlay,
+                boundaries, algorithm)
+
+    def find_path_between_candidates(self, start_cost_map, dest_cost_map, routing_overlay,
+            boundaries=None, algorithm="dijkstra", penalty=None):
+        """
+        Single search from all start to all destination candidates (original
+        vertex ids). The maps contain the initial cost of every candidate, e.g.
+        the snap distance. The search ends at the first settled destination, so
+        the result is the cheapest combination of candidates and path.
+
+        routing_overlay: way class weights and blocked ways of the request
+        boundaries: dict with left, bottom, right and top; if given, only
+            edges, whose geometry bounding box overlaps them, are used. This
+            equals the geom_way && ST_MakeEnvelope(...) filter of the pgrouting
+            engine, so an edge, which crosses the box with both end points
+            outside, is kept too
+        algorithm: dijkstra, astar, bidirectional or contraction_hierarchy (see
+            constants). The contraction hierarchy ignores the boundaries. Without
+            one, with blocked ways or while the metric for the weight list is
+            customized, the bidirectional search is used instead
+        penalty: if given, blocked and impassable edges are used at the cost
+            of their length plus penalty instead of being ignored. With a
+            large penalty a path without ignored edges is preferred, if there
+            is one, see Path.number_of_ignored_edges
+        Returns a RoutingGraph.Path or None, if no destination is reachable.
+        """
+        start_cost_by_index = {
+                self.vertex_index_by_id[vertex_id]: cost \
+                for vertex_id, cost in start_cost_map.items() if vertex_id in self.vertex_index_by_id }
+        dest_cost_by_index = {
+                self.vertex_index_by_id[vertex_id]: cost \
+                for vertex_id, cost in dest_cost_map.items() if vertex_id in self.vertex_index_by_id }
+        if not start_cost_by_index or not dest_cost_by_index:
+            return None
+        edge_filter = RoutingGraph.EdgeFilter(self, routing_overlay, boundaries, penalty)
+
+        contraction_hierarchy = metric = None
+        if algorithm == "contraction_hierarchy" and not routing_overlay.blocked_edge_set:
+            contraction_hierarchy = self.get_contraction_hierarchy()
+            if contraction_hierarchy:
+                metric = contraction_hierarchy.get_metric(
+                        routing_overlay.weight_list, penalty, wait=False)
+
+        if metric:
+            result = contraction_hierarchy.search(
+                    metric, start_cost_by_index, dest_cost_by_index)
+        elif algorithm in ["bidirectional", "contraction_hierarchy"]:
+            result = self.search_bidirectional(
+                    start_cost_by_index, dest_cost_by_index, edge_filter)
+        elif algorithm == "astar":
+            result = self.search(
+                    start_cost_by_index, dest_cost_by_index, edge_filter,
+                    self.create_heuristic(dest_cost_by_index, routing_overlay.weight_list))
+        else:
+            result = self.search(start_cost_by_index, dest_cost_by_index, edge_filter)
+        if not result:
+            return None
+        start, edge_list, number_of_settled_vertices = result
+
+        # vertices along the edge list
+        vertex_list = [start]
+        for edge in edge_list:
+            vertex_list.append(
+                    self.edge_target[edge] \
+                        if self.edge_source[edge] == vertex_list[-1] else self.edge_source[edge])
+        return RoutingGraph.Path(
+                [ self.vertex_id[vertex] for vertex in vertex_list ],
+                [ self.edge_id[edge] for edge in edge_list ],
+                [ edge_filter.get_cost(edge) for edge in edge_list ],
+                number_of_settled_vertices,
+                len([ edge for edge in edge_list if edge_filter.is_ignored(edge) ]))
+
+    def create_heuristic(self, dest_cost_by_index, weight_list):
+        """
+        Lower bound of the remaining cost for a*: the great circle distance to
+        the destination, multiplied with the smallest way class weight. The
+        edge lengths of osm2po are not always exactly equal to the great circle
+        distance of their end points, therefore the bound is lowered slightly
+        to stay admissible.
+
+        With several destination candidates the distance to one of them is
+        reduced by the radius of the candidate set, which keeps the bound below
+        the distance to every candidate.
+        """
+        min_weight = min(
+                [ weight for weight in weight_list if weight is not None ], default=0.0)
+        factor = min_weight * RoutingGraph.heuristic_slack / 1000
+        vertex_lat = self.vertex_lat
+        vertex_lon = self.vertex_lon
+        dest = next(iter(dest_cost_by_index))
+        dest_lat, dest_lon = vertex_lat[dest], vertex_lon[dest]
+        radius = max(
+                [ geometry.distance_between_two_points_as_float(
+                    vertex_lat[vertex], vertex_lon[vertex], dest_lat, dest_lon) \
+                  for vertex in dest_cost_by_index ])
+        def heuristic(vertex):
+            distance = geometry.distance_between_two_points_as_float(
+                    vertex_lat[vertex], vertex_lon[vertex], dest_lat, dest_lon)
+            return (distance - radius) * factor if distance > radius else 0.0
+        return heuristic
+
+    def search(self, start_cost_by_index, dest_cost_by_index, edge_filter, heuristic=None):
+        """
+        Dijkstra or, if a heuristic is given, a* (vertex indices)
+
+        Settled destination candidates push their total cost, including the
+        destination cost, as negative entry -1-vertex into the heap. The first
+        popped negative entry is the cheapest destination.
+        Returns the start vertex, the edge index list and the number of settled
+        vertices or None.
+        """
+        # local references for speed
+        adjacency_offset = self.adjacency_offset
+        adjacency_vertex = self.adjacency_vertex
+        adjacency_edge = self.adjacency_edge
+        get_edge_cost = edge_filter.get_edge_cost
+
+        cost = dict(start_cost_by_index)
+        predecessor_edge = {}
+        settled = set()
+        heap = [ (vertex_cost + heuristic(vertex) if heuristic else vertex_cost, vertex) \
+                 for vertex, vertex_cost in cost.items() ]
+        heapq.heapify(heap)
+        while heap:
+            _, vertex = heapq.heappop(heap)
+            if vertex < 0:
+                dest = -1 - vertex
+                break
+            if vertex in settled:
+                continue
+            settled.add(vertex)
+            vertex_cost = cost[vertex]
+            if vertex in dest_cost_by_index:
+                heapq.heappush(heap, (vertex_cost + dest_cost_by_index[vertex], -1 - vertex))
+            vertex_inside = edge_filter.is_inside(vertex)
+            for position in range(adjacency_offset[vertex], adjacency_offset[vertex+1]):
+                neighbour = adjacency_vertex[position]
+                if neighbour in settled:
+                    continue
+                edge = adjacency_edge[position]
+                edge_cost = get_edge_cost(edge, vertex_inside, neighbour)
+                if edge_cost is None:
+                    continue
+                neighbour_cost = vertex_cost + edge_cost
+                if neighbour_cost < cost.get(neighbour, math.inf):
+                    cost[neighbour] = neighbour_cost
+                    predecessor_edge[neighbour] = edge
+                    heapq.heappush(
+                            heap,
+                            (neighbour_cost + heuristic(neighbour) if heuristic else neighbour_cost, neighbour))
+        else:
+            return None
+        start, edge_list = self.walk_back(dest, predecessor_edge)
+        return start, edge_list[::-1], len(settled)
+
+    def search_bidirectional(self, start_cost_by_index, dest_cost_by_index, edge_filter):
+        """
+        Bidirectional Dijkstra (vertex indices). The graph is undirected, so
+        the backward search from the destination candidates uses the same
+        adjacency. Both searches alternate and stop, as soon as the sum of
+        their smallest open costs can't improve the best connection found so far.
+        """
+        adjacency_offset = self.adjacency_offset
+        adjacency_vertex = self.adjacency_vertex
+        adjacency_edge = self.adjacency_edge
+        get_edge_cost = edge_filter.get_edge_cost
+
+        # index 0: forward, 1: backward
+        cost = (dict(start_cost_by_index), dict(dest_cost_by_index))
+        predecessor_edge = ({}, {})
+        settled = (set(), set())
+        heap = (
+                [ (vertex_cost, vertex) for vertex, vertex_cost in cost[0].items() ],
+                [ (vertex_cost, vertex) for vertex, vertex_cost in cost[1].items() ])
+        heapq.heapify(heap[0])
+        heapq.heapify(heap[1])
+        best_cost = math.inf
+        meeting_vertex = None
+        for vertex in cost[0].keys() & cost[1].keys():
+            if cost[0][vertex] + cost[1][vertex] < best_cost:
+                best_cost = cost[0][vertex] + cost[1][vertex]
+                meeting_vertex = vertex
+
+        while heap[0] and heap[1] \
+                and heap[0][0][0] + heap[1][0][0] < best_cost:
+            # expand the smaller frontier
+            direction = 0 if len(heap[0]) <= len(heap[1]) else 1
+            vertex_cost, vertex = heapq.heappop(heap[direction])
+            if vertex in settled[direction]:
+                continue
+            settled[direction].add(vertex)
+            own_cost, other_cost = cost[direction], cost[1-direction]
+            vertex_inside = edge_filter.is_inside(vertex)
+            for position in range(adjacency_offset[vertex], adjacency_offset[vertex+1]):
+                neighbour = adjacency_vertex[position]
+                if neighbour in settled[direction]:
+                    continue
+                edge = adjacency_edge[position]
+                edge_cost = get_edge_cost(edge, vertex_inside, neighbour)
+                if edge_cost is None:
+                    continue
+                neighbour_cost = vertex_cost + edge_cost
+                if neighbour_cost < own_cost.get(neighbour, math.inf):
+                    own_cost[neighbour] = neighbour_cost
+                    predecessor_edge[direction][neighbour] = edge
+                    heapq.heappush(heap[direction], (neighbour_cost, neighbour))
+                # connection between both searches
+                if neighbour in other_cost \
+                        and own_cost[neighbour] + other_cost[neighbour] < best_cost:
+                    best_cost = own_cost[neighbour] + other_cost[neighbour]
+                    meeting_vertex = neighbour
+
+        if meeting_vertex is None:
+            return None
+        start, forward_edge_list = self.walk_back(meeting_vertex, predecessor_edge[0])
+        _, backward_edge_list = self.walk_back(meeting_vertex, predecessor_edge[1])
+        return (
+                start,
+                forward_edge_list[::-1] + backward_edge_list,
+                len(settled[0]) + len(settled[1]))
+
+    def walk_back(self, vertex, predecessor_edge):
+        """
+        Follows the predecessor edges from vertex back to the candidate, where
+        the search started. Returns this candidate and the edge indices.
+        """
+        edge_list = []
+        edge = predecessor_edge.get(vertex)
+        while edge is not None:
+            edge_list.append(edge)
+            vertex = self.edge_source[edge] \
+                    if self.edge_target[edge] == vertex else self.edge_target[edge]
+            edge = predecessor_edge.get(vertex)
+        return vertex, edge_list
+
+
+    class EdgeFilter:
+        """ per-request edge costs: routing overlay and boundary box """
+
+        def __init__(self, routing_graph, routing_overlay, boundaries, penalty=None):
+            # local references for speed, get_edge_cost is called for every relaxed edge
+            edge_km = routing_graph.edge_km
+            edge_way_class = routing_graph.edge_way_class
+            weight_list = routing_overlay.weight_list
+            blocked_edge_set = routing_overlay.blocked_edge_set
+            vertex_lat = routing_graph.vertex_lat
+            vertex_lon = routing_graph.vertex_lon
+            if boundaries:
+                left, bottom = boundaries['left'], boundaries['bottom']
+                right, top = boundaries['right'], boundaries['top']
+
+            def is_inside(vertex):
+                return not boundaries \
+                        or (left <= vertex_lon[vertex] <= right and bottom <= vertex_lat[vertex] <= top)
+
+            def is_ignored(edge):
+                """ blocked or impassable """
+                return weight_list[edge_way_class[edge]] is None or edge in blocked_edge_set
+
+            def get_cost(edge):
+                """ edge cost or None, if the edge must not be used """
+                weight = weight_list[edge_way_class[edge]]
+                if weight is None or edge in blocked_edge_set:
+                    return None if penalty is None else edge_km[edge] + penalty
+                return edge_km[edge] * weight
+
+            def get_edge_cost(edge, vertex_inside, neighbour):
+                """ like get_cost, but also applies the boundary box """
+                if not vertex_inside and not is_inside(neighbour) \
+                        and not routing_graph.edge_intersects_boundaries(edge, boundaries):
+                    # both end points outside, the rare case of a crossing edge needs its geometry
+                    return None
+                return get_cost(edge)
+
+            self.is_inside = is_inside
+            self.is_ignored = is_ignored
+            self.get_cost = get_cost
+            self.get_edge_cost = get_edge_cost
+
+
+    class RoutingOverlay:
+        """
+        Way class weights and blocked ways of a request on top of the shared
+        routing graph. The blocked osm way ids are resolved into edge indices
+        once, so the memory only grows with the number of blocked edges.
+        """
+
+        def __init__(self, routing_graph, weight_list, blocked_osm_id_list=None):
+            # cost multiplier per way class id, see create_weight_list
+            self.weight_list = weight_list
+            if blocked_osm_id_list:
+                self.blocked_edge_set = frozenset(
+                        [ edge_index for osm_id in set(blocked_osm_id_list) \
+                            for edge_index in routing_graph.get_edges_of_way(osm_id) ])
+            else:
+                self.blocked_edge_set = frozenset()
+            self.edge_way_class = routing_graph.edge_way_class
+
+        def is_passable(self, edge_index):
+            return self.weight_list[self.edge_way_class[edge_index]] is not None \
+                    and edge_index not in self.blocked_edge_set
+
+
+    class EdgeProjection:
+        def __init__(self, edge_index, distance, fraction, lat, lon):
+            self.edge_index = edge_index
+            # in meters
+            self.distance = distance
+            # position along the edge: 0 = source, 1 = target
+            self.fraction = fraction
+            self.lat = lat
+            self.lon = lon
+
+
+    class Path:
+        def __init__(self, vertex_id_list, edge_id_list, edge_cost_list,
+                number_of_settled_vertices, number_of_ignored_edges=0):
+            self.vertex_id_list = vertex_id_list
+            self.edge_id_list = edge_id_list
+            self.edge_cost_list = edge_cost_list
+            self.cost = sum(edge_cost_list)
+            self.number_of_settled_vertices = number_of_settled_vertices
+            self.number_of_ignored_edges = number_of_ignored_edges
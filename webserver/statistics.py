@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import logging, time
+import contextlib, logging, time
 from psycopg2 import sql
 
 from .db_control import DBControl
@@ -12,14 +12,19 @@ from .config import Config
 ###
 
 def get_access_statistics(db_instance : DBControl):
-    result = db_instance.fetch_all(
-            sql.SQL(
-                """
-                SELECT timestamp FROM {i_access_statistics_table}
-                """
-                ).format(
-                    i_access_statistics_table=sql.Identifier(Config().database.get("access_statistics_table"))))
-    return [ row['timestamp'] for row in result ]
+    """ generator over the access timestamps, streamed from the database """
+    with contextlib.closing(
+            db_instance.fetch_iter(
+                sql.SQL(
+                    """
+                    SELECT timestamp FROM {i_access_statistics_table}
+                    """
+                    ).format(
+                        i_access_statistics_table=sql.Identifier(Config().database.get("access_statistics_table"))),
+                query_name="access_statistics")
+            ) as row_iterator:
+        for row in row_iterator:
+            yield row['timestamp']
 
 
 def add_to_access_statistics(db_instance : DBControl, session_id : str):
@@ -36,7 +41,8 @@ def add_to_access_statistics(db_instance : DBControl, session_id : str):
                             i_access_statistics_table=sql.Identifier(Config().database.get("access_statistics_table")),
                             p_session_id=sql.Placeholder(name='session_id'),
                             p_timestamp=sql.Placeholder(name='timestamp')),
-                        { 'session_id':session_id, "timestamp":int(time.time()) })
+                        { 'session_id':session_id, "timestamp":int(time.time()) },
+                    query_name="access_statistics_upsert")
         except DBControl.DatabaseError as e:
             logging.warning(
                     "add to statistics failed for session id {}. Error: {}".format(session_id, e))
@@ -15,6 +15,8 @@ from .db_control import DBControl
 from .helper import WebserverException, send_email
 from .poi import POI
 from .pedestrian_route import PedestrianRoute
+from .route_cache import RouteCache
+from .routing_graph import RoutingGraph
 
 
 class RoutingWebService():
@@ -78,6 +80,7 @@ class RoutingWebService():
         # create session id
         try:
             session_id = self.create_session_id(input)
+            deadline = self.create_deadline("get_route", input)
         except WebserverException as e:
             cherrypy.response.status = e.return_code
             logging.error(e)
@@ -90,7 +93,8 @@ class RoutingWebService():
             pedestrian_route = PedestrianRoute(
                     input.get("map_id"), session_id, input.get("language"),
                     input.get("allowed_way_classes"), input.get("blocked_ways"),
-                    input.get("prefer_translated_strings_in_osm_tags", False))
+                    input.get("prefer_translated_strings_in_osm_tags", False), deadline,
+                    input.get("routing_algorithm"))
             result['route'] = pedestrian_route.calculate_route(input.get("source_points"))
         except WebserverException as e:
             pedestrian_route = None
@@ -127,6 +131,7 @@ class RoutingWebService():
         # create session id
         try:
             session_id = self.create_session_id(input)
+            deadline = self.create_deadline("get_next_intersections_for_way", input)
         except WebserverException as e:
             cherrypy.response.status = e.return_code
             logging.error(e)
@@ -138,7 +143,7 @@ class RoutingWebService():
         try:
             poi = POI(
                     input.get("map_id"), session_id, input.get("language"),
-                    input.get("prefer_translated_strings_in_osm_tags", False))
+                    input.get("prefer_translated_strings_in_osm_tags", False), deadline)
             next_intersection_list = poi.next_intersections_for_way(
                     input.get("node_id"), input.get("way_id"), input.get("next_node_id"))
         except WebserverException as e:
@@ -172,6 +177,7 @@ class RoutingWebService():
         # create session id
         try:
             session_id = self.create_session_id(input)
+            deadline = self.create_deadline("get_poi", input)
         except WebserverException as e:
             cherrypy.response.status = e.return_code
             logging.error(e)
@@ -183,7 +189,7 @@ class RoutingWebService():
         try:
             poi = POI(
                     input.get("map_id"), session_id, input.get("language"),
-                    input.get("prefer_translated_strings_in_osm_tags", False))
+                    input.get("prefer_translated_strings_in_osm_tags", False), deadline)
             poi_list = poi.get_poi(
                     input.get("lat"), input.get("lon"),
                     input.get("radius"), input.get("number_of_results"),
@@ -219,6 +225,7 @@ class RoutingWebService():
         # create session id
         try:
             session_id = self.create_session_id(input)
+            deadline = self.create_deadline("get_hiking_trails", input)
         except WebserverException as e:
             cherrypy.response.status = e.return_code
             logging.error(e)
@@ -230,7 +237,7 @@ class RoutingWebService():
         try:
             poi = POI(
                     input.get("map_id"), session_id, input.get("language"),
-                    input.get("prefer_translated_strings_in_osm_tags", False))
+                    input.get("prefer_translated_strings_in_osm_tags", False), deadline)
             trail_list = poi.get_hiking_trails(
                     input.get("lat"), input.get("lon"), input.get("radius"))
         except WebserverException as e:
@@ -301,6 +308,8 @@ class RoutingWebService():
             logging.error("Invalid session_id")
         else:
             Config().query_removement_of_session_id(input.get("session_id"))
+            # abort running database queries of that session right away
+            DBControl.cancel_queries_of_session(input.get("session_id"))
         return
 
 
@@ -337,6 +346,17 @@ class RoutingWebService():
         return result
 
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def get_metrics(self):
+        result = {}
+        result['maps'] = DBControl.get_statistics()
+        result['queries'] = DBControl.get_query_statistics()
+        result['routing_graphs'] = RoutingGraph.get_statistics()
+        result['route_cache'] = RouteCache.get_statistics()
+        return result
+
+
     def create_session_id(self, input):
         session_id = input.get("session_id")
         if not session_id:
@@ -346,6 +366,10 @@ class RoutingWebService():
             raise WebserverException(
                     ReturnCode.BAD_REQUEST, "Invalid session_id")
         # check for old sessions and max session limit
+        # a new request supersedes a running one with the same session id: flag it
+        # like cancel_request does and abort its running queries
+        Config().query_removement_of_session_id(session_id)
+        DBControl.cancel_queries_of_session(session_id)
         if not Config().clean_old_session(session_id):
             raise WebserverException(
                     ReturnCode.REQUEST_IN_PROGRESS,
@@ -355,6 +379,17 @@ class RoutingWebService():
                     ReturnCode.SERVICE_UNAVAILABLE, "Webserver unavailable or busy")
         return session_id
 
+    def create_deadline(self, endpoint, input):
+        # the client may shorten, but not extend the configured request timeout
+        timeout = Config().webserver.get("request_timeouts").get(endpoint)
+        if input.get("timeout") is not None:
+            if type(input.get("timeout")) not in [int, float] \
+                    or input.get("timeout") <= 0:
+                raise WebserverException(
+                        ReturnCode.BAD_REQUEST, "Invalid timeout")
+            timeout = min(timeout, input.get("timeout"))
+        return time.time() + timeout
+
 
 
 ###################
@@ -376,6 +411,11 @@ def start():
                 'tools.gzip.mime_types' : ['text/*', 'application/*']
             })
     cherrypy.engine.unsubscribe('graceful', cherrypy.log.reopen_files)
+    # one long-lived connection pool per map, shared by all request handlers
+    DBControl.init_map_databases()
+    cherrypy.engine.subscribe('stop', DBControl.close_map_databases)
+    # in-memory routing graphs of the maps with routing engine "graph"
+    RoutingGraph.init_routing_graphs()
     cherrypy.quickstart(RoutingWebService())
 
 
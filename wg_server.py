@@ -1,15 +1,21 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import argparse, datetime, logging, time
+import argparse, datetime, logging, random, time
 import os, sys
 from subprocess import Popen, PIPE, STDOUT
 
+from psycopg2 import sql
+
 import webserver.statistics as statistics
 import webserver.webserver as webserver
 from webserver.config import Config
 from webserver.db_control import DBControl
-from webserver.constants import server_version, supported_api_version_list, supported_map_version_list
+from webserver.constants import server_version, supported_api_version_list, supported_map_version_list, \
+        supported_routing_algorithm_list, max_distance_between_start_and_destination_in_meters, \
+        max_contraction_hierarchy_vertices
+from webserver.geometry import distance_between_two_points, get_boundary_box
+from webserver.routing_graph import RoutingGraph
 from webserver.helper import exit, pretty_print_table, send_email
 
 
@@ -81,6 +87,22 @@ def create_map_database(map_id):
         map_creation_process = Popen(
                 [Config().paths.get("shell_create_map_database")], stdout=out, stderr=STDOUT)
     return_code = map_creation_process.wait()
+    # the contraction hierarchy belongs to the new map database, but only maps, which route with it,
+    # get it here, without it the contraction_hierarchy algorithm falls back to bidirectional
+    if return_code == 0 \
+            and map.get("routing_algorithm") == "contraction_hierarchy":
+        with open(log_file, "a") as out:
+            try:
+                duration = create_contraction_hierarchy(map_id, max_contraction_hierarchy_vertices)
+            except Exception as e:
+                out.write("\nCreation of the contraction hierarchy failed: {}\n".format(e))
+            else:
+                if duration is None:
+                    out.write(
+                            "\nContraction hierarchy skipped: more than {} vertices, "
+                            "run create-contraction-hierarchy\n".format(max_contraction_hierarchy_vertices))
+                else:
+                    out.write("\nContraction hierarchy created in {} seconds\n".format(duration))
     # send email
     # subject
     if return_code != 0:
@@ -94,6 +116,21 @@ def create_map_database(map_id):
     os.remove(Config().paths.get("shell_lock_file"))
 
 
+def create_contraction_hierarchy(map_id, max_number_of_vertices=None):
+    """ returns the duration in seconds or None, if the routing graph exceeds max_number_of_vertices """
+    print(f"Create contraction hierarchy of map {map_id}")
+    start_time = time.time()
+    routing_graph = RoutingGraph(map_id)
+    if max_number_of_vertices \
+            and routing_graph.number_of_vertices > max_number_of_vertices:
+        logging.warning(
+                "Map {}: Contraction hierarchy skipped, {} vertices exceed the limit of {}".format(
+                    map_id, routing_graph.number_of_vertices, max_number_of_vertices))
+        return None
+    routing_graph.create_contraction_hierarchy()
+    return int(time.time() - start_time)
+
+
 def backup_map_database(map_id, backup_folder):
     print(f"Backup map {map_id} into {backup_folder}")
     _backup_or_restore_map_database(
@@ -127,38 +164,221 @@ def start_webserver():
 
 
 def show_statistics():
-    access_statistics = dict()
+    table = list()
+    # header
+    table.append(
+            ["map", "last 30 days", "last six months", "last year", "total"])
+    # body
+    current_timestamp = int(time.time())
     for map_id, map_data in Config().maps.items():
+        last_thirty_days = last_six_months = last_year = total = 0
         try:
-            access_statistics[map_data['name']] = \
-                    statistics.get_access_statistics(DBControl(map_id))
+            # stream the timestamps instead of loading all of them into memory
+            for timestamp in statistics.get_access_statistics(DBControl(map_id)):
+                if current_timestamp - timestamp < 30*24*60*60:
+                    last_thirty_days += 1
+                if current_timestamp - timestamp < 182*24*60*60:
+                    last_six_months += 1
+                if current_timestamp - timestamp < 365*24*60*60:
+                    last_year += 1
+                total += 1
         except Exception as e:
             logging.error(
                     "Failed to get access statistics for map {}\nError: {}".format(map_id, e))
             sys.exit(1)
+        # add
+        table.append(
+                [map_data['name'], last_thirty_days, last_six_months, last_year, total])
+    print(pretty_print_table(table))
 
+
+def benchmark_routing(map_id, number_of_routes, min_distance):
+    print(f"Load routing graph of map {map_id}")
+    routing_graph = RoutingGraph(map_id)
+    weight_list = RoutingGraph.create_weight_list(
+            { way_class_id:1.0 for way_class_id in range(1, 7) })
+    routing_overlay = RoutingGraph.RoutingOverlay(routing_graph, weight_list)
+
+    # random pairs of vertices
+    print(f"Search {number_of_routes} routes between {min_distance} and "
+            f"{max_distance_between_start_and_destination_in_meters} meters")
+    route_list = []
+    for attempt in range(number_of_routes * 1000):
+        if len(route_list) == number_of_routes:
+            break
+        start = random.randrange(routing_graph.number_of_vertices)
+        dest = random.randrange(routing_graph.number_of_vertices)
+        distance = distance_between_two_points(
+                routing_graph.vertex_lat[start], routing_graph.vertex_lon[start],
+                routing_graph.vertex_lat[dest], routing_graph.vertex_lon[dest])
+        if min_distance <= distance <= max_distance_between_start_and_destination_in_meters:
+            route_list.append(
+                    (routing_graph.vertex_id[start], routing_graph.vertex_id[dest]))
+
+    # run every algorithm on the same routes
     table = list()
-    # header
     table.append(
-            ["map", "last 30 days", "last six months", "last year", "total"])
-    # body
-    current_timestamp = int(time.time())
-    for map_name, timestamp_list in access_statistics.items():
-        last_thirty_days = last_six_months = last_year = 0
-        for timestamp in timestamp_list:
-            if current_timestamp - timestamp < 30*24*60*60:
-                last_thirty_days += 1
-            if current_timestamp - timestamp < 182*24*60*60:
-                last_six_months += 1
-            if current_timestamp - timestamp < 365*24*60*60:
-                last_year += 1
-        total = len(timestamp_list)
-        # add
+            ["algorithm", "routes found", "settled vertices", "reduction", "time in ms"])
+    cost_list_of_dijkstra = None
+    for algorithm in supported_routing_algorithm_list:
+        if algorithm == "contraction_hierarchy":
+            contraction_hierarchy = routing_graph.get_contraction_hierarchy()
+            if not contraction_hierarchy:
+                table.append([algorithm, "not created", "-", "-", "-"])
+                continue
+            # the customization is cached, don't measure it
+            contraction_hierarchy.get_metric(weight_list)
+        cost_list = []
+        number_of_settled_vertices = 0
+        start_time = time.time()
+        for start_vertex_id, dest_vertex_id in route_list:
+            path = routing_graph.find_path(
+                    start_vertex_id, dest_vertex_id, routing_overlay, algorithm=algorithm)
+            cost_list.append(path.cost if path else None)
+            if path:
+                number_of_settled_vertices += path.number_of_settled_vertices
+        duration = int((time.time() - start_time) * 1000)
+        if cost_list_of_dijkstra is None:
+            cost_list_of_dijkstra = cost_list
+            settled_vertices_of_dijkstra = number_of_settled_vertices
+        else:
+            # the goal-directed algorithms must find routes of equal cost
+            for cost, cost_of_dijkstra in zip(cost_list, cost_list_of_dijkstra):
+                if (cost is None) != (cost_of_dijkstra is None) \
+                        or (cost is not None and abs(cost - cost_of_dijkstra) > 1e-6):
+                    logging.warning(
+                            f"{algorithm}: cost {cost} differs from dijkstra {cost_of_dijkstra}")
         table.append(
-                [map_name, last_thirty_days, last_six_months, last_year, total])
+                [   algorithm,
+                    len([ cost for cost in cost_list if cost is not None ]),
+                    number_of_settled_vertices,
+                    "{:.1f} %".format(
+                        100 - 100 * number_of_settled_vertices / settled_vertices_of_dijkstra) \
+                            if settled_vertices_of_dijkstra else "-",
+                    duration ])
     print(pretty_print_table(table))
 
 
+# previous row by row implementation of recreate_vertex_of_routing_table (shell/sql/misc_functions.sql)
+recreate_vertex_of_routing_table_old = """
+CREATE FUNCTION pg_temp.recreate_vertex_of_routing_table_old(regclass)
+RETURNS void
+AS $$
+DECLARE
+    row RECORD;
+    vertex_storage hstore;
+    new_vertex int;
+BEGIN
+    vertex_storage := ''::hstore;
+    new_vertex := -1;
+    FOR row in EXECUTE FORMAT('SELECT id, source, target FROM %I ORDER BY id', $1)
+    LOOP
+        IF NOT vertex_storage ? row.source::text THEN
+            vertex_storage = vertex_storage || hstore(row.source::text, new_vertex::text);
+            new_vertex := new_vertex - 1;
+        END IF;
+        IF NOT vertex_storage ? row.target::text THEN
+            vertex_storage = vertex_storage || hstore(row.target::text, new_vertex::text);
+            new_vertex := new_vertex - 1;
+        END IF;
+    END LOOP;
+    FOR row IN SELECT key, value FROM EACH(vertex_storage)
+    LOOP
+        EXECUTE FORMAT('UPDATE %I SET source=$1 WHERE source = $2', $1) USING row.value::int, row.key::int;
+        EXECUTE FORMAT('UPDATE %I SET target=$1 WHERE target = $2', $1) USING row.value::int, row.key::int;
+    END LOOP;
+    EXECUTE FORMAT('UPDATE %I SET source=source*(-1)', $1);
+    EXECUTE FORMAT('UPDATE %I SET target=target*(-1)', $1);
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+def benchmark_vertex_renumbering(map_id, radius_list, center, repetitions):
+    """
+    Renumber the vertices of temporary routing tables of the given radii with the previous
+    and the current recreate_vertex_of_routing_table. Like in the former temp table pipeline
+    the previous function runs on an indexed table, the current one before the indexes exist.
+    Everything runs in a single transaction, which is rolled back.
+    """
+    db = DBControl(map_id, use_primary=True)
+    routing_table = sql.Identifier(Config().database.get("routing_table"))
+    con = db.acquire_connection()
+    try:
+        cursor = con.cursor()
+        if not center:
+            cursor.execute(
+                    sql.SQL(
+                        """
+                        SELECT ST_Y(ST_Centroid(extent)), ST_X(ST_Centroid(extent))
+                            FROM (SELECT ST_Extent(geom_way)::geometry AS extent FROM {i_routing_table}) AS map
+                        """
+                        ).format(i_routing_table=routing_table))
+            center = cursor.fetchone()
+        print("Center: {:.6f}, {:.6f}".format(*center))
+        cursor.execute(recreate_vertex_of_routing_table_old)
+
+        table = list()
+        table.append(
+                ["radius in m", "edges", "vertices", "previous in ms", "current in ms", "speedup", "equal"])
+        for radius in radius_list:
+            boundaries = get_boundary_box(center[0], center[1], radius)
+            duration_dict = {"previous":[], "current":[]}
+            for repetition in range(repetitions):
+                for name in duration_dict.keys():
+                    cursor.execute(
+                            sql.SQL(
+                                """
+                                DROP TABLE IF EXISTS {i_table};
+                                CREATE TEMP TABLE {i_table} AS
+                                    SELECT id, source, target FROM {i_routing_table}
+                                        WHERE geom_way && ST_MakeEnvelope(
+                                            %(left)s, %(bottom)s, %(right)s, %(top)s);
+                                """
+                                ).format(
+                                    i_table=sql.Identifier("renumbering_{}".format(name)),
+                                    i_routing_table=routing_table),
+                            boundaries)
+                    if name == "previous":
+                        cursor.execute(
+                                """
+                                ALTER TABLE renumbering_previous ADD PRIMARY KEY (id);
+                                CREATE INDEX ON renumbering_previous (source);
+                                CREATE INDEX ON renumbering_previous (target);
+                                ANALYZE renumbering_previous;
+                                """)
+                    start_time = time.time()
+                    cursor.execute(
+                            sql.SQL("SELECT {i_function}({l_table})").format(
+                                i_function=sql.SQL(
+                                    "pg_temp.recreate_vertex_of_routing_table_old" \
+                                        if name == "previous" else "recreate_vertex_of_routing_table"),
+                                l_table=sql.Literal("renumbering_{}".format(name))))
+                    duration_dict[name].append((time.time() - start_time) * 1000)
+            cursor.execute(
+                    """
+                    SELECT
+                        (SELECT COUNT(*) FROM renumbering_current),
+                        (SELECT COUNT(*) FROM (
+                            SELECT source FROM renumbering_current
+                            UNION SELECT target FROM renumbering_current) AS vertex),
+                        NOT EXISTS(
+                            SELECT * FROM renumbering_previous
+                                FULL JOIN renumbering_current USING (id)
+                                WHERE renumbering_previous.source IS DISTINCT FROM renumbering_current.source
+                                    OR renumbering_previous.target IS DISTINCT FROM renumbering_current.target)
+                    """)
+            number_of_edges, number_of_vertices, equal = cursor.fetchone()
+            previous, current = min(duration_dict['previous']), min(duration_dict['current'])
+            table.append(
+                    [   radius, number_of_edges, number_of_vertices, int(previous), int(current),
+                        "{:.1f}x".format(previous / current) if current else "-",
+                        "yes" if equal else "no" ])
+        print(pretty_print_table(table))
+    finally:
+        con.rollback()
+        db.release_connection(con)
+
+
 def print_version_info():
     return "WalkersGuide-Server version: %s     (API versions: %s;   Map versions: %s)" \
             % (server_version, ','.join([str(x) for x in supported_api_version_list]),
@@ -202,6 +422,14 @@ def main():
             help="Start a script to create a new map database thats already in the config file")
     _add_map_selection_args(create_database)
 
+    # create contraction hierarchy
+    create_contraction_hierarchy_aliases = ['create-ch']
+    create_contraction_hierarchy_parser = subparsers.add_parser(
+            "create-contraction-hierarchy", aliases=create_contraction_hierarchy_aliases,
+            description="Recreate the contraction hierarchy of an existing map database",
+            help="Recreate the contraction hierarchy of an existing map database")
+    _add_map_selection_args(create_contraction_hierarchy_parser)
+
     # backup map database
     backup_database_aliases = ['backup', 'backup-map']
     backup_database = subparsers.add_parser(
@@ -242,11 +470,43 @@ def main():
             description="Show usage statistics",
             help="Show usage statistics")
 
+    # benchmark routing algorithms
+    benchmark_routing_aliases = ['benchmark']
+    benchmark_routing = subparsers.add_parser(
+            "benchmark-routing", aliases=benchmark_routing_aliases,
+            description="Compare the routing algorithms on random long routes of the in-memory routing graph",
+            help="Compare the routing algorithms on random long routes of the in-memory routing graph")
+    benchmark_routing.add_argument(
+            'map_id', help='The map id from config')
+    benchmark_routing.add_argument(
+            '-n', '--number-of-routes', type=int, default=20, help='Number of random routes')
+    benchmark_routing.add_argument(
+            '-d', '--min-distance', type=int, default=10000, help='Minimal route distance in meters')
+
+    # benchmark the vertex renumbering of temporary routing tables
+    benchmark_vertex_renumbering_aliases = ['benchmark-renumbering']
+    benchmark_vertex_renumbering_parser = subparsers.add_parser(
+            "benchmark-vertex-renumbering", aliases=benchmark_vertex_renumbering_aliases,
+            description="Compare the previous and current recreate_vertex_of_routing_table on boundary boxes of the map",
+            help="Compare the previous and current recreate_vertex_of_routing_table on boundary boxes of the map")
+    benchmark_vertex_renumbering_parser.add_argument(
+            'map_id', help='The map id from config')
+    benchmark_vertex_renumbering_parser.add_argument(
+            '-r', '--radius', type=int, nargs='+', default=[1000, 2000, 6000, 16000],
+            help='Radii of the boundary boxes in meters, a route of d meters uses 750 + d/2')
+    benchmark_vertex_renumbering_parser.add_argument(
+            '-c', '--center', type=float, nargs=2, metavar=('LAT', 'LON'),
+            help='Center of the boundary boxes, default: center of the map')
+    benchmark_vertex_renumbering_parser.add_argument(
+            '-n', '--repetitions', type=int, default=3, help='Runs per boundary box, the fastest counts')
+
     args = parser.parse_args()
 
     # create or backup maps
     if         args.action == "create-map-database" \
             or args.action in create_database_aliases \
+            or args.action == "create-contraction-hierarchy" \
+            or args.action in create_contraction_hierarchy_aliases \
             or args.action == "backup-map-database" \
             or args.action in backup_database_aliases:
 
@@ -267,6 +527,10 @@ def main():
             if         args.action == "create-map-database" \
                     or args.action in create_database_aliases:
                 create_map_database(map_id)
+            elif       args.action == "create-contraction-hierarchy" \
+                    or args.action in create_contraction_hierarchy_aliases:
+                print("Done in {} seconds".format(create_contraction_hierarchy(map_id)))
+                continue
             else:
                 backup_map_database(map_id, args.backup_folder)
             time.sleep(10)
@@ -289,6 +553,20 @@ def main():
             or args.action in statistics_aliases:
         show_statistics()
 
+    elif       args.action == "benchmark-routing" \
+            or args.action in benchmark_routing_aliases:
+        if args.map_id not in Config().maps.keys():
+            exit("Map id {} not found in config file.\nAvailable maps: {}".format(
+                    args.map_id, list_map_ids()), prefix="Benchmark failed\n")
+        benchmark_routing(args.map_id, args.number_of_routes, args.min_distance)
+
+    elif       args.action == "benchmark-vertex-renumbering" \
+            or args.action in benchmark_vertex_renumbering_aliases:
+        if args.map_id not in Config().maps.keys():
+            exit("Map id {} not found in config file.\nAvailable maps: {}".format(
+                    args.map_id, list_map_ids()), prefix="Benchmark failed\n")
+        benchmark_vertex_renumbering(args.map_id, args.radius, args.center, args.repetitions)
+
 
 if __name__ == '__main__':
     main()